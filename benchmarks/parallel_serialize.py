@@ -0,0 +1,70 @@
+"""Compare serial and parallel serialization for increasing source counts.
+
+Run with karabo_bridge installed (e.g. ``pip install -e .``)::
+
+    python benchmarks/parallel_serialize.py
+
+Arrays are made non-contiguous, so serializing them needs a copy, which is
+the part that can run in parallel. Use --compress to time zlib compression
+instead.
+"""
+
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from karabo_bridge.serializer import serialize
+
+
+def make_data(nsources, array_mb):
+    n = int(array_mb * 1024 * 1024 / 4)
+    side = max(int(np.sqrt(n / 16)), 1)
+    data = {}
+    for i in range(nsources):
+        # Transposed view: not C-contiguous
+        image = np.random.uniform(1500, 1600, (16, side, side)).astype(
+            np.float32).T
+        data[f'SPB_DET_AGIPD1M-1/DET/{i}CH0:xtdf'] = {
+            'image.data': image, 'header.pulseCount': 64,
+        }
+    return data
+
+
+def time_serialize(data, repeats, **kwargs):
+    best = float('inf')
+    for _ in range(repeats):
+        start = perf_counter()
+        serialize(data, **kwargs)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--sources', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    ap.add_argument('--sizes', type=float, nargs='+', default=[1, 8, 32],
+                    help='Array size per source in MB')
+    ap.add_argument('--repeats', type=int, default=5)
+    ap.add_argument('--compress', action='store_true',
+                    help='Compress arrays with zlib')
+    args = ap.parse_args(argv)
+
+    kwargs = {}
+    if args.compress:
+        kwargs['compression'] = {'image.data': 'zlib'}
+
+    print(f"{'sources':>8} {'MB/src':>8} {'serial ms':>10} {'parallel ms':>12}"
+          f" {'speedup':>8}")
+    for size in args.sizes:
+        for nsources in args.sources:
+            data = make_data(nsources, size)
+            t_serial = time_serialize(data, args.repeats, **kwargs)
+            t_parallel = time_serialize(data, args.repeats, parallel=True,
+                                        **kwargs)
+            print(f'{nsources:>8} {size:>8g} {t_serial * 1000:>10.1f} '
+                  f'{t_parallel * 1000:>12.1f} {t_serial / t_parallel:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""Time and measure memory use of serialize, deserialize and _serialize_old.
+
+Run with karabo_bridge installed (e.g. ``pip install -e .``)::
+
+    python benchmarks/serializer_hotpaths.py -o before.json
+    # ... change the serializer ...
+    python benchmarks/serializer_hotpaths.py --baseline before.json
+
+Each case is timed over several calls, keeping the fastest, and then called
+once more with tracemalloc running to find the peak memory allocated. With
+--baseline, results slower or using more memory than the baseline by more
+than --tolerance are flagged, and the exit status is 1.
+"""
+
+import argparse
+import json
+import platform
+import sys
+from time import perf_counter
+import tracemalloc
+
+import numpy as np
+
+from karabo_bridge import __version__
+from karabo_bridge.serializer import _serialize_old, deserialize, serialize
+
+
+def many_small(numpy_scalars=False, nsources=200):
+    """Many sources of slow data: scalars, strings and small arrays"""
+    f = np.float64 if numpy_scalars else float
+    i = np.int32 if numpy_scalars else int
+    data = {}
+    for s in range(nsources):
+        data[f'SA1_XTD2_XGM/DOOCS/MAIN{s}'] = {
+            'pulseEnergy.photonFlux': f(s * 0.5),
+            'pulseEnergy.wavelengthUsed': f(1.33),
+            'pulseEnergy.nummberOfBrunches': i(64),
+            'beamPosition.ixPos': f(-0.2),
+            'beamPosition.iyPos': f(0.7),
+            'gasDosing.pressure': f(1e-5),
+            'state': 'ON',
+            'data.intensityTD': np.linspace(0, 1, 100, dtype=np.float32),
+        }
+    return data
+
+
+def few_huge(contiguous=True, nsources=2, array_mb=32):
+    """A few sources with big detector-like arrays"""
+    side = int(np.sqrt(array_mb * 1024 * 1024 / 2 / 64))
+    data = {}
+    for s in range(nsources):
+        image = np.zeros((64, side, side), dtype=np.uint16)
+        if not contiguous:
+            image = image.T  # As sent online: (fs, ss, pulses)
+        data[f'SPB_DET_AGIPD1M-1/DET/{s}CH0:xtdf'] = {
+            'image.data': image,
+            'image.cellId': np.arange(64, dtype=np.uint16),
+            'header.pulseCount': 64,
+        }
+    return data
+
+
+CASES = {
+    'many_small_python': lambda: many_small(numpy_scalars=False),
+    'many_small_numpy_scalars': lambda: many_small(numpy_scalars=True),
+    'few_huge_contiguous': lambda: few_huge(contiguous=True),
+    'few_huge_noncontiguous': lambda: few_huge(contiguous=False),
+}
+
+
+def _metadata(data):
+    return {src: {'source': src, 'timestamp': 1.5e9, 'timestamp.tid': 10000}
+            for src in data}
+
+
+def _functions(data):
+    """The functions to benchmark, each taking no arguments"""
+    meta = _metadata(data)
+    msg = [bytes(f) for f in serialize(data, meta)]
+    return {
+        'serialize': lambda: serialize(data, meta),
+        'deserialize': lambda: deserialize(msg),
+        '_serialize_old': lambda: _serialize_old(data, meta, False),
+    }
+
+
+def measure(func, repeats):
+    """Fastest time of *repeats* calls, and the peak memory of one call"""
+    best = float('inf')
+    for _ in range(repeats):
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': best, 'peak_bytes': peak}
+
+
+def compare(results, baseline, tolerance):
+    """List of (name, quantity, baseline, new) over the tolerance"""
+    regressions = []
+    for name, new in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for quantity in ('seconds', 'peak_bytes'):
+            if new[quantity] > old[quantity] * (1 + tolerance):
+                regressions.append((name, quantity, old[quantity],
+                                    new[quantity]))
+    return regressions
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--cases', nargs='+', choices=list(CASES),
+                    default=list(CASES))
+    ap.add_argument('--repeats', type=int, default=10)
+    ap.add_argument('-o', '--output', help='Write the results to a JSON file')
+    ap.add_argument('--baseline',
+                    help='JSON file from a previous run to compare with')
+    ap.add_argument('--tolerance', type=float, default=0.2,
+                    help='Fraction slower or bigger than the baseline which '
+                         'counts as a regression (default 0.2)')
+    args = ap.parse_args(argv)
+
+    results = {}
+    print(f"{'benchmark':<42} {'ms':>9} {'peak MB':>9}")
+    for case in args.cases:
+        for func_name, func in _functions(CASES[case]()).items():
+            name = f'{func_name}/{case}'
+            r = results[name] = measure(func, args.repeats)
+            print(f"{name:<42} {r['seconds'] * 1000:>9.3f} "
+                  f"{r['peak_bytes'] / 1e6:>9.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'environment': {
+                    'karabo_bridge': __version__,
+                    'python': platform.python_version(),
+                    'numpy': np.__version__,
+                    'platform': platform.platform(),
+                },
+                'results': results,
+            }, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for name, quantity, old, new in regressions:
+            print(f'REGRESSION {name} {quantity}: {old:.4g} -> {new:.4g} '
+                  f'({new / old - 1:+.0%})')
+        if regressions:
+            return 1
+        print(f'No regressions compared to {args.baseline}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,382 @@
+# coding: utf-8
+"""
+Running statistics of detector data over a stream of trains.
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+from collections import deque
+
+import numpy as np
+
+from .stage import ImageStage
+
+
+__all__ = ['RunningStats', 'EWMStats', 'RollingStats']
+
+
+class _CellAccumulator(ImageStage):
+    """Common code for statistics per pixel and memory cell.
+
+    Buffers are shaped (cells, ) + frame shape, and are allocated on the
+    first train and grown if higher cell IDs appear.
+
+    Subclasses update the buffers through :meth:`_gather` and
+    :meth:`_scatter`. For a consecutive run of cells, as usual, these give a
+    view of the buffer rows, which are updated in place. Otherwise, the rows
+    are copied into scratch buffers reused from train to train.
+    """
+    required_keys = ('image.cellId',)
+
+    def __init__(self, source=None, key='image.data', data_like='online'):
+        super().__init__(source, key, data_like)
+        self.frame_shape = None
+        self.n_cells = 0
+        self._scratch_bufs = {}
+
+    def _frames(self, image):
+        """View of the image with pulses on the first axis"""
+        if self.data_like == 'online':
+            return np.moveaxis(image, -1, 0)
+        return image
+
+    def _buffer_names(self):
+        raise NotImplementedError
+
+    def _fill_value(self, name):
+        return 0
+
+    def _ensure_buffers(self, frame_shape, n_cells):
+        if self.frame_shape is None:
+            self.frame_shape = frame_shape
+        elif frame_shape != self.frame_shape:
+            raise ValueError(f'Frame shape changed from {self.frame_shape} '
+                             f'to {frame_shape}')
+        if n_cells <= self.n_cells:
+            return
+
+        for name in self._buffer_names():
+            old = getattr(self, name, None)
+            dtype = np.int64 if name == 'count' else np.float64
+            shape = (n_cells,) if name == 'count' else (n_cells,) + frame_shape
+            new = np.full(shape, self._fill_value(name), dtype=dtype)
+            if old is not None:
+                new[:self.n_cells] = old
+            setattr(self, name, new)
+        self.n_cells = n_cells
+
+    def update(self, image, cells):
+        """Add one train of data.
+
+        Parameters
+        ----------
+        image : numpy.ndarray
+            Detector data for one train (``image.data``).
+        cells : numpy.ndarray
+            Memory cell ID of each pulse (``image.cellId``).
+        """
+        self._add_frames(self._frames(image), np.asarray(cells, dtype=np.intp))
+
+    @staticmethod
+    def _unique_groups(cells):
+        """Split pulse indices into groups where each cell appears once.
+
+        Fancy indexing with repeated cells would lose updates.
+        """
+        if len(np.unique(cells)) == len(cells):
+            yield slice(None)  # All unique: the usual case
+            return
+        remaining = np.arange(len(cells))
+        while len(remaining):
+            _, first = np.unique(cells[remaining], return_index=True)
+            yield remaining[first]
+            remaining = np.delete(remaining, first)
+
+    @staticmethod
+    def _cell_index(cells):
+        """A slice for consecutive cells, which indexes without copying"""
+        if len(cells) and (np.diff(cells) == 1).all():
+            return slice(cells[0], cells[0] + len(cells))
+        return cells
+
+    def _scratch(self, name, n):
+        """Reusable float64 buffer shaped (n,) + frame shape"""
+        buf = self._scratch_bufs.get(name)
+        if buf is None or len(buf) < n or buf.shape[1:] != self.frame_shape:
+            buf = np.empty((n,) + self.frame_shape)
+            self._scratch_bufs[name] = buf
+        return buf[:n]
+
+    def _gather(self, name, cells):
+        """Rows of a buffer for *cells*, to update and pass to _scatter"""
+        buf = getattr(self, name)
+        if isinstance(cells, slice):
+            return buf[cells]
+        out = self._scratch(name, len(cells))
+        return np.take(buf, cells, axis=0, out=out)
+
+    def _scatter(self, name, cells, rows):
+        """Store rows from _gather; views were already updated in place"""
+        if not isinstance(cells, slice):
+            getattr(self, name)[cells] = rows
+
+    def _add_frames(self, frames, cells):
+        if len(cells) == 0:
+            return  # A train without pulses
+        self._ensure_buffers(frames.shape[1:], int(cells.max()) + 1)
+        for sel in self._unique_groups(cells):
+            self._update(frames[sel], self._cell_index(cells[sel]))
+
+    def _update(self, frames, cells):
+        raise NotImplementedError
+
+    def process(self, source, src_data):
+        self.update(src_data[self.key], src_data['image.cellId'])
+
+
+class RunningStats(_CellAccumulator):
+    """Mean and variance per pixel and memory cell over all trains.
+
+    Uses Welford's algorithm, so the result is numerically stable however
+    many trains are added, and memory use does not grow with the run length.
+    Use it as a :class:`~karabo_bridge.Client` stage to accumulate every
+    train received::
+
+        dark = RunningStats()
+        client.add_stage(dark)
+        for _ in range(1000):
+            client.next()
+        snap = dark.snapshot()
+        snap['mean'], snap['std']  # shaped (cells,) + frame shape
+
+    Parameters
+    ----------
+    source, key, data_like
+        As for :class:`~karabo_bridge.stage.ImageStage`. All the sources
+        selected are added together.
+    minmax : bool, optional
+        Also track the minimum and maximum values.
+    """
+    def __init__(self, source=None, key='image.data', data_like='online',
+                 minmax=False):
+        super().__init__(source, key, data_like)
+        self.minmax = minmax
+
+    def _buffer_names(self):
+        names = ['count', 'mean', 'm2']
+        if self.minmax:
+            names += ['min', 'max']
+        return names
+
+    def _fill_value(self, name):
+        return {'min': np.inf, 'max': -np.inf}.get(name, 0)
+
+    def _update(self, frames, cells):
+        self.count[cells] += 1
+        count = self.count[cells].reshape((-1,) + (1,) * len(self.frame_shape))
+
+        mean = self._gather('mean', cells)
+        delta = self._scratch('delta', len(frames))
+        tmp = self._scratch('tmp', len(frames))
+        np.subtract(frames, mean, out=delta)
+        np.divide(delta, count, out=tmp)
+        mean += tmp
+        self._scatter('mean', cells, mean)
+        # m2 += delta * (x - new mean)
+        np.subtract(frames, mean, out=tmp)
+        tmp *= delta
+        m2 = self._gather('m2', cells)
+        m2 += tmp
+        self._scatter('m2', cells, m2)
+
+        if self.minmax:
+            for name, func in (('min', np.minimum), ('max', np.maximum)):
+                rows = self._gather(name, cells)
+                func(rows, frames, out=rows)
+                self._scatter(name, cells, rows)
+
+    def snapshot(self, ddof=0):
+        """Copy the current statistics.
+
+        Returns
+        -------
+        dict
+            ``count`` (per cell), ``mean``, ``variance``, ``std`` and, with
+            *minmax*, ``min`` and ``max``. Cells with no data give NaN.
+        """
+        if self.frame_shape is None:
+            return {}
+        count = self.count.reshape((-1,) + (1,) * len(self.frame_shape))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = self.m2 / (count - ddof)
+            mean = np.where(count > 0, self.mean, np.nan)
+        variance[np.broadcast_to(count <= ddof, variance.shape)] = np.nan
+        snap = {
+            'count': self.count.copy(),
+            'mean': mean,
+            'variance': variance,
+            'std': np.sqrt(variance),
+        }
+        if self.minmax:
+            snap['min'] = self.min.copy()
+            snap['max'] = self.max.copy()
+        return snap
+
+
+class EWMStats(_CellAccumulator):
+    """Exponentially weighted mean and variance per pixel and memory cell.
+
+    Recent trains have more weight, so the statistics follow slow drifts.
+    The first train seen for a cell initialises its mean.
+
+    Parameters
+    ----------
+    alpha : float
+        Weight of each new train, between 0 and 1.
+    source, key, data_like
+        As for :class:`~karabo_bridge.stage.ImageStage`.
+    """
+    def __init__(self, alpha, source=None, key='image.data',
+                 data_like='online'):
+        if not 0 < alpha <= 1:
+            raise ValueError('alpha must be in the range (0, 1]')
+        super().__init__(source, key, data_like)
+        self.alpha = alpha
+
+    def _buffer_names(self):
+        return ['count', 'mean', 'var']
+
+    def _update(self, frames, cells):
+        new = self.count[cells] == 0
+        self.count[cells] += 1
+
+        mean = self._gather('mean', cells)
+        var = self._gather('var', cells)
+        if new.any():
+            # Start new cells from their first value
+            mean[new] = frames[new]
+
+        delta = self._scratch('delta', len(frames))
+        tmp = self._scratch('tmp', len(frames))
+        np.subtract(frames, mean, out=delta)
+        np.multiply(delta, self.alpha, out=tmp)
+        mean += tmp
+        # var = (1 - alpha) * (var + alpha * delta**2)
+        delta *= tmp
+        var += delta
+        var *= 1 - self.alpha
+
+        self._scatter('mean', cells, mean)
+        self._scatter('var', cells, var)
+
+    def snapshot(self):
+        """Copy the current statistics.
+
+        Returns
+        -------
+        dict
+            ``count`` (per cell), ``mean``, ``variance`` and ``std``. Cells
+            with no data give NaN.
+        """
+        if self.frame_shape is None:
+            return {}
+        unseen = self.count == 0
+        mean, variance = self.mean.copy(), self.var.copy()
+        mean[unseen] = np.nan
+        variance[unseen] = np.nan
+        return {
+            'count': self.count.copy(),
+            'mean': mean,
+            'variance': variance,
+            'std': np.sqrt(variance),
+        }
+
+
+class RollingStats(_CellAccumulator):
+    """Mean and variance per pixel and memory cell over the last N trains.
+
+    This keeps a copy of the last *window* trains' frames, so the memory
+    use is proportional to the window length. Sums are updated as trains
+    enter and leave the window, and recomputed from the kept frames every
+    *window* trains, so rounding errors don't build up.
+
+    Parameters
+    ----------
+    window : int
+        Number of trains to include.
+    source, key, data_like
+        As for :class:`~karabo_bridge.stage.ImageStage`.
+    """
+    def __init__(self, window, source=None, key='image.data',
+                 data_like='online'):
+        if window < 1:
+            raise ValueError('window must be at least 1 train')
+        super().__init__(source, key, data_like)
+        self.window = window
+        self._trains = deque()
+        self._n_removed = 0  # Since the sums were recomputed
+
+    def _buffer_names(self):
+        return ['count', 'sum', 'sumsq']
+
+    def update(self, image, cells):
+        frames = np.array(self._frames(image), dtype=np.float64)
+        cells = np.array(cells, dtype=np.intp)
+        self._trains.append((frames, cells))
+        self._add_frames(frames, cells)
+        if len(self._trains) > self.window:
+            self._remove(*self._trains.popleft())
+            self._n_removed += 1
+            if self._n_removed >= self.window:
+                self._recompute()
+
+    def _update(self, frames, cells, sign=1):
+        self.count[cells] += sign
+        tmp = self._scratch('tmp', len(frames))
+        np.multiply(frames, frames, out=tmp)
+        for name, values in (('sum', frames), ('sumsq', tmp)):
+            rows = self._gather(name, cells)
+            if sign > 0:
+                rows += values
+            else:
+                rows -= values
+            self._scatter(name, cells, rows)
+
+    def _remove(self, frames, cells):
+        for sel in self._unique_groups(cells):
+            self._update(frames[sel], self._cell_index(cells[sel]), sign=-1)
+
+    def _recompute(self):
+        """Sum the frames in the window again, discarding rounding errors"""
+        for name in self._buffer_names():
+            getattr(self, name)[...] = 0
+        for frames, cells in self._trains:
+            self._add_frames(frames, cells)
+        self._n_removed = 0
+
+    def snapshot(self, ddof=0):
+        """Statistics over the current window.
+
+        Returns
+        -------
+        dict
+            ``count`` (per cell), ``mean``, ``variance`` and ``std``.
+        """
+        if self.frame_shape is None:
+            return {}
+        count = self.count.reshape((-1,) + (1,) * len(self.frame_shape))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum / count
+            variance = (self.sumsq - self.sum * mean) / (count - ddof)
+        # Rounding can make the variance slightly negative
+        np.maximum(variance, 0, out=variance)
+        return {
+            'count': self.count.copy(),
+            'mean': mean,
+            'variance': variance,
+            'std': np.sqrt(variance),
+        }
@@ -0,0 +1,220 @@
+# coding: utf-8
+"""
+Client side calibration of raw detector data.
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .stage import ImageStage
+
+
+__all__ = ['Calibration']
+
+
+class _SourceState:
+    """Buffers kept between trains for one source"""
+    def __init__(self):
+        self.cells = None
+        self.offset = None
+        self.rel_gain = None
+        self.out = None
+        self.mask = None
+        self.mask_tmp = None
+
+
+class Calibration(ImageStage):
+    """Offset and relative gain correction for raw detector data.
+
+    Constants are loaded once and the values matching ``image.cellId`` are
+    gathered only when the cell ID sequence changes. Corrected data is
+    written as float32 into a buffer which is reused from train to train, so
+    processing a train does not allocate any temporary array.
+
+    Use it as a :class:`~karabo_bridge.Client` stage::
+
+        offset, rel_gain = load_my_constants()
+        client = Client('tcp://localhost:4545')
+        client.add_stage(Calibration(offset, rel_gain))
+
+        for data, meta in client:
+            ...
+
+    The corrected array replaces ``image.data`` in the returned train. It is
+    overwritten by the next train, so copy it if you need to keep it. Sources
+    without ``image.cellId`` are not corrected.
+
+    Parameters
+    ----------
+    offset : numpy.ndarray
+        Offset constants, shaped ``(gain stages,) + data shape``, with the
+        memory cell axis of the data being as long as the number of cells.
+    rel_gain : numpy.ndarray, optional
+        Relative gain constants, same shape as *offset*. The offset corrected
+        data is multiplied by these values. Default: no gain correction.
+    source, key, data_like
+        As for :class:`~karabo_bridge.stage.ImageStage`.
+    gain_thresholds : sequence of float, optional
+        Thresholds applied to ``image.gain`` to find the gain stage of each
+        pixel. By default, ``image.gain`` holds the gain stage index itself.
+    threads : int, optional
+        Split the correction across this number of threads, one module at
+        a time. Default 0: correct in the calling thread. Call :meth:`close`
+        to stop the threads when you are done.
+    """
+    required_keys = ('image.cellId',)
+
+    def __init__(self, offset, rel_gain=None, source=None, key='image.data',
+                 data_like='online', gain_thresholds=None, threads=0):
+        super().__init__(source, key, data_like)
+        offset = np.asarray(offset, dtype=np.float32)
+        if rel_gain is not None:
+            rel_gain = np.asarray(rel_gain, dtype=np.float32)
+            if rel_gain.shape != offset.shape:
+                raise ValueError(
+                    f'Gain constants shape {rel_gain.shape} does not match '
+                    f'offset constants shape {offset.shape}')
+        n_gain = offset.shape[0]
+        if gain_thresholds is not None and len(gain_thresholds) != n_gain - 1:
+            raise ValueError(
+                f'Expected {n_gain - 1} gain thresholds, '
+                f'got {len(gain_thresholds)}')
+
+        self.offset = offset
+        self.rel_gain = rel_gain
+        self.gain_thresholds = gain_thresholds
+        self.threads = threads
+        self._pool = ThreadPoolExecutor(threads) if threads > 0 else None
+        self._state = {}
+
+    def close(self):
+        """Stop the worker threads, if any"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    @property
+    def n_gain(self):
+        return self.offset.shape[0]
+
+    def _cell_axis(self, ndim):
+        return ndim - 1 if self.data_like == 'online' else 0
+
+    def _module_axis(self, ndim):
+        if ndim < 4:
+            return None  # single module
+        return 0 if self.data_like == 'online' else 1
+
+    def _prepare(self, state, raw, cells):
+        """Gather constants for this cell sequence and allocate buffers"""
+        if (state.out is None or state.out.shape != raw.shape
+                or not np.array_equal(state.cells, cells)):
+            # The constants have a leading gain axis
+            axis = self._cell_axis(raw.ndim) + 1
+            state.offset = np.take(self.offset, cells, axis=axis)
+            if self.rel_gain is not None:
+                state.rel_gain = np.take(self.rel_gain, cells, axis=axis)
+            state.cells = cells.copy()
+
+        if state.out is None or state.out.shape != raw.shape:
+            state.out = np.empty(raw.shape, dtype=np.float32)
+            if self.n_gain > 1:
+                state.mask = np.empty(raw.shape, dtype=np.bool_)
+                state.mask_tmp = np.empty(raw.shape, dtype=np.bool_)
+
+    def _stage_mask(self, gain, stage, mask, tmp):
+        """Fill *mask* with the pixels in gain *stage*"""
+        last = stage == self.n_gain - 1
+        if self.gain_thresholds is None:
+            if last:
+                np.greater_equal(gain, stage, out=mask)
+            else:
+                np.equal(gain, stage, out=mask)
+            return
+
+        thresholds = self.gain_thresholds
+        if stage == 0:
+            np.less(gain, thresholds[0], out=mask)
+        elif last:
+            np.greater_equal(gain, thresholds[-1], out=mask)
+        else:
+            np.greater_equal(gain, thresholds[stage - 1], out=mask)
+            np.less(gain, thresholds[stage], out=tmp)
+            np.logical_and(mask, tmp, out=mask)
+
+    def _correct(self, raw, gain, offset, rel_gain, out, mask, tmp):
+        if self.n_gain == 1 or gain is None:
+            np.subtract(raw, offset[0], out=out)
+            if rel_gain is not None:
+                np.multiply(out, rel_gain[0], out=out)
+            return
+
+        for stage in range(self.n_gain):
+            self._stage_mask(gain, stage, mask, tmp)
+            np.subtract(raw, offset[stage], out=out, where=mask)
+            if rel_gain is not None:
+                np.multiply(out, rel_gain[stage], out=out, where=mask)
+
+    def correct(self, raw, cells, gain=None, state=None):
+        """Correct one train of raw data.
+
+        Parameters
+        ----------
+        raw : numpy.ndarray
+            Raw detector data for a train.
+        cells : numpy.ndarray
+            Memory cell ID of each pulse (``image.cellId``).
+        gain : numpy.ndarray, optional
+            Gain information (``image.gain``), broadcastable to *raw*.
+            Only used with multiple gain stages.
+
+        Returns
+        -------
+        numpy.ndarray
+            The float32 corrected data. This buffer is reused for the next
+            call.
+        """
+        if state is None:
+            state = self._state.setdefault(None, _SourceState())
+        cells = np.asarray(cells)
+        self._prepare(state, raw, cells)
+
+        module_axis = self._module_axis(raw.ndim)
+        if self._pool is None or module_axis is None:
+            self._correct(raw, gain, state.offset, state.rel_gain, state.out,
+                          state.mask, state.mask_tmp)
+            return state.out
+
+        if gain is not None:
+            # A view with the module axis, to select each module's part
+            gain = np.broadcast_to(gain, raw.shape)
+
+        def per_module(ix):
+            sel = (slice(None),) * module_axis + (ix,)
+            csel = (slice(None),) + sel  # constants have a gain axis
+            self._correct(
+                raw[sel], None if gain is None else gain[sel],
+                state.offset[csel],
+                None if state.rel_gain is None else state.rel_gain[csel],
+                state.out[sel],
+                None if state.mask is None else state.mask[sel],
+                None if state.mask_tmp is None else state.mask_tmp[sel],
+            )
+
+        # list() to raise any exception from the worker threads
+        list(self._pool.map(per_module, range(raw.shape[module_axis])))
+        return state.out
+
+    def process(self, source, src_data):
+        state = self._state.setdefault(source, _SourceState())
+        src_data[self.key] = self.correct(
+            src_data[self.key], src_data['image.cellId'],
+            src_data.get('image.gain'), state=state,
+        )
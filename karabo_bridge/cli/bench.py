@@ -0,0 +1,311 @@
+"""Measure Karabo bridge throughput and latency between local endpoints.
+
+Each configuration starts a server in a thread, sending simulated detector
+data, and one or more clients receiving it in other threads of the same
+process. The results are written as JSON, to compare them between releases.
+"""
+
+import argparse
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from itertools import product
+import json
+import os
+import platform
+from queue import Full
+import sys
+from tempfile import TemporaryDirectory
+from threading import Barrier, BrokenBarrierError, Event, Thread
+import time
+
+import numpy as np
+import zmq
+
+from .. import Client, __version__
+from ..server import ServerInThread, SimServerInThread, _array_nbytes
+from ..simulation import data_generator
+
+# Server socket: client socket
+CLIENT_SOCKETS = {'REP': 'REQ', 'PUB': 'SUB', 'PUSH': 'PULL'}
+
+
+def _endpoint(transport, tmpdir, name):
+    if transport == 'tcp':
+        return 'tcp://127.0.0.1:*'  # Bound to a free port
+    elif transport == 'ipc':
+        return f'ipc://{tmpdir}/{name}'
+    elif transport == 'inproc':
+        return f'inproc://{name}'
+    raise ValueError(f'Unknown transport {transport!r}')
+
+
+def _thread_cpu_time(thread):
+    """CPU time of another thread, or NaN if the platform can't tell"""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+    except (AttributeError, OSError):
+        return np.nan
+
+
+def _timestamp(meta):
+    return next((m['timestamp'] for m in meta.values() if 'timestamp' in m),
+                np.nan)
+
+
+class _Feeder(Thread):
+    """Feed trains to a ServerInThread until stopped"""
+    def __init__(self, server, trains):
+        super().__init__(daemon=True)
+        self.server = server
+        self.trains = trains
+        self.n_fed = 0
+        self.stopped = Event()
+
+    def run(self):
+        for data, meta in self.trains:
+            while not self.stopped.is_set():
+                try:
+                    self.server.feed(data, meta, timeout=0.1)
+                    break
+                except Full:
+                    pass
+            else:
+                return
+            self.n_fed += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def _n_sent(sender, feeder):
+    return sender.n_sent if feeder is None else feeder.n_fed
+
+
+def _receive(client, ntrains, warmup, barrier, result):
+    try:
+        for _ in range(warmup):
+            client.next()
+        barrier.wait()
+
+        latency = np.empty(ntrains)
+        nbytes = 0
+        cpu0 = time.thread_time()
+        for i in range(ntrains):
+            data, meta = client.next()
+            latency[i] = time.time() - _timestamp(meta)
+            nbytes += sum(_array_nbytes(props) for props in data.values())
+        result.update(cpu=time.thread_time() - cpu0, bytes=nbytes,
+                      latency=latency)
+    except BrokenBarrierError:
+        pass
+    except Exception as e:
+        result['error'] = repr(e)
+        barrier.abort()
+
+
+def run_config(server='sim', transport='tcp', pattern='REP',
+               protocol='2.2', detector='AGIPDModule', data_like='online',
+               nsources=1, clients=1, ntrains=100, warmup=10, timeout=30):
+    """Run one benchmark configuration.
+
+    Parameters
+    ----------
+    server: ('sim' | 'thread')
+        Send trains from a :class:`~karabo_bridge.server.SimServerInThread`,
+        or feed them to a :class:`~karabo_bridge.ServerInThread`.
+    transport: ('tcp' | 'ipc' | 'inproc')
+    pattern: ('REP' | 'PUB' | 'PUSH')
+        The server socket type; clients use REQ, SUB or PULL.
+    protocol, detector, data_like, nsources:
+        Options for the simulated data, as for ``karabo-bridge-server-sim``.
+        Detectors send raw data, taken from a pool so generating it doesn't
+        limit the rate.
+    clients: int
+        Number of clients, each receiving in its own thread.
+    ntrains: int
+        Trains measured per client, after *warmup* trains.
+    timeout: float
+        Seconds for a client to wait for a train before giving up.
+
+    Returns
+    -------
+    dict
+        The configuration and its results. Latency is measured from
+        generating a train (its ``timestamp`` metadata) until a client has
+        decoded it. Server CPU time is per train sent, which may be more
+        than were received with PUB sockets; other CPU times are per train
+        received.
+    """
+    config = dict(server=server, transport=transport,
+                  pattern=f'{pattern}-{CLIENT_SOCKETS[pattern]}',
+                  protocol=protocol, detector=detector, data_like=data_like,
+                  nsources=nsources, clients=clients)
+    data_kw = dict(detector=detector, raw=True, nsources=nsources,
+                   datagen='zeros', data_like=data_like, pool=1, native=True)
+    # inproc:// only connects sockets in the same context
+    context = zmq.Context() if transport == 'inproc' else None
+    feeder = None
+
+    with TemporaryDirectory() as tmpdir, ExitStack() as stack:
+        if context is not None:
+            # Registered first, so it's destroyed after the sockets close
+            stack.callback(context.destroy, linger=0)
+        endpoint = _endpoint(transport, tmpdir, 'karabo-bridge-bench')
+        if server == 'sim':
+            sender = SimServerInThread(
+                endpoint, sock=pattern, protocol_version=protocol,
+                context=context, debug=False, **data_kw)
+            sender.timing_interval = sys.maxsize  # No rate reports
+        elif server == 'thread':
+            sender = ServerInThread(endpoint, sock=pattern, maxlen=1,
+                                    protocol_version=protocol,
+                                    context=context)
+            feeder = _Feeder(sender, data_generator(**data_kw))
+        else:
+            raise ValueError(f'Unknown server {server!r}')
+
+        barrier = Barrier(clients + 1, timeout=timeout)
+        results = [{} for _ in range(clients)]
+        conns = [stack.enter_context(Client(
+                    sender.endpoint, sock=CLIENT_SOCKETS[pattern],
+                    timeout=timeout, context=context))
+                 for _ in range(clients)]
+        threads = [Thread(target=_receive, daemon=True,
+                          args=(c, ntrains, warmup, barrier, r))
+                   for c, r in zip(conns, results)]
+        try:
+            sender.start()
+            if feeder is not None:
+                feeder.start()
+            for t in threads:
+                t.start()
+
+            try:
+                barrier.wait()
+            except BrokenBarrierError:
+                pass
+            t0, cpu0 = time.perf_counter(), time.process_time()
+            server_cpu0 = _thread_cpu_time(sender.thread)
+            sent0 = _n_sent(sender, feeder)
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - t0
+            process_cpu = time.process_time() - cpu0
+            server_cpu = _thread_cpu_time(sender.thread) - server_cpu0
+            sent = _n_sent(sender, feeder) - sent0
+        finally:
+            if feeder is not None:
+                feeder.stop()
+            sender.stop()
+
+    errors = [r['error'] for r in results if 'error' in r]
+    if errors:
+        return dict(config, error=errors[0])
+
+    received = clients * ntrains
+    nbytes = sum(r['bytes'] for r in results)
+    latency = np.concatenate([r['latency'] for r in results]) * 1000
+    p50, p90, p99 = np.percentile(latency, [50, 90, 99])
+    return dict(
+        config,
+        trains=received,
+        seconds=elapsed,
+        trains_per_s=received / elapsed,
+        gb_per_s=nbytes / elapsed / 1e9,
+        train_bytes=nbytes // received,
+        latency_ms={'p50': p50, 'p90': p90, 'p99': p99,
+                    'max': latency.max()},
+        trains_sent=sent,
+        server_cpu_ms_per_train=server_cpu / max(sent, 1) * 1000,
+        client_cpu_ms_per_train=sum(r['cpu'] for r in results)
+        / received * 1000,
+        process_cpu_ms_per_train=process_cpu / received * 1000,
+    )
+
+
+def _environment():
+    return {
+        'karabo_bridge': __version__,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pyzmq': zmq.__version__,
+        'libzmq': zmq.zmq_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    }
+
+
+def _summary(r):
+    name = ('{server} {transport} {pattern} p{protocol} {detector} '
+            '{data_like} x{nsources}'.format(**r))
+    if 'error' in r:
+        return f'{name}: FAILED ({r["error"]})'
+    return ('{}: {:.1f} trains/s, {:.3f} GB/s, latency p50 {:.1f} ms, '
+            'p99 {:.1f} ms, CPU server {:.1f} / client {:.1f} ms/train'
+            ''.format(name, r['trains_per_s'], r['gb_per_s'],
+                      r['latency_ms']['p50'], r['latency_ms']['p99'],
+                      r['server_cpu_ms_per_train'],
+                      r['client_cpu_ms_per_train']))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(
+        prog="karabo-bridge-bench",
+        description="Measure throughput and latency of Karabo bridge servers "
+                    "and clients on local endpoints, for every combination "
+                    "of the options given.")
+    ap.add_argument('--server', nargs='+', default=['sim'],
+                    choices=['sim', 'thread'],
+                    help="sim: SimServerInThread; thread: ServerInThread fed "
+                         "from another thread (default: sim)")
+    ap.add_argument('--transport', nargs='+', default=['tcp'],
+                    choices=['tcp', 'ipc', 'inproc'],
+                    help='Endpoint types to test (default: tcp)')
+    ap.add_argument('-z', '--server-socket', nargs='+', default=['REP'],
+                    choices=list(CLIENT_SOCKETS),
+                    help='Server socket types (default: REP)')
+    ap.add_argument('-p', '--protocol', nargs='+', default=['2.2'],
+                    choices=['1.0', '2.2'],
+                    help='Bridge protocol versions (default: 2.2)')
+    ap.add_argument('-d', '--detector', nargs='+', default=['AGIPDModule'],
+                    choices=['AGIPD', 'AGIPDModule', 'LPD', 'LPDModule'],
+                    help='Simulated detectors, sending raw data '
+                         '(default: AGIPDModule)')
+    ap.add_argument('-l', '--data-like', nargs='+', default=['online'],
+                    choices=['online', 'file'],
+                    help='Detector array layouts (default: online)')
+    ap.add_argument('-n', '--nsources', nargs='+', type=int, default=[1],
+                    metavar='N', help='Numbers of sources (default: 1)')
+    ap.add_argument('--clients', type=int, default=1, metavar='N',
+                    help='Clients receiving in parallel (default: 1)')
+    ap.add_argument('--ntrains', type=int, default=100, metavar='N',
+                    help='Trains measured by each client (default: 100)')
+    ap.add_argument('--warmup', type=int, default=10, metavar='N',
+                    help='Trains received before measuring (default: 10)')
+    ap.add_argument('-o', '--output', default='karabo-bridge-bench.json',
+                    help='JSON file for the results '
+                         '(default: karabo-bridge-bench.json)')
+    args = ap.parse_args(argv)
+
+    results = []
+    configs = product(args.server, args.transport, args.server_socket,
+                      args.protocol, args.detector, args.data_like,
+                      args.nsources)
+    for server, transport, sock, protocol, detector, layout, nsrc in configs:
+        r = run_config(server=server, transport=transport, pattern=sock,
+                       protocol=protocol, detector=detector,
+                       data_like=layout, nsources=nsrc, clients=args.clients,
+                       ntrains=args.ntrains, warmup=args.warmup)
+        print(_summary(r), file=sys.stderr)
+        results.append(r)
+
+    with open(args.output, 'w') as f:
+        json.dump({'environment': _environment(), 'results': results}, f,
+                  indent=2)
+    print(f'Results written to {args.output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
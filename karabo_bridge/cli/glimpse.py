@@ -3,6 +3,7 @@
 
 import argparse
 from collections.abc import Sequence
+from contextlib import contextmanager
 from datetime import datetime
 import h5py
 import numpy as np
@@ -48,6 +49,74 @@ def hdf5_to_dict(filepath, group='/'):
     return dic
 
 
+@contextmanager
+def lazy_hdf5_to_dict(filepath, group='/'):
+    """Open an hdf5 file as a dict of :class:`DatasetProxy` objects.
+
+    Data is only read when it is accessed, and only the part selected::
+
+        with lazy_hdf5_to_dict(path) as d:
+            image = d['SPB_DET_AGIPD1M-1']['DET']['0CH0:xtdf']['image.data']
+            frame = image[..., 0]
+
+    The file stays open until the end of the with block.
+    """
+    if not h5py.is_hdf5(filepath):
+        raise RuntimeError(filepath, 'is not a valid HDF5 file.')
+
+    with h5py.File(filepath, 'r') as handler:
+        yield walk_hdf5_to_dict(handler[group], lazy=True)
+
+
+class DatasetProxy:
+    """Read data from an HDF5 dataset on access.
+
+    Indexing it reads only the selected part, i.e. the HDF5 chunks
+    overlapping the selection. Use :meth:`iter_chunks` to read a large
+    dataset one chunk at a time.
+    """
+    def __init__(self, dataset):
+        self._dataset = dataset
+        self.name = dataset.name
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+        self.chunks = dataset.chunks
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _check_open(self):
+        if not self._dataset.id.valid:
+            raise ValueError(f'Cannot read {self.name}: the file is closed')
+
+    def __getitem__(self, key):
+        self._check_open()
+        return self._dataset[key]
+
+    def read(self):
+        """Read the whole dataset"""
+        return self[()]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.read(), dtype=dtype)
+
+    def iter_chunks(self, sel=None):
+        """Iterate over (slices, data) for each chunk the selection covers"""
+        self._check_open()
+        if self.chunks is None or not self.shape:
+            yield (), self.read()
+            return
+        for slices in self._dataset.iter_chunks(sel):
+            yield slices, self._dataset[slices]
+
+    def __repr__(self):
+        return f'<DatasetProxy {self.name}: {self.shape} {self.dtype}>'
+
+
 vlen_bytes = h5py.special_dtype(vlen=bytes)
 vlen_str = h5py.special_dtype(vlen=str)
 
@@ -79,13 +148,13 @@ def walk_dict_to_hdf5(dic, h5):
             print('not supported', type(value))
 
 
-def walk_hdf5_to_dict(h5):
+def walk_hdf5_to_dict(h5, lazy=False):
     dic = {}
     for key, value in h5.items():
         if isinstance(value, h5py.Group):
-            dic[key] = walk_hdf5_to_dict(value)
+            dic[key] = walk_hdf5_to_dict(value, lazy=lazy)
         elif isinstance(value, h5py.Dataset):
-            dic[key] = value[()]
+            dic[key] = DatasetProxy(value) if lazy else value[()]
         else:
             print('what are you?', type(value))
     return dic
@@ -108,7 +177,7 @@ def print_one_train(client, verbosity=0):
 
     train_id = list(meta.values())[0].get('timestamp.tid', 0)
     print("Train ID:", train_id, "--------------------------")
-    delta = ts_after - ts_before
+    delta = (ts_after - ts_before) * 1000
     print('Data from {} sources, REQ-REP took {:.2f} ms'
           .format(len(data), delta))
     print()
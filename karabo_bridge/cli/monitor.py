@@ -2,10 +2,117 @@
 """Monitor messages coming from Karabo bridge."""
 
 import argparse
+from collections import deque
 import gc
+import sys
+from time import monotonic, strftime
+
+import numpy as np
 
 from .glimpse import print_one_train
 from ..client import Client
+from ..serializer import train_id
+
+
+class StreamStats:
+    """Statistics of a stream, updated incrementally for each train.
+
+    Timings, message sizes and missed trains come from the client's
+    :class:`~karabo_bridge.metrics.ClientMetrics`; this adds the bandwidth
+    of each source and changes in array shapes and dtypes.
+    """
+    def __init__(self, metrics, max_changes=5):
+        self.metrics = metrics
+        self.layout = {}  # (source, key): (shape, dtype)
+        self.changes = deque(maxlen=max_changes)
+        self.source_bytes = {}  # Since the last report
+        self.n_trains = 0
+        self.t_report = monotonic()
+
+    def update(self, data, meta):
+        tid = train_id(meta)
+        for src, props in data.items():
+            nbytes = 0
+            for key, value in props.items():
+                if not isinstance(value, np.ndarray):
+                    continue
+                nbytes += value.nbytes
+                layout = (value.shape, value.dtype.name)
+                old = self.layout.get((src, key))
+                if old != layout:
+                    if old is not None:
+                        self.changes.append((tid, src, key, old, layout))
+                    self.layout[(src, key)] = layout
+            self.source_bytes[src] = self.source_bytes.get(src, 0) + nbytes
+        self.n_trains += 1
+
+    def report(self, title=''):
+        """Text of one screen; starts a new interval for the rates"""
+        now = monotonic()
+        elapsed = max(now - self.t_report, 1e-9)
+        s = self.metrics.summary()
+        lat = s['staleness_seconds']
+
+        def ms(stats):
+            return ' '.join(f'{p} {stats[p] * 1000:.1f}'
+                            for p in ('p50', 'p90', 'p99'))
+
+        lines = [
+            f'{title}  {strftime("%H:%M:%S")}',
+            '',
+            'Trains: {} received, {} missed, last train ID {}'.format(
+                s['trains_received'], s['trains_missed'],
+                'none' if np.isnan(s['last_train_id'])
+                else int(s['last_train_id'])),
+            'Rate: {:.2f} trains/s, {:.2f} MB/s'.format(
+                self.n_trains / elapsed,
+                sum(self.source_bytes.values()) / elapsed / 1e6),
+            'Message: {:.2f} MB, {:.0f} frames (median)'.format(
+                s['message_bytes']['p50'] / 1e6, s['message_frames']['p50']),
+            f'Latency ms: {ms(lat)}',
+            f'  waiting:     {ms(s["wait_seconds"])}',
+            f'  receiving:   {ms(s["recv_seconds"])}',
+            f'  deserialize: {ms(s["deserialize_seconds"])}',
+            '',
+            f'{"Source":<60} {"MB/s":>10}',
+        ]
+        for src in sorted(self.source_bytes):
+            lines.append('{:<60} {:>10.2f}'.format(
+                src, self.source_bytes[src] / elapsed / 1e6))
+
+        if self.changes:
+            lines += ['', 'Array changes:']
+        for tid, src, key, (shape0, dtype0), (shape1, dtype1) in self.changes:
+            lines.append(f'  train {tid}: {src} {key}: {shape0} {dtype0} -> '
+                         f'{shape1} {dtype1}')
+
+        self.source_bytes = dict.fromkeys(self.source_bytes, 0)
+        self.n_trains = 0
+        self.t_report = now
+        return '\n'.join(lines)
+
+
+def monitor_stats(client, interval=1., ntrains=None, title=''):
+    """Print stream statistics every *interval* seconds.
+
+    Nothing is printed per train, so this keeps up with fast streams.
+    """
+    stats = StreamStats(client.enable_metrics())
+    clear = '\x1b[2J\x1b[H' if sys.stdout.isatty() else '\n'
+    n = 0
+    next_report = monotonic() + interval
+    while ntrains is None or n < ntrains:
+        try:
+            data, meta = client.next()
+        except TimeoutError:
+            pass  # Refresh the screen even if no data arrives
+        else:
+            stats.update(data, meta)
+            n += 1
+        if monotonic() >= next_report:
+            print(clear + stats.report(title), flush=True)
+            next_report = monotonic() + interval
+    print(clear + stats.report(title), flush=True)
 
 
 def main(argv=None):
@@ -20,12 +127,24 @@ def main(argv=None):
                     help='Select verbosity (-vvv for most verbose)')
     ap.add_argument('--ntrains', help="Stop after N trains", metavar='N',
                     type=int)
+    ap.add_argument('--stats', action='store_true',
+                    help='Show a summary of the stream, refreshed every '
+                         'interval, instead of printing each train')
+    ap.add_argument('--interval', type=float, default=1., metavar='SECONDS',
+                    help='Refresh interval for --stats (default 1 second)')
     args = ap.parse_args(argv)
 
     socket_map = {'REP': 'REQ', 'PUB': 'SUB', 'PUSH': 'PULL'}
-    client = Client(args.endpoint, sock=socket_map[args.server_socket])
+    if args.stats:
+        client = Client(args.endpoint, sock=socket_map[args.server_socket],
+                        timeout=args.interval)
+    else:
+        client = Client(args.endpoint, sock=socket_map[args.server_socket])
     try:
-        if args.ntrains is None:
+        if args.stats:
+            monitor_stats(client, args.interval, args.ntrains,
+                          title=f'{args.endpoint} ({args.server_socket})')
+        elif args.ntrains is None:
             while True:
                 print_one_train(client, verbosity=args.verbose)
                 # Explicitly trigger garbage collection,
@@ -0,0 +1,91 @@
+import argparse
+import sys
+
+from karabo_bridge.multisim import MODULE_DETECTORS, SimSupervisor
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(
+        prog="karabo-bridge-multi-sim",
+        description="Simulate a detector as one Karabo bridge server per "
+                    "module (or group of modules), each in its own process "
+                    "and on its own port."
+    )
+    ap.add_argument(
+        'port', type=int,
+        help="TCP port for the first process; the others use the following "
+             "ports"
+    )
+    ap.add_argument(
+        '-d', '--detector', default='AGIPD', choices=sorted(MODULE_DETECTORS),
+        help="Which kind of detector to simulate (default: AGIPD)"
+    )
+    ap.add_argument(
+        '-z', '--server-socket', default='REP', choices=['REP', 'PUB', 'PUSH'],
+        help='Socket type used by the karabo bridge servers (default REP)'
+    )
+    ap.add_argument(
+        '-p', '--protocol', default='2.2', choices=['1.0', '2.2'],
+        help="Version of the Karabo Bridge protocol to send (default: 2.2)"
+    )
+    ap.add_argument(
+        '-m', '--modules', type=int, nargs='+', metavar='N',
+        help='Module numbers to simulate (default: all 16)'
+    )
+    ap.add_argument(
+        '--modules-per-process', type=int, default=1, metavar='N',
+        help='Send N modules from each process (default 1)'
+    )
+    ap.add_argument(
+        '--rate', default='10',
+        help="Train rate in Hz for each process (default 10), or 'max'"
+    )
+    ap.add_argument(
+        '--skew', type=float, default=0, metavar='SECONDS',
+        help='Delay each process by this much more than the previous one'
+    )
+    ap.add_argument(
+        '-g', '--gen', default='random',
+        choices=['random', 'zeros', 'photons'],
+        help='Generator function to generate simulated detector data'
+    )
+    ap.add_argument(
+        '--pool', type=int, default=0, metavar='N',
+        help='Pre-generate N detector images in each process'
+    )
+    ap.add_argument(
+        '--native-dtype', action='store_true',
+        help='Generate random data directly in the detector data type'
+    )
+    ap.add_argument(
+        '--duration', type=float, metavar='SECONDS',
+        help='Stop after this long (default: run until interrupted)'
+    )
+    args = ap.parse_args(argv)
+
+    modules = args.modules if args.modules is not None else list(range(16))
+    nproc = -(-len(modules) // args.modules_per_process)
+    endpoints = [f'tcp://*:{args.port + i}' for i in range(nproc)]
+    rate = None if args.rate == 'max' else float(args.rate)
+
+    supervisor = SimSupervisor(
+        endpoints, args.detector, modules=modules,
+        modules_per_process=args.modules_per_process, rate=rate,
+        skew=args.skew, sock=args.server_socket,
+        protocol_version=args.protocol, datagen=args.gen, pool=args.pool,
+        native=args.native_dtype,
+    )
+    print('Starting {} processes on ports {} - {}'.format(
+        nproc, args.port, args.port + nproc - 1))
+    try:
+        with supervisor:
+            supervisor.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as e:
+        sys.exit(f'\nError: {e}')
+    print('\nStopped.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""Record a stream of Karabo bridge data to HDF5 files.
+"""
+
+import argparse
+from queue import Full, Queue
+from threading import Thread
+from time import monotonic
+
+import h5py
+import numpy as np
+
+from .glimpse import gen_filename, vlen_str
+from .. import Client
+from ..framelog import FrameLogWriter, index_path, message_info
+from ..serializer import train_id
+
+
+def _as_array(value):
+    """Convert a value to an array for storing, or None if not supported"""
+    if isinstance(value, np.ndarray):
+        return value
+    if isinstance(value, str):
+        return np.array(value.replace('\x00', ''), dtype=object)
+    if isinstance(value, (bool, int, float, np.generic)):
+        return np.asarray(value)
+    if isinstance(value, (list, tuple)):
+        arr = np.asarray(value)
+        if arr.dtype.kind in 'biuf':
+            return arr
+    return None
+
+
+class _Column:
+    """One dataset with a train axis, grown in preallocated steps"""
+    def __init__(self, group, key, sample, chunk_bytes, compression):
+        self.shape = sample.shape
+        self.dtype = vlen_str if sample.dtype == object else sample.dtype
+        itemsize = 8 if sample.dtype == object else sample.dtype.itemsize
+        row_bytes = max(int(np.prod(self.shape)) * itemsize, 1)
+        rows = max(chunk_bytes // row_bytes, 1)
+        self.ds = group.create_dataset(
+            key, shape=(rows,) + self.shape, maxshape=(None,) + self.shape,
+            chunks=(rows,) + self.shape, dtype=self.dtype,
+            compression=compression,
+        )
+        self.step = rows
+        self.n = 0
+
+    def append(self, value):
+        if self.n == len(self.ds):
+            self.ds.resize(self.n + self.step, axis=0)
+        self.ds[self.n] = value
+        self.n += 1
+
+    def trim(self):
+        self.ds.resize(self.n, axis=0)
+
+
+class HDF5Writer:
+    """Write trains to HDF5 files, one dataset per (source, key).
+
+    Each dataset has a leading train axis and a chunked layout sized to the
+    data. The files contain:
+
+    - ``INDEX/trainId`` and ``INDEX/timestamp``: one entry per train
+    - ``INDEX/<source>/trainId``: the trains in which each source appeared
+    - ``INDEX/<source>/keys/<key>``: the trains in which each key was
+      recorded, one entry per row of its dataset
+    - ``<source>/<key>``: the data, one row per train with this key. Keys
+      missing from some trains, or skipped after their shape changed, have
+      fewer rows than their source has trains.
+
+    Parameters
+    ----------
+    prefix : str
+        File name prefix; files are named ``<prefix>_<seq>.h5``.
+    max_file_size : int, optional
+        Start a new file once this many bytes of data have been written.
+    compression : str, optional
+        HDF5 compression filter for the datasets, e.g. 'gzip' or 'lzf'.
+    chunk_bytes : int, optional
+        Target size of the HDF5 chunks (default 1 MB). Arrays bigger than
+        this are chunked one train at a time.
+    """
+    def __init__(self, prefix, max_file_size=None, compression=None,
+                 chunk_bytes=1024 * 1024):
+        self.prefix = prefix
+        self.max_file_size = max_file_size
+        self.compression = compression
+        self.chunk_bytes = chunk_bytes
+        self.filenames = []
+        self.skipped = {}  # (source, key): reason, reported once
+        self.file = None
+        self._seq = 0
+
+    def _open(self):
+        filename = f'{self.prefix}_{self._seq:04d}.h5'
+        self._seq += 1
+        self.file = h5py.File(filename, 'w')
+        self.filenames.append(filename)
+        self._bytes = 0
+        self._columns = {}
+        self._index = {}
+        self._key_index = {}
+        self._tids = self._index_column('INDEX', 'trainId', np.uint64(0))
+        self._timestamps = self._index_column('INDEX', 'timestamp',
+                                              np.float64(0))
+
+    def _index_column(self, group, key, sample):
+        return _Column(self.file.require_group(group), key,
+                       np.asarray(sample), self.chunk_bytes, None)
+
+    def close(self):
+        if self.file is None:
+            return
+        for col in self._columns.values():
+            col.trim()
+        for col in self._index.values():
+            col.trim()
+        for col in self._key_index.values():
+            col.trim()
+        self._tids.trim()
+        self._timestamps.trim()
+        self.file.close()
+        self.file = None
+
+    def _skip(self, source, key, reason):
+        if (source, key) not in self.skipped:
+            self.skipped[(source, key)] = reason
+            print(f'Not recording {source}/{key}: {reason}')
+
+    def write(self, data, meta):
+        """Append one train"""
+        if self.file is None:
+            self._open()
+
+        first_meta = next(iter(meta.values()), {})
+        tid = train_id(meta) or 0
+        self._tids.append(tid)
+        self._timestamps.append(first_meta.get('timestamp', np.nan))
+
+        for source, src_data in data.items():
+            if source not in self._index:
+                self._index[source] = self._index_column(
+                    f'INDEX/{source}', 'trainId', np.uint64(0))
+            src_tid = meta.get(source, {}).get('timestamp.tid', tid)
+            self._index[source].append(src_tid)
+
+            for key, value in src_data.items():
+                if key == 'metadata':
+                    continue
+                arr = _as_array(value)
+                if arr is None:
+                    self._skip(source, key, f'{type(value).__name__} values '
+                                            f'are not supported')
+                    continue
+                col = self._columns.get((source, key))
+                if col is None:
+                    col = self._columns[(source, key)] = _Column(
+                        self.file.require_group(source), key, arr,
+                        self.chunk_bytes, self.compression)
+                    self._key_index[(source, key)] = self._index_column(
+                        f'INDEX/{source}/keys', key, np.uint64(0))
+                if arr.shape != col.shape:
+                    self._skip(source, key, f'shape changed from {col.shape} '
+                                            f'to {arr.shape}')
+                    continue
+                col.append(arr)
+                self._key_index[(source, key)].append(src_tid)
+                self._bytes += arr.nbytes
+
+        if self.max_file_size and self._bytes >= self.max_file_size:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Recorder:
+    """Receive trains and write them in a separate thread.
+
+    The trains are passed to the writer thread through a bounded queue. If
+    the disk can't keep up and the queue is full, new trains are dropped
+    and counted, rather than slowing down receiving.
+
+    With *raw*, messages are passed to the writer without deserializing
+    them, e.g. for a :class:`~karabo_bridge.framelog.FrameLogWriter`.
+
+    If writing fails, e.g. because the disk is full, receiving stops and
+    :meth:`run` raises the writer's exception.
+    """
+    def __init__(self, client, writer, queue_size=10, raw=False):
+        self.client = client
+        self.writer = writer
+        self.raw = raw
+        self.queue = Queue(maxsize=queue_size)
+        self.received = 0
+        self.written = 0
+        self.dropped = 0
+        self.first_tid = self.last_tid = None
+        self.error = None  # Exception raised by the writer
+        self._thread = Thread(target=self._write_loop, daemon=True)
+
+    def _write_loop(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                self.writer.write(*item)
+                self.written += 1
+        except Exception as e:
+            self.error = e
+        finally:
+            self.writer.close()
+
+    def report(self):
+        print(f'Received {self.received} trains ({self.first_tid} - '
+              f'{self.last_tid}), written {self.written}, dropped '
+              f'{self.dropped}, queued {self.queue.qsize()}')
+
+    def run(self, ntrains=None, report_interval=10):
+        self._thread.start()
+        next_report = monotonic() + report_interval
+        try:
+            while ntrains is None or self.received < ntrains:
+                if self.error is not None:
+                    break
+                if self.raw:
+                    item = (self.client.next_raw(),)
+                    tid = message_info(item[0])[0]
+                else:
+                    item = data, meta = self.client.next()
+                    tid = train_id(meta)
+                self.received += 1
+                if self.first_tid is None:
+                    self.first_tid = tid
+                self.last_tid = tid
+                try:
+                    self.queue.put_nowait(item)
+                except Full:
+                    self.dropped += 1
+
+                if monotonic() > next_report:
+                    self.report()
+                    next_report += report_interval
+        finally:
+            if self._thread.is_alive():
+                self.queue.put(None)
+            self._thread.join()
+        self.report()
+        if self.error is not None:
+            raise self.error
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(
+        prog="karabo-bridge-record",
+        description="Record data from a Karabo bridge server to HDF5 files "
+                    "or a raw frame log")
+    ap.add_argument('endpoint',
+                    help="ZMQ address to connect to, e.g. 'tcp://localhost:4545'")
+    ap.add_argument('-z', '--server-socket', default='REP', choices=['REP', 'PUB', 'PUSH'],
+                    help='Socket type used by the karabo bridge server (default REP)')
+    ap.add_argument('-o', '--output',
+                    help='Output file name prefix (default: from the '
+                         'endpoint and the current time)')
+    ap.add_argument('--format', choices=['hdf5', 'framelog'], default='hdf5',
+                    help='hdf5 (default): one dataset per source and key; '
+                         'framelog: the raw messages with a train index')
+    ap.add_argument('--ntrains', help="Stop after N trains", metavar='N',
+                    type=int)
+    ap.add_argument('--max-file-size', type=float, metavar='MB',
+                    help='Start a new file after writing this much data')
+    ap.add_argument('--compression', choices=['gzip', 'lzf'],
+                    help='Compress the HDF5 datasets')
+    ap.add_argument('--queue-size', type=int, default=10,
+                    help='Number of trains buffered for writing before '
+                         'dropping new trains (default 10)')
+    args = ap.parse_args(argv)
+    if args.format == 'framelog' and (args.max_file_size or args.compression):
+        ap.error('--max-file-size and --compression are only for HDF5 files')
+
+    prefix = args.output or gen_filename(args.endpoint)[:-len('.h5')]
+    max_size = None
+    if args.max_file_size:
+        max_size = int(args.max_file_size * 1024 * 1024)
+
+    socket_map = {'REP': 'REQ', 'PUB': 'SUB', 'PUSH': 'PULL'}
+    client = Client(args.endpoint, sock=socket_map[args.server_socket])
+    if args.format == 'framelog':
+        writer = FrameLogWriter(prefix + '.frames')
+        filenames = [writer.path, index_path(writer.path)]
+    else:
+        writer = HDF5Writer(prefix, max_file_size=max_size,
+                            compression=args.compression)
+        filenames = writer.filenames
+    recorder = Recorder(client, writer, queue_size=args.queue_size,
+                        raw=(args.format == 'framelog'))
+    try:
+        recorder.run(ntrains=args.ntrains)
+    except KeyboardInterrupt:
+        print('\nexit.')
+    print('Files written:', *filenames, sep='\n  ')
@@ -1,12 +1,28 @@
 import argparse
 
+from karabo_bridge.replay import ReplayServer
 from karabo_bridge.server import start_gen
 
 
+def start_replay(port, paths, sock='REP', version='2.2', rate='original',
+                 loop=False, metrics_port=None):
+    sender = ReplayServer(f'tcp://*:{port}', paths, rate=rate, loop=loop,
+                          sock=sock, protocol_version=version)
+    if metrics_port is not None:
+        sender.enable_metrics(port=metrics_port)
+        print(f'Metrics served at {sender.metrics_endpoint}')
+    try:
+        sender.loop()
+    except KeyboardInterrupt:
+        pass
+    print('\nStopped.')
+
+
 def main(argv=None):
     ap = argparse.ArgumentParser(
         prog="karabo-bridge-server-sim",
-        description="Run a Karabo bridge server producing simulated data."
+        description="Run a Karabo bridge server producing simulated data, "
+                    "or replaying recorded data."
     )
     ap.add_argument(
         'port', help="TCP port the server will bind"
@@ -39,7 +55,8 @@ def main(argv=None):
         help='Number of simulated detector sources to send (default 1)'
     )
     ap.add_argument(
-        '-g', '--gen', default='random', choices=['random', 'zeros'],
+        '-g', '--gen', default='random',
+        choices=['random', 'zeros', 'photons'],
         help='Generator function to generate simulated detector data'
     )
     ap.add_argument(
@@ -47,14 +64,73 @@ def main(argv=None):
         help='Data array axes ordering: online -> (modules, fs, ss, pulses), '
              'file -> (pulses, modules, ss, fs)'
     )
+    ap.add_argument(
+        '--pool', type=int, default=0, metavar='N',
+        help='Pre-generate N detector images and send them in turn, instead '
+             'of generating new data for each train'
+    )
+    ap.add_argument(
+        '--native-dtype', action='store_true',
+        help='Generate random data directly in the detector data type'
+    )
+    ap.add_argument(
+        '--replay', nargs='+', metavar='PATH',
+        help='Replay trains from HDF5 files (from karabo-bridge-record or '
+             'karabo-bridge-glimpse) or frame logs, instead of simulating '
+             'detector data'
+    )
+    ap.add_argument(
+        '--rate',
+        help="Train rate in Hz, or 'max' for as fast as possible (the "
+             "default for simulated data). With --replay, 'original' (the "
+             "default) sends trains at the recorded rate"
+    )
+    ap.add_argument(
+        '--jitter', type=float, default=0, metavar='SECONDS',
+        help='Standard deviation of random offsets to the send times'
+    )
+    ap.add_argument(
+        '--drop', type=float, default=0, metavar='FRACTION',
+        help='Probability of skipping each train ID (default 0)'
+    )
+    ap.add_argument(
+        '--burst', type=int, nargs=2, default=(0, 0),
+        metavar=('EVERY', 'SIZE'),
+        help='Every EVERY trains, hold back SIZE trains and then send them '
+             'back to back'
+    )
+    ap.add_argument(
+        '--seed', type=int,
+        help='Random seed for the jitter and dropped trains'
+    )
+    ap.add_argument(
+        '--loop', action='store_true',
+        help='With --replay: start again after the last train'
+    )
+    ap.add_argument(
+        '--metrics-port', type=int, metavar='PORT',
+        help='Serve metrics in the Prometheus text format at '
+             'http://localhost:PORT/metrics'
+    )
     ap.add_argument(
         '--debug', action='store_true',
         help='More verbose terminal logging'
     )
     args = ap.parse_args(argv)
+    if args.replay:
+        start_replay(args.port, args.replay, args.server_socket, args.protocol,
+                     args.rate or 'original', args.loop, args.metrics_port)
+        return
+
+    rate = None
+    if args.rate not in (None, 'max'):
+        rate = float(args.rate)
     start_gen(args.port, args.server_socket, args.serialisation, args.protocol,
               args.detector, args.raw, args.nsources, args.gen, args.data_like,
-              debug=args.debug)
+              args.pool, args.native_dtype, rate=rate, jitter=args.jitter,
+              drop=args.drop, burst_every=args.burst[0],
+              burst_size=args.burst[1], seed=args.seed,
+              metrics_port=args.metrics_port, debug=args.debug)
 
 
 if __name__ == '__main__':
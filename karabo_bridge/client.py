@@ -9,9 +9,16 @@ You should have received a copy of the 3-Clause BSD License along with this
 program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
 """
 
+from collections import OrderedDict, deque
+from time import monotonic, perf_counter
+
 import zmq
 
-from .serializer import deserialize
+from . import trace
+from .metrics import ClientMetrics
+from .serializer import (
+    DeltaDecoder, DeltaSyncError, deserialize, is_bundle, train_id, unbundle
+)
 
 
 __all__ = ['Client']
@@ -39,7 +46,8 @@ class Client:
         Serialization protocol to use to decode the incoming message (default
         is msgpack) - supported: msgpack.
     context : zmq.Context
-        To run the Client's sockets using a provided ZeroMQ context.
+        To run the Client's sockets using a provided ZeroMQ context. Leaving
+        a ``with`` block then closes the sockets, but not the context.
     timeout : int
         Timeout on :meth:`next` (in seconds)
 
@@ -50,6 +58,28 @@ class Client:
            - 32 pulses per train (125 MB): ~0.1 s
            - 128 pulses per train (500 MB): ~0.4 s
            - 350 pulses per train (1.37 GB): ~1 s
+    delta : ('full' | 'changes')
+        For servers sending delta encoded slow data, whether to return the
+        full rebuilt data for each source (default) or only the values which
+        changed. If part of the stream was missed, trains are skipped until
+        the next keyframe; REQ clients ask the server for one straight away.
+    unbundle : bool
+        For servers bundling several trains in one message, return the
+        trains one by one (default). If False, :meth:`next` returns whole
+        bundles, where the metadata for each source is a list with one dict
+        per train, other values are lists, and arrays have an extra first
+        axis for trains.
+    on_chunk : callable, optional
+        Called for each piece of an array which the server split into
+        several frames, as ``on_chunk(source, path, offset, chunk)``. The
+        whole message has arrived before this is called. See
+        :func:`~karabo_bridge.serializer.deserialize`.
+    fast_endpoint : str, optional
+        Address of a server's separate channel for small sources (see
+        ``fast_endpoint`` in :class:`~karabo_bridge.ServerInThread`). Use
+        :meth:`next_fast` to get these sources as soon as they arrive, or
+        ``next(join=True)`` to merge them with the bulk data of the same
+        train.
 
     Raises
     ------
@@ -59,11 +89,15 @@ class Client:
         if provided endpoint is not valid.
     """
     def __init__(self, endpoint, sock='REQ', ser='msgpack', timeout=None,
-                 context=None):
+                 context=None, delta='full', unbundle=True, on_chunk=None,
+                 fast_endpoint=None):
 
         if ser != 'msgpack':
             raise Exception('Only serialization supported is msgpack')
+        if delta not in {'full', 'changes'}:
+            raise ValueError(f"delta must be 'full' or 'changes', not {delta!r}")
 
+        self._own_context = context is None
         self._context = context or zmq.Context()
         self._socket = None
 
@@ -83,14 +117,76 @@ class Client:
         if timeout is not None:
             self._socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
         self._recv_ready = False
+        self._need_keyframe = False
+        self._delta = DeltaDecoder(changes_only=(delta == 'changes'))
+        self._unbundle = unbundle
+        self._on_chunk = on_chunk
+        self._pending = deque()  # Trains from a bundle not yet returned
 
         self._pattern = self._socket.TYPE
+        self._stages = []
+
+        self._fast_socket = None
+        self._fast_trains = OrderedDict()  # train ID: (data, meta)
+        if fast_endpoint is not None:
+            self._fast_socket = self._context.socket(zmq.SUB)
+            self._fast_socket.setsockopt(zmq.SUBSCRIBE, b'')
+            self._fast_socket.setsockopt(zmq.LINGER, 0)
+            self._fast_socket.connect(fast_endpoint)
+            if timeout is not None:
+                self._fast_socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+
+        self.metrics = None
+        self._attach_metrics = False
+        self._recv_times = None  # Start, arrival and end of the last recv
+
+    def add_stage(self, stage):
+        """Add a processing stage applied to every received train.
+
+        Stages are called in the order they were added, after the message is
+        deserialized, as ``data, meta = stage(data, meta)``.
+
+        Parameters
+        ----------
+        stage : callable
+            Takes the train ``data`` and ``meta`` dicts and returns them
+            (modified in place or as new dicts).
+        """
+        self._stages.append(stage)
+
+    def enable_metrics(self, window=1000, attach=False):
+        """Start measuring each message received.
+
+        Parameters
+        ----------
+        window : int
+            Number of recent messages used for percentiles.
+        attach : bool
+            Add the measurements for each train to its metadata, as a dict
+            under the ``'karabo_bridge.metrics'`` key for every source.
+
+        Returns
+        -------
+        metrics : ClientMetrics
+            Also available as the ``metrics`` attribute. Use
+            :func:`~karabo_bridge.metrics.serve_metrics` to expose them for
+            Prometheus.
+        """
+        self.metrics = ClientMetrics(window)
+        self._attach_metrics = attach
+        return self.metrics
 
-    def next(self):
+    def next(self, join=False):
         """Request next data container.
 
         This function call is blocking.
 
+        Parameters
+        ----------
+        join : bool
+            With a *fast_endpoint*, add the small sources for the same train,
+            received on the fast channel, to the returned data.
+
         Returns
         -------
         data : dict
@@ -107,24 +203,149 @@ class Client:
         TimeoutError
             If timeout is reached before receiving data.
         """
+        metrics, tracer = self.metrics, trace.tracer
+        timed = metrics is not None or tracer is not None
+        while not self._pending:
+            msg = self._recv(timed)
+            try:
+                data, meta = deserialize(msg, delta=self._delta,
+                                         on_chunk=self._on_chunk)
+            except DeltaSyncError:
+                # Part of a delta encoded stream was missed
+                self._need_keyframe = True
+                continue
+            self._need_keyframe = False
+            sample = None
+            if timed:
+                t0, t1, t2 = self._recv_times
+                t3 = perf_counter()
+            if metrics is not None:
+                sample = metrics.record(t1 - t0, t2 - t1, t3 - t2, msg, meta)
+            if tracer is not None:
+                tid = train_id(meta)
+                tracer.add('Client.wait', t0, t1, tid)
+                tracer.add('Client.recv', t1, t2, tid)
+                tracer.add('Client.deserialize', t2, t3, tid)
+            if self._unbundle and is_bundle(meta):
+                self._pending.extend(
+                    (d, m, sample) for d, m in unbundle(data, meta))
+            else:
+                self._pending.append((data, meta, sample))
+
+        data, meta, sample = self._pending.popleft()
+        if sample is not None and self._attach_metrics:
+            for src_meta in meta.values():
+                if isinstance(src_meta, dict):
+                    src_meta['karabo_bridge.metrics'] = sample
+        if join and self._fast_socket is not None:
+            data, meta = self._join_fast(data, meta)
+
+        if tracer is None:
+            for stage in self._stages:
+                data, meta = stage(data, meta)
+            return data, meta
+
+        tid = train_id(meta)
+        for stage in self._stages:
+            t0 = perf_counter()
+            data, meta = stage(data, meta)
+            tracer.add('Client.stage', t0, perf_counter(), tid,
+                       stage=getattr(stage, '__name__', type(stage).__name__))
+        return data, meta
+
+    def next_raw(self):
+        """Receive the next message without deserializing it.
+
+        This function call is blocking. Processing stages are not applied,
+        and delta encoded or bundled messages are returned as they are.
+
+        Returns
+        -------
+        msg : list of zmq.Frame
+            The frames of the message, as sent by the server.
+        """
+        return self._recv(False)
+
+    # Trains received on the fast channel are kept to be joined with the bulk
+    # data, which should arrive shortly after.
+    _max_fast_trains = 32
+    fast_join_timeout = 0.05  # seconds
+
+    def _store_fast(self, msg):
+        data, meta = deserialize(msg)
+        tid = train_id(meta)
+        self._fast_trains[tid] = (data, meta)
+        while len(self._fast_trains) > self._max_fast_trains:
+            self._fast_trains.popitem(last=False)
+        return data, meta
+
+    def next_fast(self):
+        """Get the small sources of the next train from the fast channel.
+
+        This function call is blocking.
+
+        Returns
+        -------
+        data, meta : dict
+            As for :meth:`next`, with only the small sources.
+        """
+        if self._fast_socket is None:
+            raise RuntimeError('Client was created without a fast_endpoint')
+        try:
+            msg = self._fast_socket.recv_multipart(copy=False)
+        except zmq.error.Again:
+            raise TimeoutError(
+                'No data received from {} in the last {} ms'.format(
+                    self._fast_socket.getsockopt_string(zmq.LAST_ENDPOINT),
+                    self._fast_socket.getsockopt(zmq.RCVTIMEO)))
+        return self._store_fast(msg)
+
+    def _join_fast(self, data, meta):
+        tid = train_id(meta)
+        deadline = monotonic() + self.fast_join_timeout
+        while tid not in self._fast_trains:
+            timeout = max(deadline - monotonic(), 0)
+            if not self._fast_socket.poll(int(timeout * 1000)):
+                return data, meta  # Not sent, or missed
+            self._store_fast(self._fast_socket.recv_multipart(copy=False))
+
+        fast_data, fast_meta = self._fast_trains.pop(tid)
+        return {**fast_data, **data}, {**fast_meta, **meta}
+
+    def _recv(self, timed):
         if self._pattern == zmq.REQ and not self._recv_ready:
-            self._socket.send(b'next')
+            self._socket.send(b'resync' if self._need_keyframe else b'next')
             self._recv_ready = True
         try:
-            msg = self._socket.recv_multipart(copy=False)
+            if not timed:
+                msg = self._socket.recv_multipart(copy=False)
+            else:
+                # Poll first to separate waiting from receiving
+                t0 = perf_counter()
+                timeout = self._socket.getsockopt(zmq.RCVTIMEO)
+                self._socket.poll(None if timeout < 0 else timeout)
+                t1 = perf_counter()
+                msg = self._socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                self._recv_times = (t0, t1, perf_counter())
         except zmq.error.Again:
             raise TimeoutError(
                 'No data received from {} in the last {} ms'.format(
                     self._socket.getsockopt_string(zmq.LAST_ENDPOINT),
                     self._socket.getsockopt(zmq.RCVTIMEO)))
         self._recv_ready = False
-        return deserialize(msg)
+        return msg
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self._context.destroy(linger=0)
+        if self._own_context:
+            self._context.destroy(linger=0)
+            return
+        # Leave a context provided by the caller usable for other sockets
+        self._socket.close(linger=0)
+        if self._fast_socket is not None:
+            self._fast_socket.close(linger=0)
 
     def __iter__(self):
         return self
@@ -0,0 +1,151 @@
+"""Array compression for the Karabo bridge protocol.
+
+Arrays are split into chunks, which are shuffled and compressed separately
+on a thread pool. zlib and lzma release the GIL while they work, so large
+arrays are compressed on several cores.
+"""
+
+import lzma
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+__all__ = ['compress_array', 'decompress_array']
+
+
+CODECS = {
+    'zlib': (lambda b, level: zlib.compress(b, level), zlib.decompress),
+    'lzma': (lambda b, level: lzma.compress(b, preset=level), lzma.decompress),
+}
+DEFAULT_LEVELS = {'zlib': 1, 'lzma': 0}
+SHUFFLES = {None, 'byte', 'bit'}
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024  # bytes
+
+_pool = None
+_local = threading.local()
+
+
+def _mark_worker():
+    _local.in_pool = True
+
+
+def thread_pool():
+    """Thread pool shared by the serializer functions"""
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(os.cpu_count() or 1,
+                                   thread_name_prefix='karabo-bridge',
+                                   initializer=_mark_worker)
+    return _pool
+
+
+def _use_pool(ntasks):
+    # Tasks running in the pool must not wait for other tasks in it, as that
+    # can deadlock when all the workers are busy.
+    return ntasks > 1 and not getattr(_local, 'in_pool', False)
+
+
+def compression_options(spec):
+    """Normalise a compression spec: a codec name or a dict of options"""
+    if isinstance(spec, str):
+        spec = {'codec': spec}
+    opts = {'shuffle': 'byte', 'chunk_size': DEFAULT_CHUNK_SIZE}
+    opts.update(spec)
+    if opts['codec'] not in CODECS:
+        raise ValueError(f"Unknown compression codec {opts['codec']!r}")
+    if opts['shuffle'] not in SHUFFLES:
+        raise ValueError(f"Unknown shuffle {opts['shuffle']!r}")
+    opts.setdefault('level', DEFAULT_LEVELS[opts['codec']])
+    return opts
+
+
+def _shuffle(chunk, shuffle):
+    """Group the bytes (or bits) of the same significance together"""
+    itemsize = chunk.dtype.itemsize
+    as_bytes = chunk.view(np.uint8).reshape(len(chunk), itemsize)
+    if shuffle == 'byte' and itemsize > 1:
+        return np.ascontiguousarray(as_bytes.T)
+    elif shuffle == 'bit':
+        bits = np.unpackbits(as_bytes, axis=1, bitorder='little')
+        packed = np.packbits(bits.T, axis=1, bitorder='little')
+        return np.ascontiguousarray(packed)
+    return as_bytes
+
+
+def _unshuffle(buf, out, shuffle):
+    """Undo _shuffle(), writing the values into the 1D array *out*"""
+    itemsize = out.dtype.itemsize
+    out_bytes = out.view(np.uint8).reshape(len(out), itemsize)
+    buf = np.frombuffer(buf, dtype=np.uint8)
+    if shuffle == 'byte' and itemsize > 1:
+        out_bytes[:] = buf.reshape(itemsize, len(out)).T
+    elif shuffle == 'bit':
+        bits = np.unpackbits(buf.reshape(itemsize * 8, -1), axis=1,
+                             count=len(out), bitorder='little')
+        out_bytes[:] = np.packbits(bits.T, axis=1, bitorder='little')
+    else:
+        out_bytes.reshape(-1)[:] = buf
+
+
+def _chunk_starts(size, chunk_items):
+    # At least one chunk, even for empty arrays
+    return range(0, max(size, 1), chunk_items)
+
+
+def compress_array(array, options):
+    """Compress an array in chunks.
+
+    Returns
+    -------
+    info : dict
+        Compression parameters to put in the frame header.
+    chunks : list of bytes
+        The compressed chunks.
+    """
+    flat = np.ascontiguousarray(array).reshape(-1)
+    # A multiple of 8 items, so bit shuffled chunks are whole bytes
+    chunk_items = max(options['chunk_size'] // flat.dtype.itemsize // 8, 1) * 8
+    compress = CODECS[options['codec']][0]
+    level, shuffle = options['level'], options['shuffle']
+
+    def compress_chunk(start):
+        chunk = _shuffle(flat[start:start + chunk_items], shuffle)
+        return compress(chunk, level)
+
+    starts = _chunk_starts(flat.size, chunk_items)
+    if _use_pool(len(starts)):
+        chunks = list(thread_pool().map(compress_chunk, starts))
+    else:
+        chunks = [compress_chunk(start) for start in starts]
+
+    info = {
+        'codec': options['codec'], 'shuffle': shuffle,
+        'chunk_items': chunk_items, 'nchunks': len(chunks),
+    }
+    return info, chunks
+
+
+def decompress_array(info, chunks, dtype, shape):
+    """Rebuild an array from compressed chunks"""
+    out = np.empty(shape, dtype=dtype)
+    flat = out.reshape(-1)
+    chunk_items, shuffle = info['chunk_items'], info['shuffle']
+    decompress = CODECS[info['codec']][1]
+
+    def decompress_chunk(start, chunk):
+        _unshuffle(decompress(chunk), flat[start:start + chunk_items], shuffle)
+
+    starts = _chunk_starts(flat.size, chunk_items)
+    if len(starts) != len(chunks):
+        raise RuntimeError(f'Expected {len(starts)} compressed chunks, '
+                           f'got {len(chunks)}')
+    if _use_pool(len(chunks)):
+        list(thread_pool().map(decompress_chunk, starts, chunks))
+    else:
+        for start, chunk in zip(starts, chunks):
+            decompress_chunk(start, chunk)
+    return out
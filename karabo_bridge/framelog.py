@@ -0,0 +1,238 @@
+# coding: utf-8
+"""
+Record raw Karabo bridge messages to an append-only log, and read them back.
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+import mmap
+import os
+
+import msgpack
+import numpy as np
+
+
+__all__ = ['FrameLogWriter', 'FrameLogReader', 'message_info']
+
+
+# One record per message in the index file. The frame lengths are stored in
+# the log, as nframes uint64 values just before the frames themselves.
+INDEX_DTYPE = np.dtype([
+    ('train_id', np.uint64),
+    ('timestamp', np.float64),
+    ('offset', np.uint64),  # Start of the frame lengths in the log
+    ('nframes', np.uint32),
+    ('size', np.uint64),  # Bytes in the log, including the frame lengths
+])
+
+
+def _buffer(frame):
+    return getattr(frame, 'buffer', frame)
+
+
+def _first_meta(meta):
+    # Bundles have a list of metadata dicts, one per train
+    if isinstance(meta, list):
+        return meta[0] if meta else {}
+    return meta
+
+
+def message_info(msg):
+    """Get the train ID and timestamp of a serialized message.
+
+    For protocol 2.x, only the first header frame is unpacked. Missing values
+    are returned as 0 and NaN.
+    """
+    if len(msg) < 2:  # protocol version 1.0: the metadata is in the data
+        data = msgpack.loads(_buffer(msg[0]), raw=False,
+                             max_bin_len=0x7fffffff)
+        meta = next(iter(data.values()), {}).get('metadata', {})
+    else:
+        header = msgpack.loads(_buffer(msg[0]), raw=False)
+        meta = _first_meta(header.get('metadata', {}))
+    return meta.get('timestamp.tid', 0), meta.get('timestamp', np.nan)
+
+
+def index_path(path):
+    return path + '.index'
+
+
+class FrameLogWriter:
+    """Append raw messages to a frame log.
+
+    The frames are written exactly as received, so recording costs little
+    more than a sequential write. The index is written to ``<path>.index``::
+
+        client = Client('tcp://localhost:4545')
+        with FrameLogWriter('run.frames') as log:
+            for _ in range(100):
+                log.write(client.next_raw())
+
+    Parameters
+    ----------
+    path : str
+        The log file. If it exists, new messages are appended to it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._log = open(path, 'ab')
+        self._index = open(index_path(path), 'ab')
+        self._record = np.zeros(1, dtype=INDEX_DTYPE)
+
+    def write(self, msg, train_id=None, timestamp=None):
+        """Append one message.
+
+        Parameters
+        ----------
+        msg : list of zmq.Frame or bytes
+            The message, e.g. from :meth:`Client.next_raw`.
+        train_id, timestamp : optional
+            Index values for the message. By default, they are read from
+            the message metadata with :func:`message_info`.
+        """
+        if train_id is None or timestamp is None:
+            tid, ts = message_info(msg)
+            train_id = tid if train_id is None else train_id
+            timestamp = ts if timestamp is None else timestamp
+
+        buffers = [_buffer(frame) for frame in msg]
+        lengths = np.array([memoryview(b).nbytes for b in buffers],
+                           dtype=np.uint64)
+        offset = self._log.tell()
+        self._log.write(lengths.tobytes())
+        for buf in buffers:
+            self._log.write(buf)
+
+        rec = self._record[0]
+        rec['train_id'] = train_id
+        rec['timestamp'] = timestamp
+        rec['offset'] = offset
+        rec['nframes'] = len(buffers)
+        rec['size'] = lengths.nbytes + int(lengths.sum())
+        # Index after the data, so a crash can't leave an index record
+        # pointing past the end of the log.
+        self._index.write(self._record.tobytes())
+
+    def flush(self):
+        self._log.flush()
+        self._index.flush()
+
+    def close(self):
+        self._log.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class FrameLogReader:
+    """Read messages from a frame log by train ID or time.
+
+    The log is memory-mapped, and messages are returned as lists of
+    memoryviews into it, which :func:`~karabo_bridge.serializer.deserialize`
+    accepts without copying the frames::
+
+        log = FrameLogReader('run.frames')
+        data, meta = deserialize(log.train(10000000))
+        for msg in log.select_time(start, stop):
+            ...
+
+    Lookups use binary search on the index, sorted by train ID and by
+    timestamp when the log is opened.
+
+    Parameters
+    ----------
+    path : str
+        The log file, with its index at ``<path>.index``.
+    """
+    def __init__(self, path):
+        self.path = path
+        index = np.fromfile(index_path(path), dtype=INDEX_DTYPE)
+        size = os.path.getsize(path)
+        # Drop records for messages not completely written
+        self.index = index[index['offset'] + index['size'] <= size]
+
+        self._mmap = None
+        self._buf = memoryview(b'')
+        if size:
+            with open(path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._buf = memoryview(self._mmap)
+
+        self._by_tid = np.argsort(self.index['train_id'], kind='stable')
+        self._sorted_tids = self.index['train_id'][self._by_tid]
+        self._by_time = np.argsort(self.index['timestamp'], kind='stable')
+        self._sorted_times = self.index['timestamp'][self._by_time]
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def train_ids(self):
+        """Train IDs of the messages, in the order they were recorded"""
+        return self.index['train_id']
+
+    def message(self, i):
+        """Get the frames of the i-th message recorded"""
+        rec = self.index[i]
+        start, nframes = int(rec['offset']), int(rec['nframes'])
+        lengths = np.frombuffer(self._buf, dtype=np.uint64, count=nframes,
+                                offset=start)
+        frames = []
+        pos = start + lengths.nbytes
+        for length in lengths.tolist():
+            frames.append(self._buf[pos:pos + length])
+            pos += length
+        return frames
+
+    def train(self, train_id):
+        """Get the frames of the message for a train ID.
+
+        If a train was recorded more than once, the first one is returned.
+
+        Raises
+        ------
+        KeyError
+            If the train is not in the log.
+        """
+        i = np.searchsorted(self._sorted_tids, train_id)
+        if i == len(self._sorted_tids) or self._sorted_tids[i] != train_id:
+            raise KeyError(train_id)
+        return self.message(self._by_tid[i])
+
+    def select_trains(self, start, stop):
+        """Iterate over messages with start <= train ID < stop, in order"""
+        lo, hi = np.searchsorted(self._sorted_tids, [start, stop])
+        for i in self._by_tid[lo:hi]:
+            yield self.message(i)
+
+    def select_time(self, start, stop):
+        """Iterate over messages with start <= timestamp < stop, in order"""
+        lo, hi = np.searchsorted(self._sorted_times, [start, stop])
+        for i in self._by_time[lo:hi]:
+            yield self.message(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.message(i)
+
+    def close(self):
+        try:
+            self._buf.release()
+            if self._mmap is not None:
+                self._mmap.close()
+        except BufferError:
+            pass  # Frames are still in use; unmapped when they are freed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,298 @@
+# coding: utf-8
+"""
+Measurements of Karabo bridge servers and clients, with rolling percentiles.
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import time
+
+import numpy as np
+
+from .serializer import train_id, unbundle
+
+
+__all__ = ['ClientMetrics', 'RollingWindow', 'SenderMetrics', 'serve_metrics']
+
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def frame_nbytes(frame):
+    """Size of a message frame: bytes, zmq.Frame or buffer"""
+    return memoryview(getattr(frame, 'buffer', frame)).nbytes
+
+
+class RollingWindow:
+    """The last *size* values of a quantity, and totals since the start"""
+    def __init__(self, size=1000):
+        self._values = np.zeros(size)
+        self.count = 0
+        self.total = 0.
+
+    def add(self, value):
+        self._values[self.count % len(self._values)] = value
+        self.count += 1
+        self.total += value
+
+    @property
+    def values(self):
+        """The values in the window, oldest first"""
+        n = len(self._values)
+        if self.count <= n:
+            return self._values[:self.count].copy()
+        return np.roll(self._values, -(self.count % n))
+
+    @property
+    def last(self):
+        if not self.count:
+            return np.nan
+        return self._values[(self.count - 1) % len(self._values)]
+
+    def quantiles(self, q=QUANTILES):
+        """Quantiles (0 - 1) of the values in the window, NaN if empty"""
+        if not self.count:
+            return [np.nan] * len(q)
+        n = min(self.count, len(self._values))
+        return np.quantile(self._values[:n], q).tolist()
+
+
+class Metrics:
+    """Named rolling windows, counters and gauges.
+
+    Subclasses describe their quantities in the ``windows``, ``counters``
+    and ``gauges`` dicts, mapping each name to a help string.
+    """
+    prefix = 'karabo_bridge'
+    windows = {}
+    counters = {}
+    gauges = {}
+
+    def __init__(self, window=1000):
+        self.window = {name: RollingWindow(window) for name in self.windows}
+        self.count = dict.fromkeys(self.counters, 0)
+        self.gauge = dict.fromkeys(self.gauges, np.nan)
+        self.hooks = []
+        self._lock = Lock()
+
+    def add_hook(self, func):
+        """Call ``func(sample)`` with a dict of the values for each train"""
+        self.hooks.append(func)
+
+    def _record(self, sample, counts=None):
+        with self._lock:
+            for name, value in sample.items():
+                if name in self.window:
+                    if value == value:  # Skip NaN (value not known)
+                        self.window[name].add(value)
+                elif name in self.gauge:
+                    self.gauge[name] = value
+            for name, n in (counts or {}).items():
+                self.count[name] += n
+        for hook in self.hooks:
+            hook(sample)
+
+    def summary(self):
+        """A dict of the current values.
+
+        Rolling windows give ``{'p50': .., 'p90': .., 'p99': .., 'mean': ..,
+        'count': ..}``, where the mean is over all values recorded.
+        """
+        with self._lock:
+            res = dict(self.count)
+            res.update(self.gauge)
+            for name, w in self.window.items():
+                res[name] = dict(
+                    zip(('p50', 'p90', 'p99'), w.quantiles()),
+                    mean=w.total / w.count if w.count else np.nan,
+                    count=w.count,
+                )
+        return res
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def describe(name, help, kind):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            for name, help in self.counters.items():
+                full = f'{self.prefix}_{name}_total'
+                describe(full, help, 'counter')
+                lines.append(f'{full} {self.count[name]}')
+            for name, help in self.gauges.items():
+                full = f'{self.prefix}_{name}'
+                describe(full, help, 'gauge')
+                lines.append(f'{full} {self.gauge[name]}')
+            for name, help in self.windows.items():
+                full = f'{self.prefix}_{name}'
+                w = self.window[name]
+                describe(full, help, 'summary')
+                for q, value in zip(QUANTILES, w.quantiles()):
+                    lines.append(f'{full}{{quantile="{q}"}} {value}')
+                lines.append(f'{full}_sum {w.total}')
+                lines.append(f'{full}_count {w.count}')
+        return '\n'.join(lines) + '\n'
+
+
+class SenderMetrics(Metrics):
+    """Per-train measurements of a server.
+
+    Enable them with :meth:`~karabo_bridge.ServerInThread.enable_metrics`::
+
+        server = ServerInThread('tcp://*:4545')
+        metrics = server.enable_metrics()
+        ...
+        print(metrics.summary()['serialize_seconds']['p99'])
+    """
+    windows = {
+        'serialize_seconds': 'Time to serialize a train',
+        'wait_seconds': 'Time waiting for a request or for the socket to '
+                        'accept a message',
+        'send_seconds': 'Time to pass a message to ZeroMQ',
+        'message_bytes': 'Size of each message sent',
+        'message_frames': 'Number of frames in each message sent',
+    }
+    counters = {
+        'trains_sent': 'Messages sent',
+        'bytes_sent': 'Bytes sent',
+        'frames_sent': 'Frames sent',
+        'trains_dropped': 'Trains dropped before sending',
+    }
+    gauges = {
+        'queue_depth': 'Trains waiting in the queue to be sent',
+    }
+
+    def record(self, serialize, wait, send, payload, queue_depth=np.nan):
+        nbytes = sum(frame_nbytes(f) for f in payload)
+        self._record(
+            {'serialize_seconds': serialize, 'wait_seconds': wait,
+             'send_seconds': send, 'message_bytes': nbytes,
+             'message_frames': len(payload), 'queue_depth': queue_depth},
+            {'trains_sent': 1, 'bytes_sent': nbytes,
+             'frames_sent': len(payload)},
+        )
+
+    def dropped(self, n=1):
+        with self._lock:
+            self.count['trains_dropped'] += n
+
+
+def _train_info(meta):
+    """Train IDs and timestamps in a message's metadata"""
+    tids, timestamps = [], []
+    for _, train_meta in unbundle({}, meta):  # Bundles: one per train
+        tid = train_id(train_meta)
+        if tid is not None:
+            tids.append(tid)
+            timestamps.append(next((m['timestamp'] for m in train_meta.values()
+                                    if 'timestamp' in m), np.nan))
+    return tids, timestamps
+
+
+class ClientMetrics(Metrics):
+    """Per-message measurements of a client.
+
+    Enable them with :meth:`~karabo_bridge.Client.enable_metrics`::
+
+        client = Client('tcp://localhost:4545')
+        metrics = client.enable_metrics()
+        ...
+        print(metrics.summary()['staleness_seconds']['p50'])
+
+    Train IDs missing from the sequence received are counted as missed. For
+    several clients sharing out the trains from a PUSH socket, each client
+    sees gaps which are not lost data.
+    """
+    prefix = 'karabo_bridge_client'
+    windows = {
+        'wait_seconds': 'Time waiting for a message to arrive',
+        'recv_seconds': 'Time to receive a message once it has arrived',
+        'deserialize_seconds': 'Time to deserialize a message',
+        'message_bytes': 'Size of each message received',
+        'message_frames': 'Number of frames in each message received',
+        'staleness_seconds': 'Age of the latest train in each message when '
+                             'it is decoded, from its timestamp',
+    }
+    counters = {
+        'trains_received': 'Trains received',
+        'bytes_received': 'Bytes received',
+        'trains_missed': 'Trains missing from the train ID sequence',
+    }
+    gauges = {
+        'last_train_id': 'Train ID of the last train received',
+    }
+
+    def __init__(self, window=1000):
+        super().__init__(window)
+        self._last_tid = None
+
+    def record(self, wait, recv, deserialize, msg, meta):
+        """Record a decoded message, and return its sample dict"""
+        tids, timestamps = _train_info(meta)
+        missed = 0
+        for tid in tids:
+            last = self._last_tid
+            if last is not None and tid > last + 1:
+                missed += tid - last - 1
+            self._last_tid = tid
+        nbytes = sum(frame_nbytes(f) for f in msg)
+        sample = {
+            'wait_seconds': wait, 'recv_seconds': recv,
+            'deserialize_seconds': deserialize, 'message_bytes': nbytes,
+            'message_frames': len(msg),
+            'staleness_seconds': time() - timestamps[-1] if tids else np.nan,
+            'last_train_id': tids[-1] if tids else np.nan,
+            'trains_missed': missed,
+        }
+        self._record(sample, {'trains_received': max(len(tids), 1),
+                              'bytes_received': nbytes,
+                              'trains_missed': missed})
+        return sample
+
+
+def serve_metrics(metrics, port=0, host='127.0.0.1'):
+    """Serve metrics in the Prometheus text format over HTTP.
+
+    The server runs in a daemon thread, answering at ``/metrics``. Call its
+    ``shutdown()`` and ``server_close()`` methods to stop it.
+
+    Parameters
+    ----------
+    metrics : Metrics
+        E.g. from :meth:`~karabo_bridge.ServerInThread.enable_metrics` or
+        :meth:`~karabo_bridge.Client.enable_metrics`.
+    port : int
+        The TCP port; 0 picks a free one, available as
+        ``server.server_port``.
+    host : str
+        The address to listen on; by default only local connections.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Don't print every scrape
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,235 @@
+# coding: utf-8
+"""
+Simulate a large detector as many module streams, each from its own process.
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+import multiprocessing as mp
+from queue import Empty
+from time import monotonic, time
+
+from .serializer import train_id
+from .server import SimServer, _array_nbytes
+
+
+__all__ = ['SimSupervisor']
+
+
+# Detector: (module detector type, module source name template)
+MODULE_DETECTORS = {
+    'AGIPD': ('AGIPDModule', 'SPB_DET_AGIPD1M-1/DET/{}CH0:xtdf'),
+    'LPD': ('LPDModule', 'FXE_DET_LPD1M-1/DET/{}CH0:xtdf'),
+}
+
+
+class _StatsSimServer(SimServer):
+    """SimServer sending its statistics to the supervisor"""
+    def __init__(self, endpoint, index, stats_queue, report_interval,
+                 **kwargs):
+        super().__init__(endpoint, **kwargs)
+        self.index = index
+        self.stats_queue = stats_queue
+        self.report_interval = report_interval
+        self.n_bytes = 0
+        self._next_report = monotonic()
+
+    def _sent(self, data, meta):
+        super()._sent(data, meta)
+        self.n_bytes += sum(_array_nbytes(props) for props in data.values())
+        now = monotonic()
+        if now >= self._next_report:
+            tid = train_id(meta)
+            self.stats_queue.put(
+                (self.index, self.n_sent, self.n_bytes, tid, now))
+            self._next_report = now + self.report_interval
+
+
+def _run_worker(endpoint, index, stats_queue, report_interval, kwargs):
+    try:
+        server = _StatsSimServer(endpoint, index, stats_queue,
+                                 report_interval, **kwargs)
+        server.loop()
+    except KeyboardInterrupt:
+        pass
+
+
+class SimSupervisor:
+    """Run simulated detector modules in separate processes.
+
+    Each process sends a group of modules on its own endpoint, with the same
+    train IDs at the same times (or shifted by *skew*)::
+
+        endpoints = [f'tcp://*:{4500 + i}' for i in range(16)]
+        with SimSupervisor(endpoints, 'AGIPD', rate=10) as sup:
+            sup.run()  # Print aggregated statistics until interrupted
+
+    Parameters
+    ----------
+    endpoints: list of str
+        An address to bind for each process.
+    detector: ('AGIPD' | 'LPD')
+        The detector to simulate. Modules are sent as raw data.
+    modules: list of int, optional
+        Module numbers to simulate (default: all 16).
+    modules_per_process: int, optional
+        Number of modules sent by each process, as separate sources in the
+        same message. There must be one endpoint per group of modules.
+    rate: float, optional
+        Trains per second from each process (default 10). None sends as
+        fast as possible; the train IDs are still the same in each process,
+        but not sent at the same time.
+    skew: float, optional
+        Delay in seconds of each process relative to the previous one.
+    first_train_id: int, optional
+    start_delay: float, optional
+        Seconds from :meth:`start` until the first train is due, to let
+        the processes start up (default 2).
+    report_interval: float, optional
+        How often the processes send statistics, in seconds.
+    **kwargs
+        Other options for :class:`~karabo_bridge.server.SimServer`, e.g.
+        *sock*, *protocol_version*, *pool*.
+    """
+    def __init__(self, endpoints, detector='AGIPD', modules=None,
+                 modules_per_process=1, rate=10, skew=0,
+                 first_train_id=10000000000, start_delay=2,
+                 report_interval=1, **kwargs):
+        if detector not in MODULE_DETECTORS:
+            raise ValueError(f'Unknown detector {detector!r}; use one of '
+                             f'{sorted(MODULE_DETECTORS)}')
+        self.module_type, source_template = MODULE_DETECTORS[detector]
+        modules = list(range(16) if modules is None else modules)
+        self.groups = [
+            [source_template.format(m)
+             for m in modules[i:i + modules_per_process]]
+            for i in range(0, len(modules), modules_per_process)
+        ]
+        if len(endpoints) != len(self.groups):
+            raise ValueError(f'{len(self.groups)} groups of modules need as '
+                             f'many endpoints, got {len(endpoints)}')
+        self.endpoints = list(endpoints)
+        self.rate = rate
+        self.skew = skew
+        self.first_train_id = first_train_id
+        self.start_delay = start_delay
+        self.report_interval = report_interval
+        self.sim_kwargs = kwargs
+
+        self._mp = mp.get_context('spawn')
+        self.stats_queue = self._mp.Queue()
+        self.processes = []
+        # Process index: list of the last 2 (trains, bytes, train ID, time)
+        self.stats = {}
+
+    def start(self):
+        """Start the processes"""
+        start_time = time() + self.start_delay
+        for i, (endpoint, sources) in enumerate(zip(self.endpoints,
+                                                    self.groups)):
+            kwargs = dict(
+                self.sim_kwargs, detector=self.module_type, raw=True,
+                sources=sources, rate=self.rate,
+                first_train_id=self.first_train_id,
+                start_time=start_time + i * self.skew, debug=False,
+            )
+            p = self._mp.Process(
+                target=_run_worker, daemon=True,
+                args=(endpoint, i, self.stats_queue, self.report_interval,
+                      kwargs),
+            )
+            p.start()
+            self.processes.append(p)
+
+    def stop(self):
+        """Stop the processes"""
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            p.join()
+        self.processes = []
+
+    def check_processes(self):
+        """Raise RuntimeError if any process has stopped.
+
+        A process stops if it fails, e.g. because its endpoint is already in
+        use; its traceback is printed on stderr.
+        """
+        for i, p in enumerate(self.processes):
+            if p.exitcode is not None:
+                raise RuntimeError(
+                    f'Process {i} sending on {self.endpoints[i]} stopped '
+                    f'with exit code {p.exitcode}')
+
+    def poll(self, timeout=0):
+        """Collect statistics sent by the processes.
+
+        Raises RuntimeError if any process has stopped, rather than
+        reporting its last statistics as if it was still running.
+        """
+        deadline = monotonic() + timeout
+        while True:
+            try:
+                index, *sample = self.stats_queue.get(
+                    timeout=max(deadline - monotonic(), 0))
+            except Empty:
+                break
+            history = self.stats.setdefault(index, [])
+            history.append(tuple(sample))
+            del history[:-2]
+        self.check_processes()
+
+    def summary(self):
+        """Aggregated statistics from the latest reports.
+
+        Returns
+        -------
+        dict
+            ``trains`` and ``bytes`` sent by all processes, the combined
+            ``rate`` (trains/s) and ``throughput`` (bytes/s) over the last
+            report interval, and the range of the latest train IDs sent
+            (``min_train_id``, ``max_train_id``).
+        """
+        summary = {'processes': len(self.stats), 'trains': 0, 'bytes': 0,
+                   'rate': 0., 'throughput': 0.}
+        tids = []
+        for history in self.stats.values():
+            trains, nbytes, tid, t = history[-1]
+            summary['trains'] += trains
+            summary['bytes'] += nbytes
+            tids.append(tid)
+            if len(history) == 2:
+                trains0, nbytes0, _, t0 = history[0]
+                if t > t0:
+                    summary['rate'] += (trains - trains0) / (t - t0)
+                    summary['throughput'] += (nbytes - nbytes0) / (t - t0)
+        summary['min_train_id'] = min(tids, default=None)
+        summary['max_train_id'] = max(tids, default=None)
+        return summary
+
+    def run(self, duration=None):
+        """Print aggregated statistics until *duration* seconds have passed.
+
+        Raises RuntimeError if any process stops.
+        """
+        end = None if duration is None else monotonic() + duration
+        while end is None or monotonic() < end:
+            self.poll(timeout=self.report_interval)
+            s = self.summary()
+            if not s['processes']:
+                continue
+            print('{} processes: {:.1f} trains/s, {:.1f} MB/s, train IDs {} - '
+                  '{}'.format(s['processes'], s['rate'],
+                              s['throughput'] / 1e6, s['min_train_id'],
+                              s['max_train_id']))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
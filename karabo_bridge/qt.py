@@ -1,11 +1,13 @@
 import queue
 from itertools import count
 from secrets import token_hex
+from time import perf_counter
 
 import zmq
 from qtpy.QtCore import QObject, QThread, QTimer, Signal, Slot
 
-from .serializer import deserialize
+from . import trace
+from .serializer import DeltaDecoder, DeltaSyncError, deserialize, train_id
 
 class Worker(QThread):
     data_queued = Signal()
@@ -35,6 +37,8 @@ class Worker(QThread):
         if self.sock_type == zmq.REQ:
             data_sock.send(b'next')
 
+        delta = DeltaDecoder()
+        need_keyframe = False
         for i in count(start=1):
             ready = [sock for (sock, _) in poller.poll()]
             if ctrl_sock in ready:
@@ -43,15 +47,34 @@ class Worker(QThread):
 
 
             if data_sock in ready:
+                tracer = trace.tracer
+                if tracer is not None:
+                    t0 = perf_counter()
                 raw_msgs = data_sock.recv_multipart(copy=False)
-                data, metadata = deserialize(raw_msgs)
-                self.queue.put((data, metadata))
-                self.data_queued.emit()
-                if (self.stop_after > 0) and (i >= self.stop_after):
-                    break
+                if tracer is not None:
+                    t1 = perf_counter()
+                try:
+                    data, metadata = deserialize(raw_msgs, delta=delta)
+                except DeltaSyncError:
+                    # Missed part of a delta encoded stream
+                    need_keyframe = True
+                else:
+                    need_keyframe = False
+                    t_queued = None
+                    if tracer is not None:
+                        t_queued = perf_counter()
+                        tid = train_id(metadata)
+                        tracer.add('QBridgeClient.recv', t0, t1, tid)
+                        tracer.add('QBridgeClient.deserialize', t1, t_queued,
+                                   tid)
+                    # The time it was queued is kept for tracing
+                    self.queue.put((data, metadata, t_queued))
+                    self.data_queued.emit()
+                    if (self.stop_after > 0) and (i >= self.stop_after):
+                        break
 
             if self.sock_type == zmq.REQ:
-                data_sock.send(b'next')
+                data_sock.send(b'resync' if need_keyframe else b'next')
 
         # Stop receiving
         ctrl_sock.close()
@@ -133,12 +156,20 @@ class QBridgeClient(QObject):
 
     def _dequeue_one(self):
         try:
-            data, metadata = self.queue.get_nowait()
+            data, metadata, t_queued = self.queue.get_nowait()
         except queue.Empty:
             self._dequeuing = False
             return
 
-        self.new_data.emit(data, metadata)
+        tracer = trace.tracer
+        if tracer is None or t_queued is None:
+            self.new_data.emit(data, metadata)
+        else:
+            tid = train_id(metadata)
+            t0 = perf_counter()
+            tracer.add_async('QBridgeClient.queue', t_queued, t0, tid)
+            self.new_data.emit(data, metadata)
+            tracer.add('QBridgeClient.emit', t0, perf_counter(), tid)
         QTimer.singleShot(0, self._dequeue_one)
 
     def stop(self):
@@ -0,0 +1,168 @@
+# coding: utf-8
+"""
+Per-pulse reductions of detector data.
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+import numpy as np
+
+from .stage import ImageStage
+
+
+__all__ = ['Reduction']
+
+
+class Reduction(ImageStage):
+    """Compute per-pulse scalars from detector images.
+
+    Configure the reductions to compute, then use it as a
+    :class:`~karabo_bridge.Client` stage::
+
+        reduce = Reduction(drop_image=True)
+        reduce.add_roi('spot', np.s_[3, 10:20, 40:60])
+        reduce.add_module_mean()
+        reduce.add_histogram('pixels', bins=100, range=(0, 10000))
+
+        client = Client('tcp://localhost:4545')
+        client.add_stage(reduce)
+        data, meta = client.next()
+        data[source]['reduced.spot']  # shape (pulses,)
+
+    Each result is added to the source data as ``reduced.<name>``, with the
+    pulses along the first axis, in the same order as ``image.pulseId`` and
+    ``image.cellId``.
+
+    Parameters
+    ----------
+    source, key, data_like
+        As for :class:`~karabo_bridge.stage.ImageStage`.
+    drop_image : bool, optional
+        Remove the image from the returned train data after reducing it.
+    """
+    def __init__(self, source=None, key='image.data', data_like='online',
+                 drop_image=False):
+        super().__init__(source, key, data_like)
+        self.drop_image = drop_image
+        self._reductions = {}
+
+    def _add(self, name, func):
+        if name in self._reductions:
+            raise ValueError(f'Reduction {name!r} already defined')
+        self._reductions[name] = func
+
+    def add_roi(self, name, roi):
+        """Sum the pixels in a region of interest.
+
+        Parameters
+        ----------
+        name : str
+        roi : tuple of slices
+            Index of the region in a single frame, i.e. excluding the pulse
+            axis, e.g. ``np.s_[modno, 10:20, 40:60]``.
+        """
+        if not isinstance(roi, tuple):
+            roi = (roi,)
+        self._add(name, lambda image: self._roi_sum(image, roi))
+
+    def add_module_mean(self, name='module_mean'):
+        """Mean intensity of each module, shaped (pulses, modules)."""
+        self._add(name, self._module_mean)
+
+    def add_histogram(self, name, bins, range):
+        """Histogram of the pixel values, shaped (pulses, bins).
+
+        Bins have a fixed width, and values outside *range* are ignored,
+        like :func:`numpy.histogram`.
+        """
+        lo, hi = range
+        if hi <= lo:
+            raise ValueError('Histogram range must be increasing')
+        self._add(name, lambda image: self._histogram(image, bins, lo, hi))
+
+    def _roi_sum(self, image, roi):
+        if self.data_like == 'online':
+            index = roi + (Ellipsis, slice(None))
+        else:
+            index = (slice(None),) + roi
+        region = image[index]
+        pulse_axis = region.ndim - 1 if self.data_like == 'online' else 0
+        frame_axes = tuple(ax for ax in range(region.ndim) if ax != pulse_axis)
+        return region.sum(axis=frame_axes, dtype=np.float64)
+
+    def _pixels(self, image):
+        """2D view (pixels, pulses) or (pulses, pixels) of the image"""
+        if self.data_like == 'online':
+            return image.reshape(-1, image.shape[-1]), 0
+        return image.reshape(image.shape[0], -1), 1
+
+    def _module_mean(self, image):
+        modules = image.shape[0 if self.data_like == 'online' else 1]
+        if image.ndim < 4:
+            modules = 1  # single module
+        pixels, axis = self._pixels(image)
+        per_module = pixels.shape[axis] // modules
+        starts = np.arange(modules) * per_module
+        sums = np.add.reduceat(pixels, starts, axis=axis, dtype=np.float64)
+        if axis == 0:
+            sums = sums.T
+        sums /= per_module
+        return sums
+
+    # Pixel values converted to bin numbers at a time in _histogram
+    _histogram_chunk = 1 << 20
+
+    def _histogram(self, image, bins, lo, hi):
+        pixels, axis = self._pixels(image)
+        npulses = pixels.shape[1 - axis]
+        scale = bins / (hi - lo)
+        # Offset each pulse's bins, so one bincount makes all histograms
+        offsets = np.arange(npulses) * bins
+        if axis == 1:
+            offsets = offsets[:, np.newaxis]
+
+        # Work through blocks of rows with reused buffers, rather than
+        # making full size temporary arrays.
+        rows = max(self._histogram_chunk // max(pixels.shape[1], 1), 1)
+        shape = (min(rows, pixels.shape[0]), pixels.shape[1])
+        scaled_buf = np.empty(shape, np.float64)
+        index_buf = np.empty(shape, np.intp)
+        valid_buf = np.empty(shape, np.bool_)
+        upper_buf = np.empty(shape, np.bool_)
+        counts = np.zeros(npulses * bins, np.intp)
+        for start in range(0, pixels.shape[0], rows):
+            chunk = pixels[start:start + rows]
+            n = len(chunk)
+            scaled, index = scaled_buf[:n], index_buf[:n]
+            valid, upper = valid_buf[:n], upper_buf[:n]
+            np.subtract(chunk, lo, out=scaled, dtype=np.float64)
+            scaled *= scale
+            np.greater_equal(scaled, 0, out=valid)
+            np.less_equal(scaled, bins, out=upper)
+            valid &= upper
+            np.minimum(scaled, bins - 1, out=scaled)
+            with np.errstate(invalid='ignore'):  # NaNs are not valid
+                np.copyto(index, scaled, casting='unsafe')
+            index += offsets[start:start + n] if axis == 1 else offsets
+            counts += np.bincount(index[valid], minlength=npulses * bins)
+        return counts.reshape(npulses, bins)
+
+    def reduce(self, image):
+        """Compute the configured reductions for one train's image.
+
+        Returns
+        -------
+        dict
+            Per-pulse results, keyed by reduction name.
+        """
+        return {name: func(image) for name, func in self._reductions.items()}
+
+    def process(self, source, src_data):
+        for name, result in self.reduce(src_data[self.key]).items():
+            src_data[f'reduced.{name}'] = result
+        if self.drop_image:
+            del src_data[self.key]
@@ -0,0 +1,280 @@
+# coding: utf-8
+"""
+Replay recorded Karabo bridge data.
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+import os
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from time import monotonic
+
+import numpy as np
+
+from .framelog import FrameLogReader, index_path
+from .serializer import train_id
+from .server import Sender, ServerInThread
+
+
+__all__ = ['ReplayServer', 'ReplayServerInThread']
+
+
+TRAIN_PERIOD = 0.1  # seconds, at 10 Hz
+
+
+def _value(ds, row):
+    """Read one train's value from a dataset with a train axis"""
+    if ds.ndim == 1:
+        value = ds[row]
+        if isinstance(value, bytes):
+            return value.decode('utf-8', 'surrogateescape')
+        return value.item() if isinstance(value, np.generic) else value
+
+    # Big arrays are chunked by train: read the chunk without going
+    # through the HDF5 type conversion and selection machinery. Any filter
+    # (compression, shuffle, checksums...) means the raw chunk needs decoding.
+    if (ds.chunks == (1,) + ds.shape[1:]
+            and ds.id.get_create_plist().get_nfilters() == 0):
+        _, buf = ds.id.read_direct_chunk((row,) + (0,) * (ds.ndim - 1))
+        return np.frombuffer(buf, dtype=ds.dtype).reshape(ds.shape[1:])
+    out = np.empty(ds.shape[1:], dtype=ds.dtype)
+    ds.read_direct(out, np.s_[row])
+    return out
+
+
+def _hdf5_trains(path):
+    """Yield (train ID, timestamp, (data, meta)) from an HDF5 file.
+
+    Files written by karabo-bridge-record have one row per train in each
+    dataset. Other files, such as those from ``karabo-bridge-glimpse --save``,
+    are read as a single train.
+    """
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        if 'INDEX/trainId' not in f:
+            yield from _hdf5_single_train(f)
+            return
+
+        tids = f['INDEX/trainId'][:]
+        timestamps = f['INDEX/timestamp'][:]
+        sources = {}  # source: train IDs
+        keys = {}  # (source, key): (train IDs, dataset)
+
+        def find_source(name, obj):
+            if not name.endswith('/trainId') or isinstance(obj, h5py.Group):
+                return
+            src = name[:-len('/trainId')]
+            if not isinstance(f.get(src), h5py.Group):
+                return  # E.g. the index of a key called trainId
+            sources[src] = src_tids = obj[:]
+            key_index = f.get(f'INDEX/{src}/keys', {})
+            for k, ds in f[src].items():
+                if not isinstance(ds, h5py.Dataset):
+                    continue
+                if k in key_index:
+                    keys[(src, k)] = (key_index[k][:], ds)
+                elif len(ds) == len(src_tids):
+                    # Older files have no index per key: only keys in every
+                    # train with the source can be matched to train IDs.
+                    keys[(src, k)] = (src_tids, ds)
+        f['INDEX'].visititems(find_source)
+
+        src_rows = dict.fromkeys(sources, 0)
+        key_rows = dict.fromkeys(keys, 0)
+        for tid, ts in zip(tids.tolist(), timestamps.tolist()):
+            data, meta = {}, {}
+            for src, src_tids in sources.items():
+                row = src_rows[src]
+                if row >= len(src_tids) or src_tids[row] != tid:
+                    continue  # Source not in this train
+                src_rows[src] += 1
+                data[src] = {}
+                meta[src] = {'source': src, 'timestamp': ts,
+                             'timestamp.tid': tid}
+            for (src, k), (key_tids, ds) in keys.items():
+                row = key_rows[(src, k)]
+                if row >= len(key_tids) or key_tids[row] != tid:
+                    continue  # Key not recorded in this train
+                key_rows[(src, k)] += 1
+                if src in data:
+                    data[src][k] = _value(ds, row)
+            yield tid, ts, (data, meta)
+
+
+def _hdf5_single_train(f):
+    import h5py
+
+    data = {}
+
+    def add(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            src, key = name.rsplit('/', 1)
+            data.setdefault(src, {})[key] = obj[()]
+    f.visititems(add)
+
+    meta = {}
+    for src in list(data):
+        if src.endswith('/metadata'):
+            meta[src[:-len('/metadata')]] = data.pop(src)
+    tid = train_id(meta) or 0
+    meta = {src: meta.get(src, {}) for src in data}
+    yield tid, np.nan, (data, meta)
+
+
+def _framelog_trains(path):
+    """Yield (train ID, timestamp, msg) from a frame log"""
+    with FrameLogReader(path) as log:
+        for rec, msg in zip(log.index, log):
+            yield int(rec['train_id']), float(rec['timestamp']), msg
+
+
+def open_recording(path):
+    """Iterate over the trains in an HDF5 file or a frame log.
+
+    Yields ``(train_id, timestamp, item)``, where *item* is a
+    ``(data, meta)`` tuple for HDF5 files, and the raw message (list of
+    frames) for frame logs.
+    """
+    if os.path.exists(index_path(path)):
+        return _framelog_trains(path)
+    import h5py
+    if h5py.is_hdf5(path):
+        return _hdf5_trains(path)
+    raise ValueError(f'{path} is neither an HDF5 file nor a frame log')
+
+
+class ReplayServer(Sender):
+    """Stream recorded trains from files.
+
+    Trains are read in a separate thread, ahead of sending them. Frame logs
+    (see :mod:`karabo_bridge.framelog`) are sent exactly as recorded; HDF5
+    files are serialized with the given options.
+
+    Parameters
+    ----------
+    endpoint : str
+        The address to bind.
+    paths : str or list of str
+        HDF5 files (from ``karabo-bridge-record`` or
+        ``karabo-bridge-glimpse --save``) or frame logs, replayed in order.
+    rate : 'original', 'max' or float
+        Send trains at the recorded rate, as fast as possible, or at a fixed
+        rate in Hz. The original rate is taken from the timestamps, or from
+        the train IDs if the timestamps are missing.
+    loop : bool
+        Start again from the first file after the last one.
+    prefetch : int
+        Number of trains to read ahead.
+    **kwargs
+        Passed to :class:`~karabo_bridge.server.Sender`, e.g. *sock* and
+        *protocol_version*.
+    """
+    def __init__(self, endpoint, paths, rate='original', loop=False,
+                 prefetch=4, **kwargs):
+        if not (rate in {'original', 'max'} or float(rate) > 0):
+            raise ValueError(f"rate must be 'original', 'max' or a positive "
+                             f"number, not {rate!r}")
+        super().__init__(endpoint, **kwargs)
+        if isinstance(paths, str):
+            paths = [paths]
+        self.paths = list(paths)
+        self.rate = rate
+        self.repeat = loop
+        self.prefetch = prefetch
+        self._stop_reading = Event()
+
+    def _put(self, queue, item):
+        """Put item in the queue, unless sending stops; returns False if so"""
+        while not self._stop_reading.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _read(self, queue):
+        while True:
+            for path in self.paths:
+                for train in open_recording(path):
+                    if not self._put(queue, train):
+                        return
+            if not self.repeat:
+                break
+        self._put(queue, None)
+
+    def _trains(self):
+        """Yield trains from the reading thread"""
+        queue = Queue(maxsize=self.prefetch)
+        self._stop_reading.clear()
+        reader = Thread(target=self._read, args=(queue,), daemon=True)
+        reader.start()
+        try:
+            while True:
+                train = queue.get()
+                if train is None:
+                    break
+                yield train
+        finally:
+            self._stop_reading.set()
+            try:
+                while True:  # Unblock the reader
+                    queue.get_nowait()
+            except Empty:
+                pass
+            reader.join()
+
+    def _interval(self, prev_tid, prev_ts, tid, ts):
+        """Time in seconds between sending two trains"""
+        if self.rate == 'max':
+            return 0
+        elif self.rate != 'original':
+            return 1 / float(self.rate)
+        if np.isnan(ts) or np.isnan(prev_ts) or ts < prev_ts:
+            return max(tid - prev_tid, 0) * TRAIN_PERIOD
+        return ts - prev_ts
+
+    def loop(self):
+        print(f'Replay Karabo-bridge server started on:\n{self.endpoint}')
+
+        n = 0
+        t_start = due = prev = None
+        for tid, ts, item in self._trains():
+            if prev is None:
+                t_start = due = monotonic()
+            else:
+                due += self._interval(*prev, tid, ts)
+                if self._wait(due):
+                    break
+                # If sending fell behind, don't burst to catch up
+                due = max(due, monotonic() - 1)
+            prev = tid, ts
+
+            if isinstance(item, tuple):
+                done = self.send(*item)
+            else:
+                done = self.send_raw(item)
+            if done:
+                break
+            n += 1
+
+        if n > 1:
+            elapsed = monotonic() - t_start
+            print(f'Replayed {n} trains in {elapsed:.2f} seconds '
+                  f'({n / elapsed:.2f} Hz)')
+
+
+class ReplayServerInThread(ReplayServer, ServerInThread):
+    """Run a :class:`ReplayServer` in a background thread.
+
+    Use it as a context manager, like
+    :class:`~karabo_bridge.ServerInThread`.
+    """
+    def _run(self):
+        self.loop()
@@ -1,3 +1,4 @@
+from copy import deepcopy
 from functools import partial
 from time import time
 
@@ -6,8 +7,16 @@ import msgpack_numpy
 import numpy as np
 import zmq
 
+from .compression import (
+    compress_array, compression_options, decompress_array, thread_pool
+)
 
-__all__ = ['serialize', 'deserialize']
+
+__all__ = [
+    'serialize', 'deserialize', 'SparseArray', 'DeltaEncoder', 'DeltaDecoder',
+    'DeltaSyncError', 'serialize_bundle', 'is_bundle', 'unbundle',
+    'train_id',
+]
 
 
 class Frame:
@@ -20,6 +29,152 @@ class Frame:
         self.buffer = data
 
 
+class SparseArray:
+    """Sparse array received from a karabo bridge.
+
+    Only the values at the flat *indices* of an array with *shape* are stored,
+    all other elements are zero.
+    """
+    def __init__(self, shape, dtype, indices, values):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.indices = indices
+        self.values = values
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def todense(self):
+        """Make a dense numpy array"""
+        dense = np.zeros(self.shape, dtype=self.dtype)
+        dense.reshape(-1)[self.indices] = self.values
+        return dense
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.todense(), dtype=dtype)
+
+    def __repr__(self):
+        return (f'<SparseArray shape={self.shape} dtype={self.dtype} '
+                f'nnz={self.nnz}>')
+
+
+def _index_dtype(size):
+    """The narrowest unsigned integer type to index *size* elements"""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if size <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def _get_option(options, source, key):
+    """Look up a per-key option given as {(source, key): x} or {key: x}"""
+    if not options:
+        return None
+    return options.get((source, key), options.get(key))
+
+
+class DeltaSyncError(RuntimeError):
+    """A delta message can't be applied: the previous state is unknown"""
+
+
+def _same_value(a, b):
+    return type(a) is type(b) and a == b
+
+
+class DeltaEncoder:
+    """Server side state to send only slow data values which changed.
+
+    A keyframe with all values is sent every *keyframe_interval* messages,
+    or when :meth:`request_keyframe` is called. In between, the msgpack part
+    of each source only has the keys whose values changed since the last
+    message including that source. Arrays are always sent in full.
+
+    Pass this to :func:`serialize` as ``delta=encoder`` for each message.
+    """
+    def __init__(self, keyframe_interval=100):
+        if keyframe_interval < 1:
+            raise ValueError('keyframe_interval must be at least 1')
+        self.keyframe_interval = keyframe_interval
+        self.seq = -1
+        self._last_keyframe = None
+        self._keyframe_requested = True
+        self._last = {}  # source: (seq, main_data)
+
+    def request_keyframe(self):
+        """Make the next message a keyframe, e.g. when a client resyncs"""
+        self._keyframe_requested = True
+
+    def next_message(self):
+        """Start a new message. Returns True if it is a keyframe."""
+        self.seq += 1
+        if (self._keyframe_requested
+                or self.seq - self._last_keyframe >= self.keyframe_interval):
+            self._keyframe_requested = False
+            self._last_keyframe = self.seq
+            self._last.clear()
+        return self._last_keyframe == self.seq
+
+    def encode(self, source, main_data):
+        """Encode one source's values in the current message.
+
+        Returns the content type, the extra header fields and the dict of
+        values to pack.
+        """
+        prev = self._last.get(source)
+        # Copy mutable values, so changes made in place are detected
+        self._last[source] = (self.seq, {
+            k: deepcopy(v) if isinstance(v, (list, dict)) else v
+            for k, v in main_data.items()
+        })
+        if prev is None:
+            return 'msgpack', {'delta': {'seq': self.seq}}, main_data
+
+        base, prev_data = prev
+        changed = {k: v for k, v in main_data.items()
+                   if k not in prev_data or not _same_value(v, prev_data[k])}
+        removed = [k for k in prev_data if k not in main_data]
+        header = {'delta': {'seq': self.seq, 'base': base, 'removed': removed}}
+        return 'msgpack-delta', header, changed
+
+
+class DeltaDecoder:
+    """Client side state to rebuild full data from delta messages.
+
+    Parameters
+    ----------
+    changes_only: bool
+        If True, return only the keys which changed for delta messages,
+        instead of the full rebuilt data.
+    """
+    def __init__(self, changes_only=False):
+        self.changes_only = changes_only
+        self._state = {}  # source: (seq, data)
+
+    def keyframe(self, source, seq, values):
+        self._state[source] = (seq, dict(values))
+        return values
+
+    def apply(self, source, delta, changes):
+        """Apply changes to the last known state of a source.
+
+        Raises :exc:`DeltaSyncError` if the message this delta is based on
+        was not received.
+        """
+        seq, state = self._state.get(source, (None, None))
+        if seq is None or seq != delta['base']:
+            self._state.pop(source, None)
+            raise DeltaSyncError(
+                f'Missed data for {source!r}, waiting for a keyframe')
+        for key in delta['removed']:
+            state.pop(key, None)
+        state.update(changes)
+        self._state[source] = (delta['seq'], state)
+        if self.changes_only:
+            return changes
+        return dict(state)
+
+
 def timestamp():
     """Generate dummy timestamp information based on machine time
     """
@@ -51,8 +206,85 @@ def _serialize_old(data, metadata, dummy_timestamps):
                           default=msgpack_numpy.encode)]
 
 
+def _array_frames(pack, src, key, array, sparse=None, compression=None,
+                  max_frame_size=None):
+    """Make the frames (header, payload, ...) for one array"""
+    if sparse is not None:
+        if isinstance(sparse, np.ndarray) and sparse.dtype == np.bool_:
+            indices = np.flatnonzero(sparse)
+        else:
+            indices = np.flatnonzero(array > sparse)
+        values = np.ascontiguousarray(array.reshape(-1)[indices])
+        indices = indices.astype(_index_dtype(array.size))
+        return [
+            pack({
+                'source': src, 'content': 'sparse-array', 'path': key,
+                'dtype': str(array.dtype), 'shape': array.shape,
+                'index_dtype': str(indices.dtype), 'nnz': len(indices),
+            }),
+            indices.data,
+            values.data,
+        ]
+
+    if compression is not None:
+        info, chunks = compress_array(array, compression_options(compression))
+        return [
+            pack({
+                'source': src, 'content': 'compressed-array', 'path': key,
+                'dtype': str(array.dtype), 'shape': array.shape,
+                'compression': info,
+            }),
+            *chunks,
+        ]
+
+    if not array.flags['C_CONTIGUOUS']:
+        array = np.ascontiguousarray(array)
+
+    if (max_frame_size is not None and array.nbytes > max_frame_size
+            and array.ndim > 0 and len(array) > 1):
+        # Split along the first axis; each chunk is still contiguous
+        row_bytes = array.nbytes // len(array)
+        count = max(max_frame_size // max(row_bytes, 1), 1)
+        frames = []
+        for offset in range(0, len(array), count):
+            chunk = array[offset:offset + count]
+            frames.extend([
+                pack({
+                    'source': src, 'content': 'array-chunk', 'path': key,
+                    'dtype': str(array.dtype), 'shape': array.shape,
+                    'offset': offset, 'count': len(chunk),
+                }),
+                chunk.data,
+            ])
+        return frames
+
+    return [
+        pack({
+            'source': src, 'content': 'array', 'path': key,
+            'dtype': str(array.dtype), 'shape': array.shape
+        }),
+        array.data,
+    ]
+
+
+def _split_props(props):
+    """Split a source's data into a dict for msgpack and a list of arrays"""
+    main_data = {}
+    arrays = []
+    for key, value in props.items():
+        if isinstance(value, np.ndarray):
+            arrays.append((key, value))
+        elif isinstance(value, np.number):
+            # Convert numpy type to native Python type
+            main_data[key] = value.item()
+        else:
+            main_data[key] = value
+    return main_data, arrays
+
+
 def serialize(data, metadata=None, protocol_version='2.2',
-              dummy_timestamps=False):
+              dummy_timestamps=False, sparse=None, compression=None,
+              delta=None, max_frame_size=None, parallel=False):
     """Serializer for the Karabo bridge protocol
 
     Convert data/metadata to a list of bytestrings and/or memoryviews
@@ -103,6 +335,42 @@ def serialize(data, metadata=None, protocol_version='2.2',
         file, so this option generates fake timestamps from the time the data
         is fed in, if the real timestamp information is missing.
 
+    sparse: dict, optional
+        Arrays to send as sparse arrays (protocol 2.2 only), keyed by
+        parameter name, or by (source, parameter name) tuples. The values are
+        either a threshold, to send only elements greater than it, or a
+        boolean mask of the elements to send. The flat indices and the
+        values are sent in two frames.
+
+    compression: dict, optional
+        Arrays to send compressed (protocol 2.2 only), keyed like *sparse*.
+        The values are a codec name ('zlib' or 'lzma'), or a dict with the
+        keys 'codec', 'level', 'shuffle' (None, 'byte' - the default - or
+        'bit') and 'chunk_size' (in bytes). Arrays are split into chunks
+        which are compressed in parallel threads, and sent as one frame
+        each. Sparse arrays are not compressed.
+
+    delta: DeltaEncoder, optional
+        Send only the non-array values which changed since the previous
+        message, with periodic keyframes (protocol 2.2 only). The same
+        encoder must be used for each message in a stream. Clients rebuild
+        the full data with a :class:`DeltaDecoder`.
+
+    max_frame_size: int, optional
+        Split arrays bigger than this (in bytes) along their first axis, and
+        send the pieces in separate frames (protocol 2.2 only).
+        :func:`deserialize` copies them back together into one array, and
+        can pass each piece to a callback as it is unpacked. This only
+        limits the size of each frame: the pieces are still parts of one
+        message, which ZeroMQ delivers all at once.
+
+    parallel: bool
+        Serialize the sources concurrently in a thread pool (protocol 2.2
+        only). This helps when there are many sources with arrays which need
+        copying (not C-contiguous) or compressing, as numpy and the
+        compression codecs release the GIL. The message is the same as
+        without this option.
+
     returns
     -------
     msg: list of bytes/memoryviews ojects
@@ -115,56 +383,194 @@ def serialize(data, metadata=None, protocol_version='2.2',
         metadata = {src: v.get('metadata', {}) for src, v in data.items()}
 
     if protocol_version == '1.0':
+        if sparse or compression or delta or max_frame_size:
+            raise ValueError('Sparse arrays, compression, delta encoding and '
+                             'split frames need protocol version 2.2')
         return _serialize_old(data, metadata, dummy_timestamps)
 
-    pack = msgpack.Packer(use_bin_type=True).pack
-    msg = []
     ts = timestamp()
-    for src, props in sorted(data.items()):
+    if delta is not None:
+        delta.next_message()
+
+    def source_frames(src):
+        # Packer objects are not thread safe: make one for each source
+        pack = msgpack.Packer(use_bin_type=True).pack
         src_meta = metadata[src].copy()
         if dummy_timestamps and 'timestamp' not in src_meta:
             src_meta.update(ts)
 
-        main_data = {}
-        arrays = []
-        for key, value in props.items():
-            if isinstance(value, np.ndarray):
-                arrays.append((key, value))
-            elif isinstance(value, np.number):
-                # Convert numpy type to native Python type
-                main_data[key] = value.item()
-            else:
-                main_data[key] = value
+        main_data, arrays = _split_props(data[src])
+        header = {'source': src, 'content': 'msgpack', 'metadata': src_meta}
+        if delta is not None:
+            content, extra, main_data = delta.encode(src, main_data)
+            header.update(content=content, **extra)
+        frames = [pack(header), pack(main_data)]
+
+        for key, array in arrays:
+            frames.extend(_array_frames(
+                pack, src, key, array, sparse=_get_option(sparse, src, key),
+                compression=_get_option(compression, src, key),
+                max_frame_size=max_frame_size,
+            ))
+        return frames
+
+    sources = sorted(data)
+    if parallel and len(sources) > 1:
+        # map() keeps the results in order, so the message is the same
+        per_source = thread_pool().map(source_frames, sources)
+    else:
+        per_source = map(source_frames, sources)
+
+    msg = []
+    for frames in per_source:
+        msg.extend(frames)
+    return msg
+
+
+def train_layout(data):
+    """Sources, keys and array shapes & dtypes of a train's data.
+
+    Trains with the same layout can be bundled together.
+    """
+    return tuple(sorted(
+        (src, tuple(sorted(
+            (key, (v.shape, v.dtype.str) if isinstance(v, np.ndarray) else None)
+            for key, v in props.items()
+        )))
+        for src, props in data.items()
+    ))
+
+
+def serialize_bundle(trains, dummy_timestamps=False, sparse=None,
+                     compression=None, max_frame_size=None):
+    """Serialize several trains into a single message (protocol 2.2).
+
+    Bundling reduces the per message overhead for sources with small
+    payloads. All trains must have the same sources, keys, and array shapes
+    and dtypes. Each array is sent once, with the trains stacked along a new
+    first axis, and other values are sent as lists with one entry per train.
+
+    Parameters
+    ----------
+    trains: list of (data, metadata) tuples
+        The trains to bundle. See :func:`serialize` for the format of data
+        and metadata; metadata may be None.
+    dummy_timestamps, sparse, compression, max_frame_size:
+        As for :func:`serialize`.
+
+    returns
+    -------
+    msg: list of bytes/memoryviews ojects
+        Use :func:`unbundle` to split the deserialized message into trains.
+    """
+    if not trains:
+        raise ValueError('No trains to bundle')
+    layout = train_layout(trains[0][0])
+    if any(train_layout(data) != layout for data, _ in trains[1:]):
+        raise ValueError('Bundled trains must have the same sources, keys '
+                         'and array shapes')
+
+    metadatas = []
+    for data, metadata in trains:
+        if metadata is None:
+            metadata = {src: v.get('metadata', {}) for src, v in data.items()}
+        metadatas.append(metadata)
 
+    pack = msgpack.Packer(use_bin_type=True).pack
+    msg = []
+    ts = timestamp()
+    first_data = trains[0][0]
+    for src in sorted(first_data):
+        src_metas = []
+        for metadata in metadatas:
+            src_meta = metadata[src].copy()
+            if dummy_timestamps and 'timestamp' not in src_meta:
+                src_meta.update(ts)
+            src_metas.append(src_meta)
+
+        per_train = [_split_props(data[src]) for data, _ in trains]
+        main_data = {key: [md[key] for md, _ in per_train]
+                     for key in per_train[0][0]}
         msg.extend([
             pack({
-                'source': src, 'content': 'msgpack',
-                'metadata': src_meta
+                'source': src, 'content': 'msgpack-bundle',
+                'metadata': src_metas, 'ntrains': len(trains),
             }),
             pack(main_data)
         ])
 
-        for key, array in arrays:
-            if not array.flags['C_CONTIGUOUS']:
-                array = np.ascontiguousarray(array)
-            msg.extend([
-                pack({
-                    'source': src, 'content': 'array', 'path': key,
-                    'dtype': str(array.dtype), 'shape': array.shape
-                }),
-                array.data,
-            ])
+        for i, (key, _) in enumerate(per_train[0][1]):
+            array = np.stack([arrays[i][1] for _, arrays in per_train])
+            msg.extend(_array_frames(
+                pack, src, key, array, sparse=_get_option(sparse, src, key),
+                compression=_get_option(compression, src, key),
+                max_frame_size=max_frame_size,
+            ))
 
     return msg
 
 
-def deserialize(msg):
+def is_bundle(meta):
+    """Check if deserialized data is a bundle of several trains"""
+    return any(isinstance(m, list) for m in meta.values())
+
+
+def train_id(meta, data=None):
+    """The train ID in a message's metadata, or None if it has none.
+
+    For a bundle of several trains, this is the ID of the first train. If
+    *meta* is None, the metadata is taken from *data*, where protocol 1.0
+    keeps it.
+    """
+    if meta is None:
+        meta = {src: props.get('metadata', {})
+                for src, props in (data or {}).items()}
+    for m in meta.values():
+        if isinstance(m, list):  # Bundles have a list of dicts
+            m = m[0] if m else {}
+        if 'timestamp.tid' in m:
+            return int(m['timestamp.tid'])
+    return None
+
+
+def unbundle(data, meta):
+    """Split a bundle of trains into a list of (data, meta) tuples.
+
+    Arrays in the individual trains are views of the bundled arrays.
+    """
+    if not is_bundle(meta):
+        return [(data, meta)]
+    ntrains = len(next(iter(meta.values())))
+    trains = []
+    for i in range(ntrains):
+        train_data = {}
+        for src, props in data.items():
+            train_data[src] = {key: value[i] for key, value in props.items()}
+        trains.append((train_data, {src: m[i] for src, m in meta.items()}))
+    return trains
+
+
+def deserialize(msg, sparse='dense', delta=None, on_chunk=None):
     """Deserializer for the karabo bridge protocol
 
     Parameters
     ----------
     msg: list of zmq.Frame or list of byte objects
         Serialized data following the karabo_bridge protocol
+    sparse: ('dense' | 'sparse')
+        Whether arrays sent as sparse arrays are returned as dense numpy
+        arrays (default), or as :class:`SparseArray` objects.
+    delta: DeltaDecoder, optional
+        State to rebuild data from delta encoded messages. The same decoder
+        must be used for each message in a stream.
+    on_chunk: callable, optional
+        Called as ``on_chunk(source, path, offset, chunk)`` for each piece of
+        an array split into several frames (see *max_frame_size* in
+        :func:`serialize`), once it has been copied into the full array.
+        *chunk* is the view of the full array at *offset* along its first
+        axis. The whole message has already been received when this is
+        called, so it doesn't overlap processing with the transfer; it only
+        lets processing start before the other pieces are copied.
 
     Returns
     -------
@@ -185,19 +591,68 @@ def deserialize(msg):
             meta[key] = value.get('metadata', {})
         return data, meta
 
+    if sparse not in {'dense', 'sparse'}:
+        raise ValueError(f"sparse must be 'dense' or 'sparse', not {sparse!r}")
+
     data, meta = {}, {}
-    for header, payload in zip(*[iter(msg)]*2):
+    frames = iter(msg)
+    for header in frames:
         md = unpack(header.bytes)
         source = md['source']
         content = md['content']
+        payload = next(frames)
 
         if content == 'msgpack':
             data[source] = unpack(payload.bytes)
             meta[source] = md.get('metadata', {})
+            if delta is not None and 'delta' in md:
+                delta.keyframe(source, md['delta']['seq'], data[source])
+        elif content == 'msgpack-bundle':
+            # Several trains: values are lists, arrays have a train axis
+            data[source] = unpack(payload.bytes)
+            meta[source] = md['metadata']
+        elif content == 'msgpack-delta':
+            if delta is None:
+                raise RuntimeError('Delta encoded message: deserializing it '
+                                   'needs a DeltaDecoder')
+            data[source] = delta.apply(source, md['delta'],
+                                       unpack(payload.bytes))
+            meta[source] = md.get('metadata', {})
         elif content == 'array':
             dtype, shape = md['dtype'], md['shape']
             array = np.frombuffer(payload.buffer, dtype=dtype).reshape(shape)
             data[source].update({md['path']: array})
+        elif content == 'array-chunk':
+            path, offset, count = md['path'], md['offset'], md['count']
+            shape = md['shape']
+            piece = np.frombuffer(payload.buffer, dtype=md['dtype'])
+            if offset == 0 and count == shape[0]:
+                # The whole array in one piece: no need to copy it
+                chunk = piece.reshape(shape)
+                data[source][path] = chunk
+            else:
+                array = data[source].get(path)
+                if array is None:
+                    array = np.empty(shape, dtype=md['dtype'])
+                    data[source][path] = array
+                chunk = array[offset:offset + count]
+                chunk[...] = piece.reshape(chunk.shape)
+            if on_chunk is not None:
+                on_chunk(source, path, offset, chunk)
+        elif content == 'sparse-array':
+            indices = np.frombuffer(payload.buffer, dtype=md['index_dtype'])
+            values = np.frombuffer(next(frames).buffer, dtype=md['dtype'])
+            array = SparseArray(md['shape'], md['dtype'], indices, values)
+            if sparse == 'dense':
+                array = array.todense()
+            data[source].update({md['path']: array})
+        elif content == 'compressed-array':
+            info = md['compression']
+            chunks = [payload] + [next(frames)
+                                  for _ in range(info['nchunks'] - 1)]
+            array = decompress_array(info, [c.buffer for c in chunks],
+                                     md['dtype'], md['shape'])
+            data[source].update({md['path']: array})
         else:
             raise RuntimeError('Unknown message: %s' % md['content'])
     return data, meta
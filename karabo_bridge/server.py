@@ -1,112 +1,320 @@
 from functools import partial
-from queue import Queue
+from queue import Empty, Full, Queue
 from socket import gethostname
 from threading import Thread
-from time import time
+from time import monotonic, perf_counter, time
 
+import numpy as np
 import zmq
 
-from .serializer import serialize
-from .simulation import data_generator
+from . import trace
+from .metrics import SenderMetrics, serve_metrics
+from .serializer import (
+    DeltaEncoder, serialize, serialize_bundle, train_id, train_layout
+)
+from .simulation import TrainPacer, data_generator
 
 
 __all__ = ['ServerInThread', 'start_gen']
 
 
+def _array_nbytes(props):
+    return sum(v.nbytes for v in props.values() if isinstance(v, np.ndarray))
+
+
 class Sender:
     def __init__(self, endpoint, sock='REP', protocol_version='2.2',
-                 dummy_timestamps=False):
+                 dummy_timestamps=False, sparse=None, compression=None,
+                 keyframe_interval=None, max_frame_size=None, parallel=False,
+                 fast_endpoint=None, fast_threshold=65536, context=None):
+        if fast_endpoint is not None and keyframe_interval:
+            raise ValueError("Delta encoding can't be used with a separate "
+                             "channel for small sources")
+        self.delta = None
+        if keyframe_interval:
+            if protocol_version != '2.2':
+                raise ValueError('Delta encoding needs protocol version 2.2')
+            if sock not in {'PUB', 'REP'}:
+                # PUSH shares messages out between clients, so each one
+                # would miss deltas
+                raise ValueError('Delta encoding needs a PUB or REP socket')
+            self.delta = DeltaEncoder(keyframe_interval)
         self.dump = partial(serialize, protocol_version=protocol_version,
-                            dummy_timestamps=dummy_timestamps)
-        self.zmq_context = zmq.Context()
+                            dummy_timestamps=dummy_timestamps, sparse=sparse,
+                            compression=compression, delta=self.delta,
+                            max_frame_size=max_frame_size, parallel=parallel)
+        self.dump_bundle = None
+        if protocol_version == '2.2':
+            self.dump_bundle = partial(
+                serialize_bundle, dummy_timestamps=dummy_timestamps,
+                sparse=sparse, compression=compression,
+                max_frame_size=max_frame_size)
+        if sock not in {'REP', 'PUB', 'PUSH'}:
+            raise ValueError(f'Unsupported socket type: {sock}')
+        # A shared context allows inproc:// endpoints
+        self._own_context = context is None
+        self.zmq_context = zmq.Context() if context is None else context
         if sock == 'REP':
             self.server_socket = self.zmq_context.socket(zmq.REP)
         elif sock == 'PUB':
             self.server_socket = self.zmq_context.socket(zmq.PUB)
         elif sock == 'PUSH':
             self.server_socket = self.zmq_context.socket(zmq.PUSH)
-        else:
-            raise ValueError(f'Unsupported socket type: {sock}')
         self.server_socket.setsockopt(zmq.LINGER, 0)
         self.server_socket.set_hwm(1)
         self.server_socket.bind(endpoint)
 
+        # Optional channel publishing small sources ahead of the bulk data
+        self.fast_socket = None
+        self.fast_threshold = fast_threshold
+        if fast_endpoint is not None:
+            self.fast_socket = self.zmq_context.socket(zmq.PUB)
+            self.fast_socket.setsockopt(zmq.LINGER, 0)
+            self.fast_socket.bind(fast_endpoint)
+
+        stop_endpoint = f'inproc://sim-server-stop-{id(self)}'
         self.stopper_r = self.zmq_context.socket(zmq.PAIR)
-        self.stopper_r.bind('inproc://sim-server-stop')
+        self.stopper_r.bind(stop_endpoint)
         self.stopper_w = self.zmq_context.socket(zmq.PAIR)
-        self.stopper_w.connect('inproc://sim-server-stop')
+        self.stopper_w.connect(stop_endpoint)
 
         self.poller = zmq.Poller()
         self.poller.register(self.server_socket, zmq.POLLIN | zmq.POLLOUT)
         self.poller.register(self.stopper_r, zmq.POLLIN)
 
+        self.metrics = None
+        self._metrics_server = None
+
+    def enable_metrics(self, window=1000, port=None):
+        """Start measuring each train sent.
+
+        Parameters
+        ----------
+        window : int
+            Number of recent trains used for percentiles.
+        port : int, optional
+            Serve the metrics in the Prometheus text format on this local
+            TCP port, at ``http://localhost:<port>/metrics`` (0 picks a free
+            port).
+
+        Returns
+        -------
+        metrics : SenderMetrics
+            Also available as the ``metrics`` attribute.
+        """
+        self.metrics = SenderMetrics(window)
+        if port is not None:
+            self._metrics_server = serve_metrics(self.metrics, port)
+        return self.metrics
+
+    @property
+    def metrics_endpoint(self):
+        if self._metrics_server is None:
+            return None
+        host, port = self._metrics_server.server_address[:2]
+        return f'http://{host}:{port}/metrics'
+
+    def _queue_depth(self):
+        return np.nan
+
     @property
     def endpoint(self):
         endpoint = self.server_socket.getsockopt_string(zmq.LAST_ENDPOINT)
         endpoint = endpoint.replace('0.0.0.0', gethostname())
         return endpoint
 
+    @property
+    def fast_endpoint(self):
+        if self.fast_socket is None:
+            return None
+        endpoint = self.fast_socket.getsockopt_string(zmq.LAST_ENDPOINT)
+        return endpoint.replace('0.0.0.0', gethostname())
+
+    def close(self):
+        """Close the sockets, and the ZeroMQ context if it was created here"""
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+        if self._own_context:
+            self.zmq_context.destroy(linger=0)
+            return
+        for socket in (self.server_socket, self.fast_socket, self.stopper_r,
+                       self.stopper_w):
+            if socket is not None:
+                socket.close(linger=0)
+
+    def _split_fast(self, data, metadata):
+        """Separate sources with less than fast_threshold bytes of arrays"""
+        if metadata is None:
+            metadata = {src: v.get('metadata', {}) for src, v in data.items()}
+        fast = {src for src, props in data.items()
+                if _array_nbytes(props) < self.fast_threshold}
+        if not fast or len(fast) == len(data):
+            # Nothing to split, send everything on the main channel
+            return None, (data, metadata)
+
+        def select(d, small):
+            return {src: v for src, v in d.items() if (src in fast) == small}
+        return ((select(data, True), select(metadata, True)),
+                (select(data, False), select(metadata, False)))
+
     def send(self, data, metadata=None):
-        payload = self.dump(data, metadata)
+        if self.fast_socket is not None:
+            fast, (data, metadata) = self._split_fast(data, metadata)
+            if fast is not None:
+                self.fast_socket.send_multipart(self.dump(*fast), copy=False)
+        tid = None
+        if trace.tracer is not None:
+            tid = train_id(metadata, data)
+        return self._send(partial(self.dump, data, metadata), tid)
+
+    def send_bundle(self, trains):
+        """Send a list of (data, metadata) trains as one message"""
+        if self.dump_bundle is None:
+            raise ValueError('Bundling trains needs protocol version 2.2')
+        tid = None
+        if trace.tracer is not None:
+            tid = train_id(trains[0][1], trains[0][0])
+        return self._send(partial(self.dump_bundle, trains), tid)
+
+    def _wait(self, deadline):
+        """Wait until *deadline* (monotonic time); True if stopped meanwhile"""
+        timeout = deadline - monotonic()
+        if timeout > 0 and self.stopper_r.poll(int(timeout * 1000)):
+            self.stopper_r.recv()
+            return True
+        return False
+
+    def send_raw(self, msg):
+        """Send an already serialized message, e.g. from a frame log"""
+        return self._send(lambda: msg)
+
+    def _send(self, dump, train_id=None):
+        # Timing is skipped entirely unless metrics or tracing are enabled
+        metrics, tracer = self.metrics, trace.tracer
+        timed = metrics is not None or tracer is not None
+        # With delta encoding, a REP server serializes after the request,
+        # which may ask for a keyframe. Otherwise, serializing overlaps
+        # waiting for the client.
+        defer = self.delta is not None and self.server_socket.type == zmq.REP
+        if timed:
+            t0 = perf_counter()
+        payload = None if defer else dump()
+        if timed:
+            t1 = perf_counter()
         events = dict(self.poller.poll())
 
         if self.stopper_r in events:
             self.stopper_r.recv()
             return True
 
+        request = None
         if events[self.server_socket] == zmq.POLLIN:
-            msg = self.server_socket.recv()
-            if msg != b'next':
-                print(f'Unrecognised request: {msg}')
-                self.server_socket.send(b'Error: bad request %b' % msg)
-                return
-
+            request = self.server_socket.recv()
+        if timed:
+            t2 = perf_counter()
+
+        if request not in (None, b'next', b'resync'):
+            print(f'Unrecognised request: {request}')
+            self.server_socket.send(b'Error: bad request %b' % request)
+            return
+        if request == b'resync' and self.delta is not None:
+            # The client missed part of the delta encoded stream
+            self.delta.request_keyframe()
+        if payload is None:
+            payload = dump()
+
+        if not timed:
+            self.server_socket.send_multipart(payload, copy=False)
+            return
+        t3 = perf_counter()
         self.server_socket.send_multipart(payload, copy=False)
+        t4 = perf_counter()
+        if metrics is not None:
+            metrics.record(serialize=(t1 - t0) + (t3 - t2), wait=t2 - t1,
+                           send=t4 - t3, payload=payload,
+                           queue_depth=self._queue_depth())
+        if tracer is not None:
+            if defer:
+                tracer.add('Sender.poll', t1, t2, train_id)
+                tracer.add('Sender.serialize', t2, t3, train_id,
+                           keyframe=request == b'resync')
+            else:
+                tracer.add('Sender.serialize', t0, t1, train_id)
+                tracer.add('Sender.poll', t1, t2, train_id)
+            tracer.add('Sender.send', t3, t4, train_id)
 
 
 class SimServer(Sender):
     def __init__(self, endpoint, sock='REP', ser='msgpack',
                  protocol_version='2.2', detector='AGIPD', raw=False,
-                 nsources=1, datagen='random', data_like='online', *,
+                 nsources=1, datagen='random', data_like='online', pool=0,
+                 native=False, rate=None, jitter=0, drop=0, burst_every=0,
+                 burst_size=0, seed=None, source='', sources=None,
+                 first_train_id=10000000000, start_time=None, context=None, *,
                  debug=True):
-        super().__init__(endpoint, sock=sock, protocol_version=protocol_version)
-
         if ser != 'msgpack':
             raise ValueError("Unknown serialisation format %s" % ser)
+        self.pacer = TrainPacer(rate=rate, jitter=jitter, drop=drop,
+                                burst_every=burst_every,
+                                burst_size=burst_size, seed=seed,
+                                first_train_id=first_train_id,
+                                start_time=start_time)
+
+        super().__init__(endpoint, sock=sock, protocol_version=protocol_version,
+                         context=context)
 
         self.data = data_generator(
             detector=detector, raw=raw, nsources=nsources, datagen=datagen,
-            data_like=data_like, debug=debug)
+            data_like=data_like, pool=pool, native=native,
+            train_ids=self.pacer.train_ids(), source=source, sources=sources,
+            debug=debug)
         self.debug = debug
+        self.timing_interval = 50
+        self.n_sent = 0
+        self._n_dropped = 0  # Dropped trains passed on to the metrics
 
     def loop(self):
         print(f'Simulated Karabo-bridge server started on:\n'
               f'{self.endpoint}')
 
-        timing_interval = 50
-        t_prev = time()
-        n = 0
-
+        self._t_prev = time()
         for data, meta in self.data:
+            if self._wait(self.pacer.due):
+                break
             done = self.send(data, meta)
             if done:
                 break
-
-            if self.debug:
-                print('Server : emitted train:',
-                      next(v for v in meta.values())['timestamp.tid'])
-            n += 1
-            if n % timing_interval == 0:
-                t_now = time()
-                print('Sent {} trains in {:.2f} seconds ({:.2f} Hz)'
-                      ''.format(timing_interval, t_now - t_prev,
-                                timing_interval / (t_now - t_prev)))
-                t_prev = t_now
+            self._sent(data, meta)
+
+    def _sent(self, data, meta):
+        """Called after sending each train"""
+        if self.debug:
+            print('Server : emitted train:',
+                  next(v for v in meta.values())['timestamp.tid'])
+        self.n_sent += 1
+        if self.metrics is not None and self.pacer.dropped > self._n_dropped:
+            self.metrics.dropped(self.pacer.dropped - self._n_dropped)
+            self._n_dropped = self.pacer.dropped
+        if self.n_sent % self.timing_interval == 0:
+            t_now = time()
+            rates = '{:.2f} Hz'.format(
+                self.timing_interval / (t_now - self._t_prev))
+            if self.pacer.rate is not None:
+                rates += f', target {self.pacer.rate:.2f} Hz'
+            if self.pacer.drop:
+                rates += f', {self.pacer.dropped} trains dropped'
+            print('Sent {} trains in {:.2f} seconds ({})'
+                  ''.format(self.timing_interval, t_now - self._t_prev, rates))
+            self._t_prev = t_now
 
 
 class ServerInThread(Sender):
     def __init__(self, endpoint, sock='REP', maxlen=10, protocol_version='2.2',
-                 dummy_timestamps=False):
+                 dummy_timestamps=False, sparse=None, compression=None,
+                 keyframe_interval=None, bundle=1, bundle_time=None,
+                 max_frame_size=None, parallel=False, fast_endpoint=None,
+                 fast_threshold=65536, context=None):
         """ZeroMQ interface sending data over a TCP socket.
 
         example::
@@ -140,9 +348,66 @@ class ServerInThread(Sender):
             the messages. We can't give accurate timestamps where these are not
             in the file, so this option generates fake timestamps from the time
             the data is fed in.
+        sparse: dict, optional
+            Arrays to send as sparse arrays, with a threshold or mask for
+            each key. See :func:`~karabo_bridge.serializer.serialize`.
+        compression: dict, optional
+            Arrays to compress, with a codec name or options for each key.
+            See :func:`~karabo_bridge.serializer.serialize`.
+        keyframe_interval: int, optional
+            Enable delta encoding of slow data: between keyframes, sent every
+            N trains, only values which changed are sent for each source.
+            Clients joining or missing a message wait for the next keyframe,
+            or request one (REQ clients). Only for PUB and REP sockets; the
+            encoder state is shared by all clients, so with REP it works
+            properly with a single client.
+        bundle: int or None, optional
+            Send up to this many consecutive trains in one message, to reduce
+            the overhead for small, high rate data. None means no limit,
+            with *bundle_time* set. Default 1: no bundling.
+        bundle_time: float, optional
+            Maximum time in seconds to wait for more trains to bundle after
+            the first one. By default, wait until *bundle* trains are fed.
+            A bundle is also sent early if the next train has different
+            sources, keys or array shapes. Clients split bundles back into
+            trains, unless told not to.
+        max_frame_size: int, optional
+            Split arrays bigger than this many bytes into several frames
+            along their first axis. See
+            :func:`~karabo_bridge.serializer.serialize`.
+        parallel: bool, optional
+            Serialize sources concurrently in a thread pool.
+        fast_endpoint: str, optional
+            Address for a second (PUB) socket sending the small sources of
+            each train before the bulk data, so clients which need only those
+            get them sooner. Clients must connect to both endpoints.
+        fast_threshold: int, optional
+            Sources with less than this many bytes of arrays are sent on the
+            fast channel (default 64 kB). If all or none of the sources in a
+            train are small, the whole train goes on the main channel.
+        context: zmq.Context, optional
+            Create the sockets in this ZeroMQ context, e.g. to use an
+            ``inproc://`` endpoint shared with a client. It is not destroyed
+            when the server stops.
         """
         super().__init__(endpoint, sock=sock, protocol_version=protocol_version,
-                         dummy_timestamps=dummy_timestamps)
+                         dummy_timestamps=dummy_timestamps, sparse=sparse,
+                         compression=compression,
+                         keyframe_interval=keyframe_interval,
+                         max_frame_size=max_frame_size, parallel=parallel,
+                         fast_endpoint=fast_endpoint,
+                         fast_threshold=fast_threshold, context=context)
+        if bundle is None and bundle_time is None:
+            raise ValueError('Unlimited bundles need a bundle_time')
+        if bundle != 1 and protocol_version != '2.2':
+            raise ValueError('Bundling trains needs protocol version 2.2')
+        if bundle != 1 and (keyframe_interval or fast_endpoint):
+            raise ValueError("Bundling trains can't be combined with delta "
+                             "encoding or a separate channel for small "
+                             "sources")
+        self.bundle = bundle
+        self.bundle_time = bundle_time
+        self._held = None  # A train which didn't fit in the last bundle
         self.thread = Thread(target=self._run, daemon=True)
         self.buffer = Queue(maxsize=maxlen)
 
@@ -170,25 +435,80 @@ class ServerInThread(Sender):
 
         timeout: float
             In seconds, raises 'queue.Full' if no free slow was available
-            within that time.
+            within that time. With metrics enabled, trains not queued are
+            counted as dropped.
         """
-        self.buffer.put((data, metadata), block=block, timeout=timeout)
+        try:
+            self.buffer.put((data, metadata), block=block, timeout=timeout)
+        except Full:
+            if self.metrics is not None:
+                self.metrics.dropped()
+            raise
+
+    def _queue_depth(self):
+        return self.buffer.qsize()
+
+    def _next_bundle(self):
+        """Collect trains from the queue to send as one message"""
+        if self._held is not None:
+            first, self._held = self._held, None
+        else:
+            first = self.buffer.get()
+        trains = [first]
+        if first is self._stop_item:
+            return trains
+        layout = train_layout(first[0])
+        deadline = None
+        if self.bundle_time is not None:
+            deadline = monotonic() + self.bundle_time
+
+        while self.bundle is None or len(trains) < self.bundle:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+            try:
+                train = self.buffer.get(timeout=timeout)
+            except Empty:
+                break
+            if train is self._stop_item:
+                # Send what we have; the stop is seen when sending
+                self._held = train
+                break
+            if train_layout(train[0]) != layout:
+                self._held = train
+                break
+            trains.append(train)
+        return trains
 
     def _run(self):
         while True:
-            done = self.send(*self.buffer.get())
+            if self.bundle == 1:
+                done = self.send(*self.buffer.get())
+            else:
+                trains = self._next_bundle()
+                if len(trains) == 1:
+                    done = self.send(*trains[0])
+                else:
+                    done = self.send_bundle(trains)
             if done:
                 break
 
     def start(self):
         self.thread.start()
 
+    # Put in the queue by stop(), to release a thread waiting for trains
+    _stop_item = ({},)
+
     def stop(self):
         self.stopper_w.send(b'')
-        if self.buffer.qsize() == 0:
-            self.buffer.put(({},))  # release blocking queue
+        try:
+            self.buffer.put_nowait(self._stop_item)
+        except Full:
+            pass  # The thread isn't waiting for trains
         self.thread.join()
-        self.zmq_context.destroy(linger=0)
+        self.close()
 
     def __enter__(self):
         self.start()
@@ -204,7 +524,9 @@ class SimServerInThread(SimServer, ServerInThread):
 
 
 def start_gen(port, sock='REP', ser='msgpack', version='2.2', detector='AGIPD',
-              raw=False, nsources=1, datagen='random', data_like='online', *,
+              raw=False, nsources=1, datagen='random', data_like='online',
+              pool=0, native=False, rate=None, jitter=0, drop=0,
+              burst_every=0, burst_size=0, seed=None, metrics_port=None, *,
               debug=True):
     """Karabo bridge server simulation.
 
@@ -228,7 +550,8 @@ def start_gen(port, sock='REP', ser='msgpack', version='2.2', detector='AGIPD',
     nsources: int, optional
         Number of sources.
     datagen: string, optional
-        Generator function used to generate detector data. Default is random.
+        Generator function used to generate detector data: 'random'
+        (default), 'zeros' or 'photons' (simulated diffraction patterns).
     data_like: string optional ['online', 'file']
         Data array axes ordering for Mhz detector.
         The data arrays's axes can have different ordering on online data. The
@@ -241,13 +564,40 @@ def start_gen(port, sock='REP', ser='msgpack', version='2.2', detector='AGIPD',
         performance penalty for the file-like array shape.
 
         Default is online.
+    pool: int, optional
+        Pre-generate this many detector images, and send them in turn, so
+        generating data doesn't limit the rate. Default 0: generate new data
+        for each train.
+    native: bool, optional
+        Generate random data directly in the detector data type, which is
+        faster and avoids a large temporary array.
+    rate: float, optional
+        Send trains at this rate in Hz, scheduled from the start so that the
+        average rate doesn't drift. Default: as fast as possible.
+    jitter: float, optional
+        Standard deviation in seconds of random offsets to send times.
+    drop: float, optional
+        Probability of skipping each train ID, to simulate lost trains.
+    burst_every, burst_size: int, optional
+        Every *burst_every* trains, hold back *burst_size* trains and then
+        send them back to back, to simulate a backlog.
+    seed: int, optional
+        Seed for the jitter and dropped trains, for reproducible runs.
+    metrics_port: int, optional
+        Serve metrics of the trains sent in the Prometheus text format on
+        this local port.
     """
     endpoint = f'tcp://*:{port}'
     sender = SimServer(
         endpoint, sock=sock, ser=ser, protocol_version=version,
         detector=detector, raw=raw, nsources=nsources, datagen=datagen,
-        data_like=data_like, debug=debug
+        data_like=data_like, pool=pool, native=native, rate=rate,
+        jitter=jitter, drop=drop, burst_every=burst_every,
+        burst_size=burst_size, seed=seed, debug=debug
     )
+    if metrics_port is not None:
+        sender.enable_metrics(port=metrics_port)
+        print(f'Metrics served at {sender.metrics_endpoint}')
     try:
         sender.loop()
     except KeyboardInterrupt:
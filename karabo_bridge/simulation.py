@@ -10,9 +10,9 @@ You should have received a copy of the 3-Clause BSD License along with this
 program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
 """
 
-import copy
-from itertools import count
-from time import time
+from functools import partial
+from itertools import count, cycle
+from time import monotonic, time
 
 import numpy as np
 
@@ -27,42 +27,81 @@ class Detector:
     distance = 0  # Sample to detector distance [mm]
     layout = np.array([[]])  # super module layout of the detector
 
+    # Signal model for gen='photons'
+    adu_per_photon = 10  # in high gain
+    gain_switch = (5000, 50000)  # signal [ADU] switching to medium/low gain
+    gain_levels = (4500, 5500, 7000)  # image.gain value in each gain stage
+    ring_radii = (0.3, 0.55, 0.8)  # powder rings, fraction of half width
+    hit_rate = 0.3  # fraction of pulses with Bragg peaks
+    peaks_per_hit = 40
+    _photon_block = 1 << 20  # pixels generated at once by photons()
+
     @staticmethod
     def getDetector(detector, source='', raw=False, gen='random',
-                    data_like='online'):
+                    data_like='online', pool=0, native=False):
+        kw = dict(raw=raw, gen=gen, pool=pool, native=native)
         if detector == 'AGIPD':
             if not raw:
                 default = 'SPB_DET_AGIPD1M-1/CAL/APPEND_CORRECTED'
             else:
                 default = 'SPB_DET_AGIPD1M-1/CAL/APPEND_RAW'
             source = source or default
-            return AGIPD(source, raw=raw, gen=gen, data_like=data_like)
+            return AGIPD(source, data_like=data_like, **kw)
         elif detector == 'AGIPDModule':
             if not raw:
                 raise NotImplementedError(
                     'Calib. Data for single Modules not available yet')
             source = source or 'SPB_DET_AGIPD1M-1/DET/0CH0:xtdf'
-            return AGIPDModule(source, raw=raw, gen=gen, data_like=data_like)
+            return AGIPDModule(source, data_like=data_like, **kw)
         elif detector == 'LPD':
             if not raw:
                 default = 'FXE_DET_LPD1M-1/CAL/APPEND_CORRECTED'
             else:
                 default = 'FXE_DET_LPD1M-1/CAL/APPEND_RAW'
             source = source or default
-            return LPD(source, raw=raw, gen=gen)
+            return LPD(source, **kw)
+        elif detector == 'LPDModule':
+            if not raw:
+                raise NotImplementedError(
+                    'Calib. Data for single Modules not available yet')
+            source = source or 'FXE_DET_LPD1M-1/DET/0CH0:xtdf'
+            return LPDModule(source, data_like=data_like, **kw)
         else:
             raise NotImplementedError('detector %r not available' % detector)
 
-    def __init__(self, source='', raw=True, gen='random', data_like='online'):
+    def __init__(self, source='', raw=True, gen='random', data_like='online',
+                 pool=0, native=False):
+        """
+        Parameters
+        ----------
+        pool: int, optional
+            Generate this many images up front, and send them in turn,
+            rather than generating a new image for each train. Each pool
+            image takes the full size of a train's data, e.g. 128 MB for
+            raw AGIPD.
+        native: bool, optional
+            Generate random data directly in the detector data type, without
+            a float64 temporary array.
+        """
         self.source = source or 'INST_DET_GENERIC/DET/detector'
         self.raw = raw
         self.data_like = data_like
+        self.native = native
+        self._rng = np.random.default_rng()
         if gen == 'random':
             self.genfunc = self.random
         elif gen == 'zeros':
             self.genfunc = self.zeros
+        elif gen == 'photons':
+            self.genfunc = self.photons
         else:
             raise NotImplementedError('gen func %r not implemented' % gen)
+        self._static = None  # Arrays which are the same for every train
+        self._model = None  # Maps and buffers for gen='photons'
+
+        if pool:
+            images = cycle([self.genfunc() for _ in range(pool)])
+            self.genfunc = partial(next, images)
 
     @property
     def data_type(self):
@@ -90,12 +129,244 @@ class Detector:
         return shape
 
     def random(self):
+        if self.native:
+            return self._random_native()
         return np.random.uniform(low=1500, high=1600,
                                  size=self.data_shape).astype(self.data_type)
 
+    def _random_native(self):
+        if np.issubdtype(self.data_type, np.integer):
+            return self._rng.integers(1500, 1600, size=self.data_shape,
+                                      dtype=self.data_type)
+        data = self._rng.random(size=self.data_shape, dtype=self.data_type)
+        data *= 100
+        data += 1500
+        return data
+
     def zeros(self):
         return np.zeros(self.data_shape, dtype=self.data_type)
 
+    @property
+    def gain_thresholds(self):
+        """Thresholds on ``image.gain`` between gain stages, for
+        :class:`~karabo_bridge.calibration.Calibration` with gen='photons'
+        """
+        levels = self.gain_levels
+        return tuple((a + b) / 2 for a, b in zip(levels, levels[1:]))
+
+    def pixel_positions(self):
+        """Pixel positions in mm from the beam, shaped (modules, mod_y, mod_x)
+
+        Modules are placed on a grid as in :attr:`layout`, with the beam in
+        the centre of the grid.
+        """
+        rows, cols = self.layout.shape
+        iy, ix = np.mgrid[:self.mod_y, :self.mod_x].astype(np.float32)
+        modules = range(self.modules) if self.modules > 1 else [0]
+        x = np.empty((len(modules), self.mod_y, self.mod_x), np.float32)
+        y = np.empty_like(x)
+        for i, mod in enumerate(modules):
+            col, row = self.module_position(mod)
+            x[i] = (col * self.mod_x + ix - cols * self.mod_x / 2)
+            y[i] = (row * self.mod_y + iy - rows * self.mod_y / 2)
+        return x * self.pixel_size, y * self.pixel_size
+
+    def _ring_angles_from_radii(self):
+        """Scattering angles (2 theta) of the rings in :attr:`ring_radii`"""
+        half_width = self.layout.shape[1] * self.mod_x * self.pixel_size / 2
+        return np.arctan(np.array(self.ring_radii) * half_width
+                         / self.distance)
+
+    def _photon_model(self):
+        """Make the static maps and the work buffers for photons()"""
+        x, y = self.pixel_positions()
+        angle = np.arctan(np.hypot(x, y) / self.distance)
+        self._ring_angles = self._ring_angles_from_radii()
+
+        # Mean photons per pixel and pulse: diffuse background and rings
+        mean = 0.05 * np.exp(-angle / 0.1)
+        width = 2 * self.pixel_size / self.distance
+        for i, ring in enumerate(self._ring_angles):
+            profile = np.exp(-0.5 * ((angle - ring) / width)**2)
+            mean += (0.5 / (i + 1)) * profile
+
+        # Pedestal and relative gain for each gain stage, per pixel
+        offset, rel_gain = self.calibration_constants(n_cells=1, seed=0)
+        plane = (-1, len(x), self.mod_y, self.mod_x)
+        if self.data_like == 'file':
+            offset = offset.swapaxes(-1, -2)
+            rel_gain = rel_gain.swapaxes(-1, -2)
+        # Drop the cell axis, then order as (stage, modules, mod_y, mod_x)
+        cell_axis = -1 if self.data_like == 'online' else 1
+        offset = np.squeeze(offset, axis=cell_axis).reshape(plane)
+        rel_gain = np.squeeze(rel_gain, axis=cell_axis).reshape(plane)
+
+        levels = np.array(self.gain_levels, np.float32)[:, None, None, None]
+        spread = self._rng.normal(0, 30, x.shape).astype(np.float32)
+        gain_maps = (levels + spread).astype(np.uint16)
+        npulses = min(max(self._photon_block // x.size, 1), self.pulses)
+        block = (npulses,) + x.shape
+
+        self._model = {
+            'mean': mean.astype(np.float32),
+            'offset': offset,
+            # Dividing the signal by the gain gives the raw value
+            'rel_gain': rel_gain,
+            'gain_maps': gain_maps,
+            # Work buffers for a block of pulses, reused for every block
+            'lam': np.empty(block, np.float32),
+            'signal': np.empty(block, np.float32),
+            'raw': np.empty(block, np.float32),
+            'stage': np.empty(block, np.uint8),
+            'high': np.empty(block, np.bool_),
+            'noise': 2 * self._rng.standard_normal(2 * x.size, np.float32),
+            'frames': np.empty((self.pulses,) + x.shape, self.data_type),
+            'gain_frames': np.empty((self.pulses,) + x.shape, np.uint16),
+        }
+        return self._model
+
+    def _add_peaks(self, lam):
+        """Add Bragg peaks, as small spots, to the mean photon map"""
+        n = self.peaks_per_hit
+        # Pick points on the rings, then find the pixel at that position
+        ring = self._rng.choice(self._ring_angles, n)
+        radius = np.tan(ring * self._rng.normal(1, 0.02, n)) * self.distance
+        phi = self._rng.uniform(0, 2 * np.pi, n)
+        gx = radius * np.cos(phi) / self.pixel_size
+        gy = radius * np.sin(phi) / self.pixel_size
+        rows, cols = self.layout.shape
+        gx = np.floor(gx + cols * self.mod_x / 2).astype(np.intp)
+        gy = np.floor(gy + rows * self.mod_y / 2).astype(np.intp)
+
+        col, ix = np.divmod(gx, self.mod_x)
+        row, iy = np.divmod(gy, self.mod_y)
+        ok = (col >= 0) & (col < cols) & (row >= 0) & (row < rows)
+        module = np.full(n, -1)
+        module[ok] = self.layout[row[ok], col[ok]]
+        if self.modules == 1:
+            ok &= module == 0
+            module[ok] = 0
+        ok &= (module >= 0) & (module < len(lam))
+        ix, iy, module = ix[ok], iy[ok], module[ok]
+
+        height = self._rng.lognormal(np.log(1000), 1.5, len(module))
+        height = np.minimum(height, 20000).astype(np.float32)
+        for dy, dx, weight in ((0, 0, 1.), (-1, 0, .3), (1, 0, .3),
+                               (0, -1, .3), (0, 1, .3)):
+            py = np.clip(iy + dy, 0, self.mod_y - 1)
+            px = np.clip(ix + dx, 0, self.mod_x - 1)
+            np.add.at(lam, (module, py, px), weight * height)
+
+    def photons(self):
+        """Simulated diffraction: Poisson photon counts on a pedestal.
+
+        Each pulse has a diffuse background and powder rings, and a fraction
+        of the pulses (:attr:`hit_rate`) also have Bragg peaks on the rings.
+        Bright pixels switch to medium or low gain: raw data is the per-pixel
+        pedestal plus the signal divided by the relative gain of the stage,
+        and ``image.gain`` has the matching gain level. For corrected data,
+        ``image.data`` is the signal in ADU and ``image.gain`` the gain stage.
+
+        Generating a train of a large detector takes seconds, so use it with
+        a *pool* to send data at a high rate.
+
+        Returns
+        -------
+        data, gain : numpy.ndarray
+            ``image.data`` and ``image.gain`` arrays.
+        """
+        m = self._model or self._photon_model()
+        npix = m['mean'].size
+        block = len(m['lam'])  # Pulses generated together
+        # Frames are made contiguous in these buffers, then rearranged into
+        # the data layout in one go, which is much faster than per frame.
+        frames, gain_frames = m['frames'], m['gain_frames']
+
+        intensity = self._rng.gamma(10, 0.1, self.pulses).astype(np.float32)
+        hits = self._rng.random(self.pulses) < self.hit_rate
+        noise_starts = self._rng.integers(0, npix, self.pulses)
+        for b0 in range(0, self.pulses, block):
+            b1 = min(b0 + block, self.pulses)
+            n = b1 - b0
+            lam, signal = m['lam'][:n], m['signal'][:n]
+            stage, high = m['stage'][:n], m['high'][:n]
+
+            pulse_intensity = intensity[b0:b1].reshape(
+                (n,) + (1,) * m['mean'].ndim)
+            np.multiply(m['mean'], pulse_intensity, out=lam)
+            for p in np.nonzero(hits[b0:b1])[0]:
+                self._add_peaks(lam[p])
+            np.multiply(self._rng.poisson(lam), self.adu_per_photon,
+                        out=signal, casting='unsafe')
+            # Readout noise: a random window of a pre-generated noise array
+            for p, start in enumerate(noise_starts[b0:b1]):
+                signal[p] += m['noise'][start:start + npix].reshape(
+                    signal.shape[1:])
+
+            out, out_gain = frames[b0:b1], gain_frames[b0:b1]
+            np.greater(signal, self.gain_switch[0], out=stage)
+            np.greater(signal, self.gain_switch[1], out=high)
+            stage += high
+            if not self.raw:
+                # Corrected data: the signal, and the gain stage index
+                out[:] = signal
+                out_gain[:] = stage
+                continue
+
+            # Most pixels are in high gain: compute that everywhere, then
+            # replace the few pixels in medium and low gain.
+            raw = np.divide(signal, m['rel_gain'][0], out=m['raw'][:n])
+            raw += m['offset'][0]
+            out_gain[:] = m['gain_maps'][0]
+            switched = np.nonzero(stage)
+            idx = (stage[switched],) + switched[1:]
+            raw[switched] = (signal[switched] / m['rel_gain'][idx]
+                             + m['offset'][idx])
+            out_gain[switched] = m['gain_maps'][idx]
+            np.clip(raw, 0, np.iinfo(np.uint16).max, out=raw)
+            out[:] = raw
+
+        data = np.empty(self.data_shape, dtype=self.data_type)
+        gain = np.empty(self.data_shape, dtype=np.uint16)
+        for arr, buf in ((data, frames), (gain, gain_frames)):
+            if self.data_like == 'online':
+                arr[...] = np.moveaxis(buf, 0, -1).reshape(arr.shape)
+            else:
+                arr[...] = buf.swapaxes(-1, -2).reshape(arr.shape)
+        return data, gain
+
+    def calibration_constants(self, n_gain=3, n_cells=None, seed=None):
+        """Generate offset and relative gain constants matching this detector.
+
+        The constants are shaped ``(n_gain,) + data_shape``, with the pulse
+        axis replaced by a memory cell axis of length *n_cells* (default: the
+        number of pulses). They can be used with
+        :class:`karabo_bridge.calibration.Calibration`.
+
+        Returns
+        -------
+        offset, rel_gain : numpy.ndarray
+            float32 arrays of constants.
+        """
+        n_cells = n_cells or self.pulses
+        shape = list(self.data_shape)
+        cell_axis = -1 if self.data_like == 'online' else 0
+        shape[cell_axis] = n_cells
+        shape = (n_gain,) + tuple(shape)
+
+        rng = np.random.default_rng(seed)
+        # Higher gain stages have a higher baseline and a lower gain
+        stage_shape = (n_gain,) + (1,) * (len(shape) - 1)
+        stage = np.arange(n_gain, dtype=np.float32).reshape(stage_shape)
+        offset = rng.standard_normal(shape, dtype=np.float32)
+        offset *= 10
+        offset += 1500 + 1000 * stage
+        rel_gain = rng.standard_normal(shape, dtype=np.float32)
+        rel_gain *= 0.02
+        rel_gain += 1
+        rel_gain *= 10 ** stage
+        return offset, rel_gain
+
     def module_position(self, ix):
         y, x = np.where(self.layout == ix)
         assert len(y) == len(x) == 1
@@ -117,24 +388,35 @@ class Detector:
     def gen_data(self, trainId):
         data = {}
         timestamp = time()
-        data['image.data'] = self.genfunc()
+        image = self.genfunc()
+        gain = None
+        if isinstance(image, tuple):
+            image, gain = image
+        data['image.data'] = image
         base_src = '/'.join((self.source.rpartition('/')[0], '{}CH0:xtdf'))
         sources = [base_src.format(i) for i in range(16)]
-        # TODO: cellId differ between AGIPD/LPD
-        data['image.cellId'] = np.arange(self.pulses, dtype=np.uint16)
+        if self._static is None:
+            self._static = {
+                # TODO: cellId differ between AGIPD/LPD
+                'image.cellId': np.arange(self.pulses, dtype=np.uint16),
+                # Image gain has only entries for one module
+                'image.gain': np.zeros((self.mod_y, self.mod_x, self.pulses),
+                                       dtype=np.uint16),
+                # TODO: pulseId differ between AGIPD/LPD
+                'image.pulseId': np.arange(self.pulses, dtype=np.uint64),
+            }
+        data['image.cellId'] = self._static['image.cellId']
         if not self.raw:
             data['image.passport'] = self.corr_passport()
         if self.modules > 1:
             # More than one modules have sources
             data['sources'] = sources
             data['modulesPresent'] = [True for i in range(self.modules)]
-        # Image gain has only entries for one module
-        data['image.gain'] = np.zeros((self.mod_y, self.mod_x, self.pulses),
-                                      dtype=np.uint16)
-        # TODO: pulseId differ between AGIPD/LPD
-        data['image.pulseId'] = np.arange(self.pulses, dtype=np.uint64)
-        data['image.trainId'] = (
-            np.ones(self.pulses) * trainId).astype(np.uint64)
+        if gain is None:
+            gain = self._static['image.gain']
+        data['image.gain'] = gain
+        data['image.pulseId'] = self._static['image.pulseId']
+        data['image.trainId'] = np.full(self.pulses, trainId, dtype=np.uint64)
 
         meta = self.gen_metadata(self.source, timestamp, trainId)
         return {self.source: data}, meta
@@ -178,23 +460,114 @@ class LPD(Detector):
     ])
 
 
+class LPDModule(LPD):
+    modules = 1
+
+
+class TrainPacer:
+    """Schedule simulated trains at a target rate.
+
+    Send times are computed from the first train, ``t0 + n / rate``, so
+    delays in sending one train don't shift the following ones. Iterate over
+    :meth:`train_ids` to get the IDs of the trains to send; after each one,
+    :attr:`due` is the time (from :func:`time.monotonic`) to send it.
+
+    Parameters
+    ----------
+    rate: float, optional
+        Trains per second; European XFEL runs at 10 Hz. None means as fast
+        as possible.
+    jitter: float, optional
+        Standard deviation, in seconds, of random offsets to the send times.
+    drop: float, optional
+        Probability of skipping each train ID, to simulate lost trains.
+    burst_every, burst_size: int, optional
+        Every *burst_every* trains, hold back *burst_size* trains and send
+        them back to back, as after a stall in the data pipeline.
+    seed: int, optional
+        Seed for the random jitter and dropped trains, to make a run
+        reproducible.
+    first_train_id: int, optional
+    start_time: float, optional
+        Wall clock time (from :func:`time.time`) at which the first train is
+        due, to keep several simulators in step. By default, the first
+        train is sent straight away.
+    """
+    def __init__(self, rate=None, jitter=0, drop=0, burst_every=0,
+                 burst_size=0, seed=None, first_train_id=10000000000,
+                 start_time=None):
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be positive')
+        if rate is None and (jitter or burst_every):
+            raise ValueError('jitter and bursts need a train rate')
+        if burst_size >= burst_every > 0:
+            raise ValueError('burst_size must be less than burst_every')
+        if not 0 <= drop < 1:
+            raise ValueError('drop must be in the range [0, 1)')
+        self.rate = rate
+        self.jitter = jitter
+        self.drop = drop
+        self.burst_every = burst_every
+        self.burst_size = burst_size
+        self.first_train_id = first_train_id
+        self.start_time = start_time
+        self.rng = np.random.default_rng(seed)
+        self.dropped = 0
+        self.due = None
+
+    def _scheduled(self, n):
+        """Time offset to send the n-th train"""
+        if self.burst_every and self.burst_size:
+            # Held back until the last train of the burst is due
+            pos = n % self.burst_every
+            if pos >= self.burst_every - self.burst_size - 1:
+                n += self.burst_every - 1 - pos
+        offset = n / self.rate
+        if self.jitter:
+            offset += self.rng.normal(0, self.jitter)
+        return offset
+
+    def train_ids(self):
+        t0 = monotonic()
+        if self.start_time is not None:
+            t0 += self.start_time - time()
+        for n in count():
+            if self.drop and self.rng.random() < self.drop:
+                self.dropped += 1
+                continue
+            if self.rate is None:
+                self.due = t0
+            else:
+                self.due = t0 + self._scheduled(n)
+            yield self.first_train_id + n
+
+
 def data_generator(detector='AGIPD', raw=False, nsources=1, datagen='random',
-                   data_like='online', *, debug=False):
+                   data_like='online', pool=0, native=False, train_ids=None,
+                   source='', sources=None, *, debug=False):
+    """Generate simulated trains.
+
+    With *sources*, a list of names, or *nsources* > 1, the detector data
+    is sent as several sources sharing the same arrays.
+    """
+    detector = Detector.getDetector(detector, source=source, raw=raw,
+                                    gen=datagen, data_like=data_like,
+                                    pool=pool, native=native)
+    if sources is None and nsources > 1:
+        sources = [f'{detector.source}-{i + 1}' for i in range(nsources)]
 
-    detector = Detector.getDetector(detector, raw=raw, gen=datagen,
-                                    data_like=data_like)
+    if train_ids is None:
+        train_ids = count(start=10000000000)
 
-    for train_id in count(start=10000000000):
+    for train_id in train_ids:
         data, meta = detector.gen_data(train_id)
 
-        if nsources > 1:
+        if sources:
             source = detector.source
-            for i in range(nsources):
-                src = source + "-" + str(i+1)
-                data[src] = copy.deepcopy(data[source])
-                meta[src] = copy.deepcopy(meta[source])
-                meta[src]['source'] = src
-            del data[source]
-            del meta[source]
+            src_data, src_meta = data.pop(source), meta.pop(source)
+            for src in sources:
+                # The sources share the same arrays: they are only read
+                data[src] = dict(src_data)
+                meta[src] = dict(src_meta, source=src)
 
         yield (data, meta)
@@ -0,0 +1,60 @@
+# coding: utf-8
+"""
+Common code for client stages processing detector images.
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+__all__ = ['ImageStage']
+
+
+class ImageStage:
+    """Base class for :class:`~karabo_bridge.Client` stages which process
+    one image key in each selected source.
+
+    Subclasses implement :meth:`process`, and list any other keys a source
+    must have in ``required_keys``.
+
+    Parameters
+    ----------
+    source : str, optional
+        The source to process. By default, all sources having *key* and the
+        ``required_keys``.
+    key : str, optional
+        The image key (default ``'image.data'``).
+    data_like : str, optional ['online', 'file']
+        Data array axes ordering, as in :func:`~karabo_bridge.start_gen`:
+        online -> (modules, fs, ss, pulses), file -> (pulses, modules, ss, fs)
+    """
+    required_keys = ()
+
+    def __init__(self, source=None, key='image.data', data_like='online'):
+        if data_like not in {'online', 'file'}:
+            raise ValueError(f'Unknown data layout: {data_like}')
+        self.source = source
+        self.key = key
+        self.data_like = data_like
+
+    def selected(self, data):
+        """Iterate over (source, source data) for the sources to process"""
+        for source, src_data in data.items():
+            if self.source is not None and source != self.source:
+                continue
+            if self.key not in src_data:
+                continue
+            if any(k not in src_data for k in self.required_keys):
+                continue
+            yield source, src_data
+
+    def process(self, source, src_data):
+        """Process one source's data for a train, modifying it in place"""
+        raise NotImplementedError
+
+    def __call__(self, data, meta):
+        for source, src_data in self.selected(data):
+            self.process(source, src_data)
+        return data, meta
@@ -0,0 +1,106 @@
+import numpy as np
+
+from karabo_bridge.accumulate import EWMStats, RollingStats, RunningStats
+
+
+def make_trains(n=6):
+    rng = np.random.default_rng(0)
+    # (modules, ss, fs, pulses), with a repeated cell in each train
+    cells = np.array([0, 2, 1, 2])
+    return [(rng.normal(100, 5, (2, 3, 4, 4)), cells) for _ in range(n)]
+
+
+def per_cell(trains, cell):
+    return np.stack([
+        img[..., p] for img, cells in trains for p in np.nonzero(cells == cell)[0]
+    ])
+
+
+def test_running_stats():
+    trains = make_trains()
+    stats = RunningStats(minmax=True)
+    for img, cells in trains:
+        stats.update(img, cells)
+
+    snap = stats.snapshot()
+    np.testing.assert_array_equal(snap['count'], [6, 6, 12])
+    for cell in range(3):
+        values = per_cell(trains, cell)
+        np.testing.assert_allclose(snap['mean'][cell], values.mean(axis=0))
+        np.testing.assert_allclose(snap['variance'][cell], values.var(axis=0))
+        np.testing.assert_array_equal(snap['min'][cell], values.min(axis=0))
+        np.testing.assert_array_equal(snap['max'][cell], values.max(axis=0))
+
+    # Snapshots are copies
+    snap['count'][:] = 0
+    assert stats.count.sum() == 24
+
+
+def test_rolling_stats():
+    trains = make_trains()
+    stats = RollingStats(window=2)
+    for img, cells in trains:
+        stats.update(img, cells)
+
+    snap = stats.snapshot()
+    np.testing.assert_array_equal(snap['count'], [2, 2, 4])
+    values = per_cell(trains[-2:], 2)
+    np.testing.assert_allclose(snap['mean'][2], values.mean(axis=0))
+    np.testing.assert_allclose(snap['variance'][2], values.var(axis=0))
+
+
+def test_rolling_stats_long_run():
+    # A big offset makes the sums lose precision as trains come and go
+    trains = [(img + 1e8, cells) for img, cells in make_trains(20)]
+    stats = RollingStats(window=3)
+    for img, cells in trains:
+        stats.update(img, cells)
+
+    snap = stats.snapshot()
+    np.testing.assert_array_equal(snap['count'], [3, 3, 6])
+    assert (snap['variance'] >= 0).all()
+    for cell in range(3):
+        values = per_cell(trains[-3:], cell)
+        np.testing.assert_allclose(snap['mean'][cell], values.mean(axis=0))
+
+
+def test_consecutive_cells():
+    # Consecutive cells are updated through views, others through copies
+    rng = np.random.default_rng(1)
+    order = np.array([3, 1, 0, 2])
+    for make in (lambda: RunningStats(minmax=True), lambda: EWMStats(0.3),
+                 lambda: RollingStats(2)):
+        in_order, shuffled = make(), make()
+        for _ in range(3):
+            img = rng.normal(100, 5, (2, 3, 4))
+            in_order.update(img, np.arange(4))
+            shuffled.update(img[..., order], order)
+        snap1, snap2 = in_order.snapshot(), shuffled.snapshot()
+        for name in snap1:
+            np.testing.assert_allclose(snap1[name], snap2[name])
+
+
+def test_no_pulses():
+    for stats in (RunningStats(), EWMStats(alpha=0.5), RollingStats(2)):
+        stats.update(np.zeros((2, 3, 0)), np.zeros(0, dtype=np.uint16))
+        assert stats.snapshot() == {}
+        stats.update(np.ones((2, 3, 1)), [0])
+        stats.update(np.zeros((2, 3, 0)), [])
+        np.testing.assert_array_equal(stats.snapshot()['count'], [1])
+
+
+def test_ewm_stats():
+    img = np.ones((2, 3, 2))
+    stats = EWMStats(alpha=0.5)
+    stats.update(img, [0, 1])
+    stats.update(img * 3, [0, 1])
+    snap = stats.snapshot()
+    np.testing.assert_allclose(snap['mean'], 2)
+    np.testing.assert_allclose(snap['variance'], 1)
+
+    # Cells with no data are NaN, as for RunningStats
+    stats.update(img[..., :1], [3])
+    snap = stats.snapshot()
+    assert np.isnan(snap['mean'][2]).all() and np.isnan(snap['std'][2]).all()
+    np.testing.assert_allclose(snap['mean'][3], 1)
+
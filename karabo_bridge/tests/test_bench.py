@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from karabo_bridge.cli import bench
+
+
+@pytest.mark.parametrize('server', ['sim', 'thread'])
+def test_run_config_inproc(server):
+    r = bench.run_config(server=server, transport='inproc', pattern='PUSH',
+                         ntrains=5, warmup=1)
+    assert 'error' not in r
+    assert r['pattern'] == 'PUSH-PULL'
+    assert r['trains'] == 5
+    assert r['server_cpu_ms_per_train'] >= 0
+    assert r['gb_per_s'] > 0
+    assert 0 < r['latency_ms']['p50'] <= r['latency_ms']['max']
+
+
+def test_main(tmp_path, capsys):
+    out = tmp_path / 'bench.json'
+    bench.main(['--transport', 'ipc', 'tcp', '-z', 'REP', '-p', '1.0', '2.2',
+                '--ntrains', '3', '--warmup', '1', '-o', str(out)])
+    with out.open() as f:
+        results = json.load(f)
+    assert results['environment']['karabo_bridge']
+    configs = [(r['transport'], r['protocol']) for r in results['results']]
+    assert configs == [('ipc', '1.0'), ('ipc', '2.2'),
+                       ('tcp', '1.0'), ('tcp', '2.2')]
+    assert all(r['trains'] == 3 for r in results['results'])
+    assert 'trains/s' in capsys.readouterr().err
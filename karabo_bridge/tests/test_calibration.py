@@ -0,0 +1,76 @@
+import numpy as np
+
+from karabo_bridge.calibration import Calibration
+from karabo_bridge.simulation import Detector
+
+
+source_spb_module = 'SPB_DET_AGIPD1M-1/DET/0CH0:xtdf'
+train_id = 10000000000
+
+
+def test_single_gain():
+    agipd = Detector.getDetector('AGIPDModule', raw=True)
+    offset, rel_gain = agipd.calibration_constants(n_gain=1, seed=0)
+    data, meta = agipd.gen_data(train_id)
+    raw = data[source_spb_module]['image.data'].copy()
+
+    calib = Calibration(offset, rel_gain)
+    data, meta = calib(data, meta)
+    corrected = data[source_spb_module]['image.data']
+
+    assert corrected.dtype == np.float32
+    expected = (raw - offset[0]) * rel_gain[0]
+    np.testing.assert_allclose(corrected, expected, rtol=1e-5)
+
+
+def test_gain_stages_and_cells():
+    rng = np.random.default_rng(1)
+    n_cells = 10
+    offset = rng.uniform(1000, 2000, (3, 2, 4, 5, n_cells)).astype(np.float32)
+    rel_gain = rng.uniform(0.5, 2, offset.shape).astype(np.float32)
+    raw = rng.integers(0, 4000, (2, 4, 5, 6), dtype=np.uint16)
+    gain = rng.integers(0, 3, raw.shape, dtype=np.uint16)
+    cells = np.array([9, 1, 3, 3, 0, 5], dtype=np.uint16)
+
+    expected = np.empty(raw.shape, dtype=np.float32)
+    for p, cell in enumerate(cells):
+        g = gain[..., p]
+        o = np.choose(g, offset[..., cell])
+        r = np.choose(g, rel_gain[..., cell])
+        expected[..., p] = (raw[..., p] - o) * r
+
+    for threads in (0, 2):
+        calib = Calibration(offset, rel_gain, threads=threads)
+        out = calib.correct(raw, cells, gain)
+        np.testing.assert_allclose(out, expected, rtol=1e-5)
+        # The output buffer is reused for the next train
+        assert calib.correct(raw, cells, gain) is out
+        calib.close()
+
+
+def test_broadcast_gain_threads():
+    rng = np.random.default_rng(2)
+    offset = rng.uniform(1000, 2000, (3, 2, 4, 5, 6)).astype(np.float32)
+    raw = rng.integers(0, 4000, (2, 4, 5, 6), dtype=np.uint16)
+    cells = np.arange(6)
+    # Same gain stages for every module: fewer dimensions, or a size 1 axis
+    gain_1mod = rng.integers(0, 3, (4, 5, 6), dtype=np.uint16)
+
+    expected = Calibration(offset).correct(
+        raw, cells, np.broadcast_to(gain_1mod, raw.shape)).copy()
+    for gain in (gain_1mod, gain_1mod[np.newaxis]):
+        calib = Calibration(offset, threads=2)
+        np.testing.assert_array_equal(calib.correct(raw, cells, gain),
+                                      expected)
+        calib.close()
+
+
+def test_gain_thresholds():
+    offset = np.array([10, 20, 30], dtype=np.float32).reshape(3, 1, 1)
+    raw = np.full((4, 1), 100, dtype=np.uint16)
+    gain = np.array([[5], [15], [25], [35]])
+
+    calib = Calibration(offset, gain_thresholds=[10, 30])
+    out = calib.correct(raw, np.zeros(1, dtype=np.uint16), gain)
+    np.testing.assert_array_equal(out[:, 0], [90, 80, 80, 70])
+
@@ -49,3 +49,45 @@ def test_timeout():
                 tid, data = c.next()
 
     assert 'No data received from ipc://nodata in the last 200 ms' in str(info.value)
+
+
+def test_metrics(sim_server):
+    src = 'SPB_DET_AGIPD1M-1/DET/0CH0:xtdf'
+    with Client(sim_server.endpoint) as c:
+        metrics = c.enable_metrics(attach=True)
+        for _ in range(3):
+            data, metadata = c.next()
+        sample = metadata[src]['karabo_bridge.metrics']
+
+    summary = metrics.summary()
+    assert summary['trains_received'] == 3
+    assert summary['trains_missed'] == 0
+    assert summary['last_train_id'] == metadata[src]['timestamp.tid']
+    assert summary['bytes_received'] > data[src]['image.data'].nbytes
+    for name in ('wait_seconds', 'recv_seconds', 'deserialize_seconds',
+                 'staleness_seconds'):
+        assert summary[name]['count'] == 3
+        assert summary[name]['p50'] >= 0
+    assert sample['last_train_id'] == metadata[src]['timestamp.tid']
+    assert sample['message_frames'] >= 1
+
+
+def test_metrics_gaps():
+    from karabo_bridge.metrics import ClientMetrics
+
+    m = ClientMetrics()
+    for tid in [10, 11, 14, 15, 17]:
+        m.record(0, 0, 0, [b''], {'src': {'timestamp.tid': tid}})
+    assert m.count['trains_missed'] == 3
+    assert m.count['trains_received'] == 5
+    # Bundles have a list of metadata dicts, one per train
+    m.record(0, 0, 0, [b''], {'src': [{'timestamp.tid': t} for t in (19, 20)]})
+    assert m.count['trains_missed'] == 4
+    assert m.count['trains_received'] == 7
+
+
+def test_metrics_timeout():
+    with Client('ipc://nodata', timeout=0.2) as c:
+        c.enable_metrics()
+        with pytest.raises(TimeoutError):
+            c.next()
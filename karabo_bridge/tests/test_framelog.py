@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pytest
+from testpath.tempdir import TemporaryWorkingDirectory
+
+from karabo_bridge import Client
+from karabo_bridge.cli import record
+from karabo_bridge.framelog import FrameLogReader, FrameLogWriter, message_info
+from karabo_bridge.serializer import deserialize, serialize
+
+
+def _meta(metadata, tid, ts):
+    return {src: {**m, 'timestamp.tid': tid, 'timestamp': ts}
+            for src, m in metadata.items()}
+
+
+def test_write_read(tmp_path, data, metadata, protocol_version):
+    path = str(tmp_path / 'run.frames')
+    tids = [105, 101, 103, 102]  # Not in order
+    with FrameLogWriter(path) as log:
+        for i, tid in enumerate(tids):
+            msg = serialize(data, _meta(metadata, tid, 1000. + i),
+                            protocol_version=protocol_version)
+            assert message_info(msg) == (tid, 1000. + i)
+            log.write(msg)
+
+    with FrameLogReader(path) as log:
+        assert len(log) == 4
+        np.testing.assert_array_equal(log.train_ids, tids)
+
+        d, m = deserialize(log.train(103))
+        assert m['source1']['timestamp.tid'] == 103
+        np.testing.assert_array_equal(d['XMPL/DET/MOD0']['image.data'],
+                                      data['XMPL/DET/MOD0']['image.data'])
+        with pytest.raises(KeyError):
+            log.train(104)
+
+        got = [deserialize(msg)[1]['source1']['timestamp.tid']
+               for msg in log.select_trains(102, 105)]
+        assert got == [102, 103]
+        got = [deserialize(msg)[1]['source1']['timestamp.tid']
+               for msg in log.select_time(1000.5, 1003)]
+        assert got == [101, 103]
+
+
+def test_incomplete_message(tmp_path, data, metadata):
+    path = str(tmp_path / 'run.frames')
+    with FrameLogWriter(path) as log:
+        for tid in (1, 2):
+            log.write(serialize(data, _meta(metadata, tid, 0.)))
+    # Truncate the last message, as if recording was interrupted
+    os.truncate(path, os.path.getsize(path) - 10)
+
+    with FrameLogReader(path) as log:
+        assert list(log.train_ids) == [1]
+
+
+def test_client_next_raw(tmp_path, sim_server):
+    path = str(tmp_path / 'run.frames')
+    with Client(sim_server.endpoint) as c, FrameLogWriter(path) as log:
+        for _ in range(3):
+            log.write(c.next_raw())
+
+    with FrameLogReader(path) as log:
+        assert len(log) == 3
+        data, meta = deserialize(log.message(0))
+        assert 'SPB_DET_AGIPD1M-1/DET/0CH0:xtdf' in data
+
+
+def test_record_framelog(sim_server):
+    with TemporaryWorkingDirectory() as td:
+        record.main([sim_server.endpoint, '-o', 'run', '--ntrains', '4',
+                     '--format', 'framelog'])
+        assert sorted(os.listdir(td)) == ['run.frames', 'run.frames.index']
+        with FrameLogReader('run.frames') as log:
+            assert len(log) == 4
+            assert np.all(np.diff(log.train_ids.astype(np.int64)) > 0)
@@ -1,6 +1,8 @@
 import os
 
 import h5py
+import numpy as np
+import pytest
 from testpath.tempdir import TemporaryWorkingDirectory
 
 from karabo_bridge.cli import glimpse
@@ -21,3 +23,25 @@ def test_save(sim_server):
         with h5py.File(path, 'r') as f:
             trainId = f['SPB_DET_AGIPD1M-1/DET/0CH0:xtdf/image.trainId'][:]
             assert trainId[0] == 10000000000
+
+
+def test_lazy_load(tmp_path):
+    path = str(tmp_path / 'train.h5')
+    image = np.arange(4 * 8 * 6, dtype=np.uint16).reshape(4, 8, 6)
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('SRC/DET/image.data', data=image, chunks=(1, 8, 6))
+        f['SRC/DET/scalar'] = 1.5
+
+    with glimpse.lazy_hdf5_to_dict(path) as d:
+        proxy = d['SRC']['DET']['image.data']
+        assert isinstance(proxy, glimpse.DatasetProxy)
+        assert proxy.shape == (4, 8, 6)
+        np.testing.assert_array_equal(proxy[2, :3], image[2, :3])
+        np.testing.assert_array_equal(np.asarray(proxy), image)
+        chunks = list(proxy.iter_chunks())
+        assert len(chunks) == 4
+        np.testing.assert_array_equal(chunks[1][1], image[1:2])
+        assert d['SRC']['DET']['scalar'].read() == 1.5
+
+    with pytest.raises(ValueError):
+        proxy[0]
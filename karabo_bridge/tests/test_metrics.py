@@ -0,0 +1,84 @@
+from queue import Full
+import time
+from tempfile import TemporaryDirectory
+from urllib.request import urlopen
+
+import numpy as np
+import pytest
+
+from karabo_bridge import Client
+from karabo_bridge.metrics import RollingWindow
+from karabo_bridge.server import ServerInThread, SimServerInThread
+
+
+def test_rolling_window():
+    w = RollingWindow(4)
+    assert np.isnan(w.last)
+    assert all(np.isnan(w.quantiles()))
+    for v in range(1, 7):
+        w.add(v)
+    np.testing.assert_array_equal(w.values, [3, 4, 5, 6])
+    assert w.last == 6
+    assert w.count == 6
+    assert w.total == 21
+    assert w.quantiles([0, 1]) == [3, 6]
+
+
+def test_server_metrics(data):
+    with TemporaryDirectory() as td:
+        endpoint = f'ipc://{td}/server'
+        with ServerInThread(endpoint, maxlen=2) as server:
+            assert server.metrics is None
+            samples = []
+            metrics = server.enable_metrics(window=10, port=0)
+            metrics.add_hook(samples.append)
+            for _ in range(3):
+                server.feed(data)
+
+            with Client(server.endpoint) as client:
+                for _ in range(3):
+                    client.next()
+
+            # The last train is recorded just after it is sent
+            deadline = time.monotonic() + 5
+            while metrics.count['trains_sent'] < 3:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            with urlopen(server.metrics_endpoint) as resp:
+                text = resp.read().decode()
+
+            # Queue is full: a non-blocking feed drops the train
+            server.feed(data)
+            server.feed(data)
+            with pytest.raises(Full):
+                server.feed(data, block=False)
+
+    summary = metrics.summary()
+    assert summary['trains_sent'] == 3
+    assert summary['trains_dropped'] == 1
+    assert summary['bytes_sent'] > 0
+    assert summary['serialize_seconds']['count'] == 3
+    assert summary['wait_seconds']['p50'] >= 0
+    assert len(samples) == 3
+    assert samples[0]['message_frames'] == summary['frames_sent'] // 3
+
+    assert 'karabo_bridge_trains_sent_total 3' in text
+    assert '# TYPE karabo_bridge_send_seconds summary' in text
+    assert 'karabo_bridge_serialize_seconds{quantile="0.99"}' in text
+    assert 'karabo_bridge_message_bytes_count 3' in text
+
+
+def test_sim_server_drops():
+    with TemporaryDirectory() as td:
+        endpoint = f'ipc://{td}/server'
+        with SimServerInThread(endpoint, detector='AGIPDModule', raw=True,
+                               pool=1, drop=0.5, seed=1,
+                               debug=False) as server:
+            metrics = server.enable_metrics()
+            with Client(server.endpoint) as client:
+                for _ in range(10):
+                    client.next()
+
+    summary = metrics.summary()
+    assert summary['trains_sent'] >= 10
+    assert summary['trains_dropped'] > 0
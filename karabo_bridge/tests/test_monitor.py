@@ -5,3 +5,26 @@ def test_main(sim_server, capsys):
     monitor.main([sim_server.endpoint, '--ntrains', '1'])
     out, err = capsys.readouterr()
     assert 'SPB_DET_AGIPD1M-1/DET/0CH0:xtdf' in out
+
+
+def test_stats(sim_server, capsys):
+    monitor.main([sim_server.endpoint, '--stats', '--ntrains', '5',
+                  '--interval', '0.01'])
+    out, err = capsys.readouterr()
+    assert 'Trains: 5 received, 0 missed' in out
+    assert 'trains/s' in out
+    assert 'SPB_DET_AGIPD1M-1/DET/0CH0:xtdf' in out
+    assert 'Train ID:' not in out  # No per-train printing
+
+
+def test_stream_stats_changes():
+    import numpy as np
+    from karabo_bridge.metrics import ClientMetrics
+
+    stats = monitor.StreamStats(ClientMetrics())
+    meta = {'src': {'timestamp.tid': 1}}
+    stats.update({'src': {'a': np.zeros((2, 3), np.uint16)}}, meta)
+    stats.update({'src': {'a': np.zeros((2, 3), np.float32)}}, meta)
+    assert list(stats.changes) == [
+        (1, 'src', 'a', ((2, 3), 'uint16'), ((2, 3), 'float32'))]
+    assert 'src a: (2, 3) uint16 -> (2, 3) float32' in stats.report()
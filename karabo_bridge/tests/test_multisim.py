@@ -0,0 +1,67 @@
+from tempfile import TemporaryDirectory
+
+import pytest
+import zmq
+
+from karabo_bridge import Client
+from karabo_bridge.cli.multisim import main
+from karabo_bridge.multisim import SimSupervisor
+
+
+def test_lockstep():
+    with TemporaryDirectory() as td:
+        endpoints = [f'ipc://{td}/mod{i}' for i in range(2)]
+        sup = SimSupervisor(endpoints, 'AGIPD', modules=[0, 1, 2, 3],
+                            modules_per_process=2, rate=10, pool=1,
+                            start_delay=1, report_interval=0.2)
+        with sup, Client(endpoints[0], timeout=20) as c0, \
+                Client(endpoints[1], timeout=20) as c1:
+            data0, meta0 = c0.next()
+            data1, meta1 = c1.next()
+            assert sorted(data0) == [
+                'SPB_DET_AGIPD1M-1/DET/0CH0:xtdf',
+                'SPB_DET_AGIPD1M-1/DET/1CH0:xtdf',
+            ]
+            assert sorted(data1) == [
+                'SPB_DET_AGIPD1M-1/DET/2CH0:xtdf',
+                'SPB_DET_AGIPD1M-1/DET/3CH0:xtdf',
+            ]
+            tid0 = meta0['SPB_DET_AGIPD1M-1/DET/0CH0:xtdf']['timestamp.tid']
+            tid1 = meta1['SPB_DET_AGIPD1M-1/DET/2CH0:xtdf']['timestamp.tid']
+            assert abs(tid0 - tid1) <= 1
+
+            for _ in range(3):
+                c0.next()
+                c1.next()
+            sup.poll(timeout=1)
+            summary = sup.summary()
+
+    assert summary['processes'] == 2
+    assert summary['trains'] >= 2
+    assert summary['bytes'] > 0
+
+
+def test_endpoint_count():
+    with pytest.raises(ValueError):
+        SimSupervisor(['tcp://*:4600'], 'AGIPD', modules=[0, 1])
+
+
+def test_worker_failure():
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.REP)
+    try:
+        sock.bind('tcp://127.0.0.1:*')
+        in_use = sock.getsockopt_string(zmq.LAST_ENDPOINT)
+        with TemporaryDirectory() as td:
+            sup = SimSupervisor([f'ipc://{td}/mod0', in_use], 'AGIPD',
+                                modules=[0, 1], pool=1, start_delay=1,
+                                report_interval=0.2)
+            with sup, pytest.raises(RuntimeError, match='Process 1'):
+                sup.run(duration=60)
+    finally:
+        ctx.destroy(linger=0)
+
+
+def test_cli_protocols():
+    with pytest.raises(SystemExit):
+        main(['4600', '--protocol', '2.1'])
@@ -0,0 +1,101 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+from testpath.tempdir import TemporaryWorkingDirectory
+
+from karabo_bridge import Client
+from karabo_bridge.cli import record
+
+SRC = 'SPB_DET_AGIPD1M-1/DET/0CH0:xtdf'
+
+
+def test_main(sim_server, capsys):
+    with TemporaryWorkingDirectory() as td:
+        record.main([sim_server.endpoint, '-o', 'run', '--ntrains', '5'])
+        assert os.listdir(td) == ['run_0000.h5']
+        with h5py.File(os.path.join(td, 'run_0000.h5'), 'r') as f:
+            tids = f['INDEX/trainId'][:]
+            assert len(tids) == 5
+            np.testing.assert_array_equal(f[f'INDEX/{SRC}/trainId'][:], tids)
+            image = f[f'{SRC}/image.data']
+            assert image.shape[0] == 5
+            assert image.chunks[0] == 1  # one train per chunk for images
+
+    out, err = capsys.readouterr()
+    assert 'Received 5 trains' in out
+
+
+def test_rollover(sim_server):
+    with TemporaryWorkingDirectory() as td:
+        record.main([sim_server.endpoint, '-o', 'run', '--ntrains', '3',
+                     '--max-file-size', '1', '--compression', 'gzip'])
+        files = sorted(os.listdir(td))
+        assert files == ['run_0000.h5', 'run_0001.h5', 'run_0002.h5']
+        for path in files:
+            with h5py.File(path, 'r') as f:
+                assert len(f['INDEX/trainId']) == 1
+                assert f[f'{SRC}/image.data'].compression == 'gzip'
+
+
+def test_writer_strings_and_skips(tmp_path):
+    writer = record.HDF5Writer(str(tmp_path / 'w'))
+    with writer:
+        for i in range(3):
+            data = {'src': {'name': 'motor', 'pos': float(i),
+                            'vals': [i, i + 1], 'nested': [{'a': 1}]}}
+            meta = {'src': {'timestamp.tid': 100 + i, 'timestamp': 1.5}}
+            writer.write(data, meta)
+
+    with h5py.File(writer.filenames[0], 'r') as f:
+        np.testing.assert_array_equal(f['INDEX/trainId'][:], [100, 101, 102])
+        np.testing.assert_array_equal(f['src/pos'][:], [0., 1., 2.])
+        assert f['src/vals'].shape == (3, 2)
+        assert f['src/name'][0] in (b'motor', 'motor')
+        assert 'nested' not in f['src']
+    assert ('src', 'nested') in writer.skipped
+
+
+def test_writer_key_index(tmp_path):
+    writer = record.HDF5Writer(str(tmp_path / 'w'))
+    with writer:
+        for i in range(4):
+            data = {'src': {'a': float(i)}}
+            if i >= 1:
+                data['src']['b'] = float(i)  # Appears after the first train
+            if i != 2:
+                data['src']['c'] = np.zeros(3 if i < 3 else 4)  # Reshaped
+            meta = {'src': {'timestamp.tid': 100 + i, 'timestamp': 1.5}}
+            writer.write(data, meta)
+
+    with h5py.File(writer.filenames[0], 'r') as f:
+        np.testing.assert_array_equal(f['INDEX/src/trainId'][:],
+                                      [100, 101, 102, 103])
+        np.testing.assert_array_equal(f['INDEX/src/keys/a'][:],
+                                      [100, 101, 102, 103])
+        np.testing.assert_array_equal(f['INDEX/src/keys/b'][:],
+                                      [101, 102, 103])
+        np.testing.assert_array_equal(f['src/b'][:], [1., 2., 3.])
+        np.testing.assert_array_equal(f['INDEX/src/keys/c'][:], [100, 101])
+        assert len(f['src/c']) == 2
+
+
+def test_writer_error(sim_server):
+    class FailingWriter:
+        closed = False
+
+        def write(self, data, meta):
+            raise OSError(28, 'No space left on device')
+
+        def close(self):
+            self.closed = True
+
+    writer = FailingWriter()
+    with Client(sim_server.endpoint) as client:
+        recorder = record.Recorder(client, writer)
+        with pytest.raises(OSError):
+            recorder.run(ntrains=20)
+    assert writer.closed
+    assert recorder.written == 0
+    assert recorder.received < 20
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from karabo_bridge.reduction import Reduction
+
+
+@pytest.fixture
+def image():
+    # (modules, ss, fs, pulses)
+    rng = np.random.default_rng(0)
+    yield rng.integers(0, 100, (4, 8, 6, 5), dtype=np.uint16)
+
+
+def test_roi(image):
+    red = Reduction()
+    red.add_roi('spot', np.s_[1, 2:5, 0:3])
+    res = red.reduce(image)
+    expected = image[1, 2:5, 0:3].sum(axis=(0, 1))
+    np.testing.assert_array_equal(res['spot'], expected)
+
+
+def test_module_mean(image):
+    red = Reduction()
+    red.add_module_mean()
+    res = red.reduce(image)['module_mean']
+    assert res.shape == (5, 4)
+    np.testing.assert_allclose(res, image.mean(axis=(1, 2)).T)
+
+    red = Reduction(data_like='file')
+    red.add_module_mean()
+    file_image = np.moveaxis(image, -1, 0).copy()
+    np.testing.assert_allclose(red.reduce(file_image)['module_mean'], res)
+
+
+def test_histogram(image):
+    red = Reduction(data_like='file')
+    red.add_histogram('hist', bins=10, range=(0, 50))
+    file_image = np.moveaxis(image, -1, 0).copy()
+    res = red.reduce(file_image)['hist']
+    assert res.shape == (5, 10)
+    for pulse in range(5):
+        expected, _ = np.histogram(file_image[pulse], bins=10, range=(0, 50))
+        np.testing.assert_array_equal(res[pulse], expected)
+
+
+@pytest.mark.parametrize('data_like', ['online', 'file'])
+def test_histogram_chunked(image, monkeypatch, data_like):
+    # Convert a few pixels at a time, so pulses span several chunks
+    monkeypatch.setattr(Reduction, '_histogram_chunk', 7)
+    red = Reduction(data_like=data_like)
+    red.add_histogram('hist', bins=10, range=(0, 50))
+    frames = np.moveaxis(image, -1, 0)
+    arr = image if data_like == 'online' else frames.copy()
+    res = red.reduce(arr)['hist']
+    for pulse in range(5):
+        expected, _ = np.histogram(frames[pulse], bins=10, range=(0, 50))
+        np.testing.assert_array_equal(res[pulse], expected)
+
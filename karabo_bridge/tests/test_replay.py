@@ -0,0 +1,95 @@
+from time import monotonic
+
+import numpy as np
+import pytest
+
+from karabo_bridge import Client
+from karabo_bridge.cli.record import HDF5Writer
+from karabo_bridge.framelog import FrameLogWriter
+from karabo_bridge.replay import ReplayServerInThread, _value
+from karabo_bridge.serializer import serialize
+
+
+def _trains(data, n, t0=1000.):
+    for i in range(n):
+        meta = {src: {'timestamp.tid': 100 + i, 'timestamp': t0 + 0.1 * i}
+                for src in data}
+        yield data, meta
+
+
+def test_replay_hdf5(tmp_path, data):
+    writer = HDF5Writer(str(tmp_path / 'run'))
+    with writer:
+        for d, m in _trains(data, 3):
+            writer.write(d, m)
+
+    endpoint = f'ipc://{tmp_path}/replay'
+    with ReplayServerInThread(endpoint, writer.filenames, rate='max'), \
+            Client(endpoint, timeout=5) as c:
+        for i in range(3):
+            d, m = c.next()
+            assert m['source1']['timestamp.tid'] == 100 + i
+            assert d['source1']['parameter.1.value'] == 123
+            assert d['source1']['string.param'] == 'True'
+            np.testing.assert_array_equal(d['source1']['list.of.int'], [1, 2, 3])
+            np.testing.assert_array_equal(
+                d['XMPL/DET/MOD0']['image.data'],
+                data['XMPL/DET/MOD0']['image.data'])
+
+
+def test_replay_hdf5_missing_keys(tmp_path):
+    writer = HDF5Writer(str(tmp_path / 'run'))
+    with writer:
+        for i in range(4):
+            d = {'src': {'a': float(100 + i)}}
+            if i in (1, 3):
+                d['src']['b'] = float(100 + i)
+            writer.write(d, {'src': {'timestamp.tid': 100 + i,
+                                     'timestamp': 1000.}})
+
+    endpoint = f'ipc://{tmp_path}/replay'
+    with ReplayServerInThread(endpoint, writer.filenames, rate='max'), \
+            Client(endpoint, timeout=5) as c:
+        for i in range(4):
+            d, m = c.next()
+            tid = m['src']['timestamp.tid']
+            assert tid == 100 + i
+            assert d['src']['a'] == tid
+            if i in (1, 3):
+                assert d['src']['b'] == tid
+            else:
+                assert 'b' not in d['src']
+
+
+@pytest.mark.parametrize('filters', [
+    {}, {'shuffle': True}, {'fletcher32': True}, {'compression': 'gzip'},
+])
+def test_value_filters(tmp_path, filters):
+    import h5py
+    arr = np.arange(2 * 3 * 4, dtype=np.uint16).reshape(2, 3, 4)
+    with h5py.File(tmp_path / 'f.h5', 'w') as f:
+        ds = f.create_dataset('a', data=arr, chunks=(1, 3, 4), **filters)
+        np.testing.assert_array_equal(_value(ds, 1), arr[1])
+
+
+def test_replay_framelog_rate(tmp_path, data, metadata):
+    path = str(tmp_path / 'run.frames')
+    with FrameLogWriter(path) as log:
+        for d, m in _trains(data, 4):
+            log.write(serialize(d, m))
+
+    endpoint = f'ipc://{tmp_path}/replay'
+    with ReplayServerInThread(endpoint, path, rate=20, loop=True), \
+            Client(endpoint, timeout=5) as c:
+        tids = [c.next()[1]['source1']['timestamp.tid'] for _ in range(2)]
+        t0 = monotonic()
+        tids += [c.next()[1]['source1']['timestamp.tid'] for _ in range(4)]
+        elapsed = monotonic() - t0
+
+    assert tids == [100, 101, 102, 103, 100, 101]
+    assert elapsed > 3 / 20
+
+
+def test_bad_rate(tmp_path):
+    with pytest.raises(ValueError):
+        ReplayServerInThread(f'ipc://{tmp_path}/replay', [], rate=-1)
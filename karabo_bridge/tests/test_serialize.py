@@ -1,7 +1,11 @@
+import msgpack
 import numpy as np
 import pytest
 
-from karabo_bridge import serialize, deserialize
+from karabo_bridge import (
+    serialize, deserialize, DeltaDecoder, DeltaEncoder, DeltaSyncError,
+    SparseArray, is_bundle, serialize_bundle, train_id, unbundle,
+)
 
 from .utils import compare_nested_dict
 
@@ -45,3 +49,223 @@ def test_serialize_with_metadata_and_dummy_timestamp(data, metadata, protocol_ve
 def test_wrong_version(data):
     with pytest.raises(ValueError):
         serialize(data, protocol_version='3.0')
+
+
+def test_sparse_array():
+    image = np.zeros((3, 40, 50), dtype=np.float32)
+    image[1, 2, 3] = 5
+    image[2, 39, 49] = 7.5
+    image[0, 0, 0] = 0.5  # Below threshold
+    data = {'XMPL/DET/MOD0': {'image.data': image, 'other': image}}
+
+    msg = serialize(data, sparse={'image.data': 1})
+    # Indices for 6000 elements fit in uint16
+    assert len(msg) == 7
+    assert msg[3].nbytes == 2 * 2
+
+    d, m = deserialize(msg)
+    expected = image.copy()
+    expected[0, 0, 0] = 0
+    np.testing.assert_array_equal(d['XMPL/DET/MOD0']['image.data'], expected)
+    np.testing.assert_array_equal(d['XMPL/DET/MOD0']['other'], image)
+
+    d, m = deserialize(msg, sparse='sparse')
+    sparse = d['XMPL/DET/MOD0']['image.data']
+    assert isinstance(sparse, SparseArray)
+    assert sparse.shape == image.shape
+    assert sparse.indices.dtype == np.uint16
+    np.testing.assert_array_equal(sparse.values, [5, 7.5])
+    np.testing.assert_array_equal(sparse.todense(), expected)
+
+
+def test_sparse_asarray():
+    sparse = SparseArray((2, 3), np.uint16, np.array([1, 4]),
+                         np.array([5, 7], dtype=np.uint16))
+    dense = np.asarray(sparse)
+    assert dense.dtype == np.uint16
+    np.testing.assert_array_equal(dense, [[0, 5, 0], [0, 7, 0]])
+    assert np.asarray(sparse, dtype=np.float32).dtype == np.float32
+
+
+def test_sparse_mask(data):
+    image = data['XMPL/DET/MOD0']['image.data']
+    mask = image > 100
+    msg = serialize(data, sparse={('XMPL/DET/MOD0', 'image.data'): mask})
+    d, m = deserialize(msg)
+    np.testing.assert_array_equal(d['XMPL/DET/MOD0']['image.data'],
+                                  np.where(mask, image, 0))
+
+    with pytest.raises(ValueError):
+        serialize(data, sparse={'image.data': mask}, protocol_version='1.0')
+
+
+@pytest.mark.parametrize('shuffle', [None, 'byte', 'bit'])
+@pytest.mark.parametrize('codec', ['zlib', 'lzma'])
+def test_compressed_array(codec, shuffle):
+    rng = np.random.default_rng(0)
+    image = rng.normal(1500, 10, (4, 33, 17)).astype(np.float32)
+    gain = rng.integers(0, 3, (5, 7), dtype=np.uint16)[:, ::2]
+    data = {'XMPL/DET/MOD0': {'image.data': image, 'image.gain': gain}}
+
+    options = {'codec': codec, 'shuffle': shuffle, 'chunk_size': 1000}
+    msg = serialize(data, compression={'image.data': options,
+                                       'image.gain': codec})
+    # image.data is split in 10 chunks of up to 248 floats
+    assert len(msg) == 2 + (1 + 10) + 2
+
+    d, m = deserialize(msg)
+    np.testing.assert_array_equal(d['XMPL/DET/MOD0']['image.data'], image)
+    np.testing.assert_array_equal(d['XMPL/DET/MOD0']['image.gain'], gain)
+
+
+def test_compress_empty_array():
+    data = {'src': {'empty': np.zeros((0, 3), dtype=np.uint16)}}
+    d, m = deserialize(serialize(data, compression={'empty': 'zlib'}))
+    assert d['src']['empty'].shape == (0, 3)
+
+
+def test_compression_bad_codec(data):
+    with pytest.raises(ValueError):
+        serialize(data, compression={'image.data': 'gzip'})
+
+
+def slow_train(i):
+    return {
+        'motor': {'position': i // 2, 'name': 'x', 'array': np.arange(3) + i},
+        'other': {'value': 1.5},
+    }
+
+
+def test_delta_encoding():
+    enc = DeltaEncoder(keyframe_interval=3)
+    dec = DeltaDecoder()
+    for i in range(7):
+        msg = serialize(slow_train(i), delta=enc)
+        headers = [msgpack.loads(f) for f in msg[::2]]
+        content = headers[0]['content']
+        assert content == ('msgpack' if i % 3 == 0 else 'msgpack-delta')
+
+        d, m = deserialize(msg, delta=dec)
+        compare_nested_dict(slow_train(i), d)
+
+        if content == 'msgpack-delta':
+            with pytest.raises(RuntimeError):
+                deserialize(msg)
+
+
+def test_delta_changes_only():
+    enc = DeltaEncoder()
+    dec = DeltaDecoder(changes_only=True)
+    deserialize(serialize(slow_train(0), delta=enc), delta=dec)
+    d, m = deserialize(serialize(slow_train(1), delta=enc), delta=dec)
+    assert d['motor'].keys() == {'array'}
+    assert d['other'] == {}
+    d, m = deserialize(serialize(slow_train(2), delta=enc), delta=dec)
+    assert d['motor'].keys() == {'position', 'array'}
+
+
+def test_delta_missed_message():
+    enc = DeltaEncoder()
+    dec = DeltaDecoder()
+    deserialize(serialize(slow_train(0), delta=enc), delta=dec)
+    serialize(slow_train(1), delta=enc)  # Not received
+    with pytest.raises(DeltaSyncError):
+        deserialize(serialize(slow_train(2), delta=enc), delta=dec)
+
+    # Joining mid-stream
+    with pytest.raises(DeltaSyncError):
+        deserialize(serialize(slow_train(3), delta=enc), delta=DeltaDecoder())
+
+    enc.request_keyframe()
+    d, m = deserialize(serialize(slow_train(4), delta=enc), delta=dec)
+    compare_nested_dict(slow_train(4), d)
+
+
+def test_bundle(data, metadata):
+    trains = []
+    for i in range(3):
+        d = {src: dict(props) for src, props in data.items()}
+        d['XMPL/DET/MOD0']['image.data'] = data['XMPL/DET/MOD0']['image.data'] + i
+        d['source1']['parameter.1.value'] = i
+        trains.append((d, metadata))
+
+    msg = serialize_bundle(trains)
+    d, m = deserialize(msg)
+    assert is_bundle(m)
+    assert d['XMPL/DET/MOD0']['image.data'].shape == (3, 2, 3, 4)
+    assert d['source1']['parameter.1.value'] == [0, 1, 2]
+    assert len(m['source1']) == 3
+
+    unbundled = unbundle(d, m)
+    assert len(unbundled) == 3
+    for (d_train, m_train), (expected, _) in zip(unbundled, trains):
+        compare_nested_dict(expected, d_train)
+        compare_nested_dict(metadata, m_train)
+
+    assert not is_bundle(deserialize(serialize(data))[1])
+
+
+def test_train_id():
+    assert train_id({'a': {}, 'b': {'timestamp.tid': np.uint64(5)}}) == 5
+    assert type(train_id({'a': {'timestamp.tid': np.uint64(5)}})) is int
+    assert train_id({'a': {}}) is None
+    assert train_id({}) is None
+    meta = {'a': [{'timestamp.tid': 7}, {'timestamp.tid': 8}]}
+    assert train_id(meta) == 7
+    # Protocol 1.0 keeps the metadata in the data
+    assert train_id(None, {'a': {'metadata': {'timestamp.tid': 9}}}) == 9
+
+
+def test_bundle_mismatch(data):
+    other = {'source1': data['source1']}
+    with pytest.raises(ValueError):
+        serialize_bundle([(data, None), (other, None)])
+
+
+def test_split_frames():
+    image = np.arange(10 * 3 * 4, dtype=np.uint16).reshape(10, 3, 4)
+    data = {'XMPL/DET/MOD0': {'image.data': image, 'small': image[:1]}}
+    msg = serialize(data, max_frame_size=100)
+    # 4 rows of 24 bytes per frame: 3 frames for image.data
+    assert len(msg) == 2 + 3 * 2 + 2
+
+    chunks = []
+    def on_chunk(source, path, offset, chunk):
+        chunks.append((source, path, offset, chunk.copy()))
+
+    d, m = deserialize(msg, on_chunk=on_chunk)
+    np.testing.assert_array_equal(d['XMPL/DET/MOD0']['image.data'], image)
+    np.testing.assert_array_equal(d['XMPL/DET/MOD0']['small'], image[:1])
+    assert [c[2] for c in chunks] == [0, 4, 8]
+    np.testing.assert_array_equal(chunks[1][3], image[4:8])
+
+
+def test_split_frames_single_chunk():
+    image = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    msg = [
+        msgpack.dumps({'source': 'XMPL/DET/MOD0', 'content': 'msgpack'}),
+        msgpack.dumps({}),
+        msgpack.dumps({'source': 'XMPL/DET/MOD0', 'content': 'array-chunk',
+                       'path': 'image.data', 'dtype': 'uint16',
+                       'shape': [3, 4], 'offset': 0, 'count': 3}),
+        image.tobytes(),
+    ]
+    d, m = deserialize(msg)
+    res = d['XMPL/DET/MOD0']['image.data']
+    np.testing.assert_array_equal(res, image)
+    assert not res.flags['OWNDATA']  # Not copied
+
+
+def test_parallel(data, metadata):
+    many = {f'SRC/{i}': dict(data['XMPL/DET/MOD0'], index=i) for i in range(20)}
+    many['XMPL/DET/MOD0'] = {'image.data': np.ones((4, 5, 6)).T}
+    msg_serial = serialize(many)
+    msg_parallel = serialize(many, parallel=True,
+                             compression={'image.data': {'codec': 'zlib',
+                                                         'chunk_size': 64}})
+    d, m = deserialize(msg_parallel)
+    compare_nested_dict(many, d)
+    assert len(msg_parallel) > len(msg_serial)
+
+    msg_parallel = serialize(many, parallel=True)
+    assert [bytes(f) for f in msg_parallel] == [bytes(f) for f in msg_serial]
@@ -1,4 +1,10 @@
+import time
+from tempfile import TemporaryDirectory
+
+import pytest
+
 from karabo_bridge import Client
+from karabo_bridge.server import ServerInThread, SimServerInThread
 
 from .utils import compare_nested_dict
 
@@ -11,3 +17,132 @@ def test_req_rep(server, data):
         for _ in range(3):
             d, m = client.next()
             compare_nested_dict(data, d)
+
+
+def test_delta_resync(data):
+    with TemporaryDirectory() as td:
+        endpoint = "ipc://{}/server".format(td)
+        with ServerInThread(endpoint, keyframe_interval=100) as server:
+            # 1 train for the first client, 3 for the second, which skips
+            # a delta message before requesting a keyframe
+            for _ in range(4):
+                server.feed(data)
+
+            with Client(server.endpoint) as client:
+                d, m = client.next()
+                compare_nested_dict(data, d)
+
+            # A new client joins mid-stream and requests a keyframe
+            with Client(server.endpoint) as client:
+                for _ in range(2):
+                    d, m = client.next()
+                    compare_nested_dict(data, d)
+
+
+def test_bundle(data, metadata):
+    with TemporaryDirectory() as td:
+        endpoint = "ipc://{}/server".format(td)
+        with ServerInThread(endpoint, bundle=3, bundle_time=0.5) as server:
+            for _ in range(3):
+                server.feed(data, metadata)
+
+            with Client(server.endpoint) as client:
+                for _ in range(3):
+                    d, m = client.next()
+                    compare_nested_dict(data, d)
+                    compare_nested_dict(metadata, m)
+
+            # Different sources are not bundled together
+            server.feed(data, metadata)
+            server.feed({'source1': data['source1']})
+            with Client(server.endpoint, unbundle=False) as client:
+                d, m = client.next()
+                assert 'XMPL/DET/MOD0' in d
+                d, m = client.next()
+                assert list(d) == ['source1']
+
+
+def test_fast_channel(data, metadata):
+    metadata = {src: dict(m, **{'timestamp.tid': 1000000})
+                for src, m in metadata.items()}
+    with TemporaryDirectory() as td:
+        endpoint = "ipc://{}/server".format(td)
+        fast_endpoint = "ipc://{}/fast".format(td)
+        with ServerInThread(endpoint, fast_endpoint=fast_endpoint,
+                            fast_threshold=10) as server:
+            with Client(server.endpoint,
+                        fast_endpoint=server.fast_endpoint) as client:
+                # Give the subscription time to reach the server
+                time.sleep(0.2)
+                for _ in range(2):
+                    server.feed(data, metadata)
+
+                d, m = client.next_fast()
+                assert list(d) == ['source1']
+                compare_nested_dict(metadata['source1'], m['source1'])
+
+                # The bulk data was sent after the small source
+                d, m = client.next(join=True)
+                compare_nested_dict(data, d)
+                compare_nested_dict(metadata, m)
+
+                d, m = client.next()
+                assert list(d) == ['XMPL/DET/MOD0']
+
+
+def test_sim_server_rate():
+    with TemporaryDirectory() as td:
+        endpoint = f'ipc://{td}/server'
+        with SimServerInThread(endpoint, detector='AGIPDModule', raw=True,
+                               pool=1, rate=20, drop=0.2, seed=0,
+                               debug=False), \
+                Client(endpoint, timeout=5) as c:
+            c.next()
+            t0 = time.monotonic()
+            tids = [c.next()[1]['SPB_DET_AGIPD1M-1/DET/0CH0:xtdf']
+                    ['timestamp.tid'] for _ in range(4)]
+            elapsed = time.monotonic() - t0
+
+    gaps = [b - a for a, b in zip(tids, tids[1:])]
+    # Trains are due at 20 Hz, including the dropped train IDs
+    assert elapsed >= (tids[-1] - tids[0]) / 20
+    assert min(gaps) >= 1
+
+
+def test_stop_idle_bundling_server(data):
+    for n_fed in (0, 2):
+        server = ServerInThread('tcp://127.0.0.1:*', bundle=4)
+        server.start()
+        for _ in range(n_fed):
+            server.feed(data)
+        time.sleep(0.1)
+        server.stop()
+        assert not server.thread.is_alive()
+
+
+def test_delta_socket_types():
+    with pytest.raises(ValueError, match='PUB or REP'):
+        ServerInThread('tcp://127.0.0.1:*', sock='PUSH', keyframe_interval=10)
+
+
+def test_delta_resync_serializes_once(data):
+    with TemporaryDirectory() as td:
+        endpoint = "ipc://{}/server".format(td)
+        with ServerInThread(endpoint, keyframe_interval=100) as server:
+            calls = []
+            dump = server.dump
+
+            def counting_dump(*args, **kwargs):
+                calls.append(1)
+                return dump(*args, **kwargs)
+            server.dump = counting_dump
+
+            for _ in range(4):
+                server.feed(data)
+            with Client(server.endpoint) as client:
+                client.next()
+            # The second client gets a delta, then asks for a keyframe
+            with Client(server.endpoint) as client:
+                for _ in range(2):
+                    client.next()
+            assert len(calls) == 4
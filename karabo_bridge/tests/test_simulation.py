@@ -1,6 +1,7 @@
 import numpy as np
+import pytest
 
-from karabo_bridge.simulation import Detector
+from karabo_bridge.simulation import Detector, TrainPacer, data_generator
 
 
 source_lpd = 'FXE_DET_LPD1M-1/CAL/APPEND_CORRECTED'
@@ -35,3 +36,87 @@ def test_filelike_shape():
     agipd = Detector.getDetector('AGIPDModule', gen='zeros', raw=True, data_like='file')
     data, meta = agipd.gen_data(train_id)
     assert data[source_spb_module]['image.data'].shape == (64, 512, 128)
+
+
+def test_native_dtype():
+    for raw, dtype in [(True, np.uint16), (False, np.float32)]:
+        agipd = Detector.getDetector('AGIPD', raw=raw, native=True)
+        img = agipd.random()
+        assert img.dtype == dtype
+        assert img.shape == (16, 128, 512, 64)
+        assert img.min() >= 1500 and img.max() <= 1600
+
+
+def test_pool():
+    agipd = Detector.getDetector('AGIPDModule', raw=True, pool=2, native=True)
+    images = [agipd.gen_data(train_id + i)[0][source_spb_module]['image.data']
+              for i in range(4)]
+    assert images[0] is images[2]
+    assert images[1] is images[3]
+    assert images[0] is not images[1]
+
+
+def test_shared_sources():
+    gen = data_generator('AGIPDModule', raw=True, nsources=3, pool=1)
+    data, meta = next(gen)
+    assert len(data) == 3
+    images = [d['image.data'] for d in data.values()]
+    assert images[0] is images[1] is images[2]
+    assert {m['source'] for m in meta.values()} == set(data)
+
+
+def test_pacer_schedule():
+    pacer = TrainPacer(rate=10, burst_every=5, burst_size=2)
+    ids = pacer.train_ids()
+    offsets = []
+    for _ in range(10):
+        next(ids)
+        offsets.append(pacer.due)
+    offsets = np.array(offsets) - offsets[0]
+    # Trains 2, 3 are held back and sent with 4, likewise 7, 8 with 9
+    np.testing.assert_allclose(
+        offsets, [0, .1, .4, .4, .4, .5, .6, .9, .9, .9], atol=1e-9)
+
+
+def test_pacer_drop_reproducible():
+    def run(seed):
+        pacer = TrainPacer(drop=0.3, seed=seed, first_train_id=0)
+        ids = pacer.train_ids()
+        return [next(ids) for _ in range(50)], pacer.dropped
+
+    tids, dropped = run(seed=1)
+    assert run(seed=1) == (tids, dropped)
+    assert dropped > 0
+    assert tids[-1] == 49 + dropped
+    assert len(set(tids)) == 50
+
+
+def test_pacer_invalid():
+    with pytest.raises(ValueError):
+        TrainPacer(jitter=0.01)  # Needs a rate
+    with pytest.raises(ValueError):
+        TrainPacer(rate=10, burst_every=3, burst_size=3)
+
+
+@pytest.mark.parametrize('data_like', ['online', 'file'])
+def test_photons(data_like):
+    agipd = Detector.getDetector('AGIPDModule', raw=True, gen='photons',
+                                 data_like=data_like)
+    agipd.hit_rate = 1
+    data, meta = agipd.gen_data(train_id)
+    img = data[source_spb_module]['image.data']
+    gain = data[source_spb_module]['image.gain']
+    assert img.dtype == np.uint16 and gain.dtype == np.uint16
+    assert img.shape == gain.shape == agipd.data_shape
+
+    # Mostly pedestal, with some bright pixels
+    assert 1400 < np.median(img) < 1600
+    assert img.max() > 2000
+    stage = np.searchsorted(agipd.gain_thresholds, gain)
+    assert (stage == 0).mean() > 0.99
+    assert (stage > 0).any()
+
+    # The next train is different, reusing the work buffers
+    img2 = agipd.gen_data(train_id + 1)[0][source_spb_module]['image.data']
+    assert img2 is not img
+    assert not np.array_equal(img, img2)
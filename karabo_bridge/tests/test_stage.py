@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from karabo_bridge import Client
+from karabo_bridge.accumulate import RunningStats
+from karabo_bridge.calibration import Calibration
+from karabo_bridge.reduction import Reduction
+from karabo_bridge.simulation import Detector
+from karabo_bridge.stage import ImageStage
+
+
+source_spb_module = 'SPB_DET_AGIPD1M-1/DET/0CH0:xtdf'
+
+
+class Recorder(ImageStage):
+    required_keys = ('image.cellId',)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.seen = []
+
+    def process(self, source, src_data):
+        self.seen.append(source)
+
+
+def test_selection():
+    data = {
+        'A': {'image.data': 1, 'image.cellId': 0},
+        'B': {'image.data': 1},  # No cell IDs
+        'C': {'other': 1, 'image.cellId': 0},
+    }
+    stage = Recorder()
+    assert stage(data, {}) == (data, {})
+    assert stage.seen == ['A']
+
+    stage = Recorder(source='C', key='other')
+    stage(data, {})
+    assert stage.seen == ['C']
+
+    with pytest.raises(ValueError):
+        Recorder(data_like='nonsense')
+
+
+def _calibration():
+    agipd = Detector.getDetector('AGIPDModule', raw=True)
+    offset, rel_gain = agipd.calibration_constants(n_gain=1, seed=0)
+    return Calibration(offset, rel_gain, threads=2)
+
+
+def _check_calibration(stage, data):
+    img = data[source_spb_module]['image.data']
+    assert img.dtype == np.float32
+    assert img.shape == (128, 512, 64)
+    stage.close()
+
+
+def _reduction():
+    red = Reduction(drop_image=True)
+    red.add_roi('roi', np.s_[0:10, 0:10])
+    red.add_histogram('hist', bins=4, range=(1500, 1600))
+    return red
+
+
+def _check_reduction(stage, data):
+    src_data = data[source_spb_module]
+    assert 'image.data' not in src_data
+    assert src_data['reduced.roi'].shape == (64,)
+    assert src_data['reduced.hist'].shape == (64, 4)
+    assert src_data['reduced.hist'].sum() == 128 * 512 * 64
+
+
+def _check_stats(stage, data):
+    snap = stage.snapshot()
+    assert snap['mean'].shape == (64, 128, 512)
+    np.testing.assert_array_equal(snap['count'], 2)
+
+
+@pytest.mark.parametrize('make_stage, check', [
+    (_calibration, _check_calibration),
+    (_reduction, _check_reduction),
+    (RunningStats, _check_stats),
+])
+def test_client_stage(sim_server, make_stage, check):
+    stage = make_stage()
+    with Client(sim_server.endpoint) as c:
+        c.add_stage(stage)
+        for _ in range(2):
+            data, meta = c.next()
+    check(stage, data)
@@ -0,0 +1,95 @@
+from itertools import islice
+
+import numpy as np
+
+from karabo_bridge import Client
+from karabo_bridge.timeseries import RingCollector, ScalarCollector
+
+
+def train(tid, value, name='motor'):
+    data = {'MOTOR/X': {'position': value, 'name': name}}
+    meta = {'MOTOR/X': {'timestamp.tid': tid}}
+    return data, meta
+
+
+def test_collector_growth():
+    coll = ScalarCollector({'MOTOR/X': ['position', 'name', 'missing']},
+                           chunk_size=4)
+    for i in range(10):
+        coll.add(*train(1000 + i, i * 0.5))
+
+    assert len(coll) == 10
+    np.testing.assert_array_equal(coll.train_ids, np.arange(1000, 1010))
+    pos = coll.column('MOTOR/X', 'position')
+    assert pos.dtype == np.float64
+    np.testing.assert_array_equal(pos, np.arange(10) * 0.5)
+    assert list(coll.column('MOTOR/X', 'name')) == ['motor'] * 10
+    assert np.isnan(coll.column('MOTOR/X', 'missing')).all()
+
+
+def test_missing_values():
+    coll = ScalarCollector([('MOTOR/X', 'position')])
+    coll.add(*train(1, 1.5))
+    coll.add({}, {'OTHER': {'timestamp.tid': 2}})
+    np.testing.assert_array_equal(coll.train_ids, [1, 2])
+    np.testing.assert_array_equal(coll.column('MOTOR/X', 'position'),
+                                  [1.5, np.nan])
+
+
+def test_missing_ints():
+    coll = ScalarCollector([('MOTOR/X', 'position')])
+    coll.add(*train(1, 0))
+    coll.add({}, {'OTHER': {'timestamp.tid': 2}})
+    coll.add(*train(3, 5))
+    pos = coll.column('MOTOR/X', 'position')
+    assert pos.dtype.kind == 'i'
+    np.testing.assert_array_equal(pos, [0, 0, 5])
+    np.testing.assert_array_equal(coll.valid('MOTOR/X', 'position'),
+                                  [True, False, True])
+
+
+def test_promote_dtype():
+    coll = ScalarCollector([('MOTOR/X', 'position')], chunk_size=2)
+    coll.add(*train(1, 1))
+    coll.add({}, {'OTHER': {'timestamp.tid': 2}})
+    coll.add(*train(3, 1.7))  # Not truncated to 1
+    pos = coll.column('MOTOR/X', 'position')
+    assert pos.dtype == np.float64
+    np.testing.assert_array_equal(pos, [1, np.nan, 1.7])
+
+    coll.add(*train(4, 'moving'))
+    pos = coll.column('MOTOR/X', 'position')
+    assert pos.dtype == object
+    assert list(pos) == [1, None, 1.7, 'moving']
+    np.testing.assert_array_equal(coll.valid('MOTOR/X', 'position'),
+                                  [True, False, True, True])
+
+    ring = RingCollector([('MOTOR/X', 'position')], maxlen=2)
+    for i in range(3):
+        ring.add(*train(i, i))
+    ring.add(*train(3, 3.5))
+    np.testing.assert_array_equal(ring.column('MOTOR/X', 'position'),
+                                  [2, 3.5])
+
+
+def test_ring_collector():
+    coll = RingCollector({'MOTOR/X': ['position']}, maxlen=3)
+    for i in range(7):
+        coll.add(*train(i, i))
+        pos = coll.column('MOTOR/X', 'position')
+        np.testing.assert_array_equal(pos, np.arange(max(0, i - 2), i + 1))
+
+    np.testing.assert_array_equal(coll.train_ids, [4, 5, 6])
+    # Columns are views of the ring buffer
+    assert coll.column('MOTOR/X', 'position').base is not None
+
+
+def test_client_stage(sim_server):
+    source = 'SPB_DET_AGIPD1M-1/DET/0CH0:xtdf'
+    coll = ScalarCollector({source: ['nonexistent']})
+    with Client(sim_server.endpoint) as c:
+        c.add_stage(coll)
+        for _ in islice(c, 3):
+            pass
+
+    np.testing.assert_array_equal(coll.train_ids, 10000000000 + np.arange(3))
@@ -0,0 +1,77 @@
+import json
+from tempfile import TemporaryDirectory
+from threading import Thread
+
+import pytest
+
+from karabo_bridge import Client, trace
+from karabo_bridge.server import ServerInThread
+
+
+@pytest.fixture
+def tracer():
+    yield trace.enable()
+    trace.disable()
+
+
+def test_ring_buffer():
+    t = trace.Tracer(size=4)
+    for i in range(6):
+        t.add('span', i, i + 0.5, train_id=i)
+    assert [s[5] for s in t.spans()] == [2, 3, 4, 5]
+
+
+def test_threads_without_lock():
+    t = trace.Tracer(size=10000)
+
+    def work():
+        for i in range(1000):
+            t.add('span', i, i + 1)
+    threads = [Thread(target=work) for _ in range(4)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert len(t.spans()) == 4000
+    assert len([e for e in t.events() if e['ph'] == 'X']) == 4000
+
+
+def test_server_and_client(tracer, data, metadata, tmp_path):
+    def passthrough(data, meta):
+        return data, meta
+
+    tid = 1000000
+    metadata = {src: dict(m, **{'timestamp.tid': tid})
+                for src, m in metadata.items()}
+
+    with TemporaryDirectory() as td:
+        with ServerInThread(f'ipc://{td}/server') as server:
+            for _ in range(2):
+                server.feed(data, metadata)
+            with Client(server.endpoint) as client:
+                client.add_stage(passthrough)
+                for _ in range(2):
+                    client.next()
+
+    path = tmp_path / 'trace.json'
+    trace.dump(str(path))
+    with path.open() as f:
+        events = json.load(f)['traceEvents']
+
+    spans = [e for e in events if e['ph'] == 'X']
+    names = {e['name'] for e in spans}
+    assert names >= {'Sender.serialize', 'Sender.poll', 'Sender.send',
+                     'Client.wait', 'Client.recv', 'Client.deserialize',
+                     'Client.stage'}
+    assert all(e['args']['train_id'] == tid for e in spans)
+    stage = next(e for e in spans if e['name'] == 'Client.stage')
+    assert stage['args']['stage'] == 'passthrough'
+    assert all(e['dur'] >= 0 for e in spans)
+    # Server and client threads are named
+    assert len({e['tid'] for e in events if e['ph'] == 'M'}) == 2
+
+
+def test_not_enabled():
+    assert trace.tracer is None
+    with pytest.raises(RuntimeError):
+        trace.dump('trace.json')
@@ -0,0 +1,227 @@
+# coding: utf-8
+"""
+Collect scalar values from a stream of trains into numpy columns.
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+import numpy as np
+
+from .serializer import train_id
+
+
+__all__ = ['ScalarCollector', 'RingCollector']
+
+
+def _missing_value(dtype):
+    if dtype.kind == 'f':
+        return np.nan
+    elif dtype.kind == 'O':
+        return None
+    return 0
+
+
+def _column_dtype(value):
+    if isinstance(value, (bool, int, float, np.bool_, np.number)):
+        return np.asarray(value).dtype
+    return np.dtype(object)  # strings, lists, etc.
+
+
+class ScalarCollector:
+    """Append selected scalar values of each train to typed numpy columns.
+
+    Columns are preallocated in chunks of *chunk_size* trains and grow by
+    doubling, so appending is O(1) amortized. Reading a column returns a
+    view of the data collected so far, without copying::
+
+        collector = ScalarCollector({'MOTOR/X': ['actualPosition.value']})
+        client.add_stage(collector)
+        ...
+        collector.train_ids
+        collector.column('MOTOR/X', 'actualPosition.value')
+
+    The column type is taken from the first value received, and promoted if
+    a later value doesn't fit, e.g. from int to float for a non-integer
+    reading, or to object for a string. Trains where a value is missing get
+    NaN in float columns, and 0, False or None otherwise; :meth:`valid`
+    tells these apart from values received.
+
+    Parameters
+    ----------
+    keys : dict or iterable of (source, key) tuples
+        The values to collect: ``{source: [key, ...]}`` or an iterable of
+        ``(source, key)``.
+    chunk_size : int, optional
+        Initial number of rows to allocate (default 1024).
+    """
+    def __init__(self, keys, chunk_size=1024):
+        if isinstance(keys, dict):
+            keys = [(src, key) for src, src_keys in keys.items()
+                    for key in src_keys]
+        self.keys = list(keys)
+        self.chunk_size = chunk_size
+        self._capacity = chunk_size
+        self._n = 0
+        self._tids = np.zeros(self._alloc_size(), dtype=np.uint64)
+        self._columns = {}
+        self._valid = {}  # Masks of the rows where each value was received
+
+    def _alloc_size(self):
+        return self._capacity
+
+    def _new_column(self, dtype):
+        col = np.empty(self._alloc_size(), dtype=dtype)
+        col[:] = _missing_value(col.dtype)
+        return col
+
+    def _grow(self):
+        self._capacity *= 2
+        self._tids = np.resize(self._tids, self._capacity)
+        for name, col in self._columns.items():
+            new = self._new_column(col.dtype)
+            new[:self._n] = col[:self._n]
+            self._columns[name] = new
+            valid = np.zeros(self._alloc_size(), dtype=np.bool_)
+            valid[:self._n] = self._valid[name][:self._n]
+            self._valid[name] = valid
+
+    def _promote(self, name, value):
+        """Change a column's type if needed to hold *value*"""
+        col = self._columns[name]
+        dtype = np.result_type(col.dtype, _column_dtype(value))
+        if dtype == col.dtype:
+            return col
+        new = self._new_column(dtype)
+        valid = self._valid[name]
+        new[valid] = col[valid]
+        self._columns[name] = new
+        return new
+
+    def _row_slots(self):
+        """Indices in the buffers where the next row is written"""
+        if self._n == self._capacity:
+            self._grow()
+        return (self._n,)
+
+    def add(self, data, meta):
+        """Append the selected values from one train."""
+        tid = train_id(meta) or 0
+        slots = self._row_slots()
+        for slot in slots:
+            self._tids[slot] = tid
+
+        for name in self.keys:
+            src, key = name
+            value = data.get(src, {}).get(key)
+            col = self._columns.get(name)
+            if col is None:
+                if value is None:
+                    continue
+                col = self._columns[name] = self._new_column(
+                    _column_dtype(value))
+                self._valid[name] = np.zeros(self._alloc_size(),
+                                             dtype=np.bool_)
+            received = value is not None
+            if received:
+                col = self._promote(name, value)
+            else:
+                value = _missing_value(col.dtype)
+            valid = self._valid[name]
+            for slot in slots:
+                col[slot] = value
+                valid[slot] = received
+        self._n += 1
+
+    def __call__(self, data, meta):
+        self.add(data, meta)
+        return data, meta
+
+    def __len__(self):
+        return self._n
+
+    def _view(self, arr):
+        return arr[:self._n]
+
+    @property
+    def train_ids(self):
+        """Train IDs of the collected rows (a view)"""
+        return self._view(self._tids)
+
+    def column(self, source, key):
+        """The values collected for a source and key (a view)"""
+        name = (source, key)
+        if name not in self._columns:
+            if name not in self.keys:
+                raise KeyError(name)
+            # No value received yet
+            return np.full(len(self), np.nan)
+        return self._view(self._columns[name])
+
+    def valid(self, source, key):
+        """Boolean mask of the rows where a value was received (a view)"""
+        name = (source, key)
+        if name not in self._valid:
+            if name not in self.keys:
+                raise KeyError(name)
+            return np.zeros(len(self), dtype=np.bool_)
+        return self._view(self._valid[name])
+
+    def columns(self):
+        """Dict of all columns, keyed by (source, key)"""
+        return {name: self.column(*name) for name in self.keys}
+
+    def to_dataframe(self):
+        """Make a pandas DataFrame of the columns, indexed by train ID.
+
+        This requires pandas to be installed. Integer and boolean columns
+        with missing values use pandas' nullable types.
+        """
+        import pandas as pd
+        columns = {}
+        for (src, key), col in self.columns().items():
+            missing = ~self.valid(src, key)
+            if missing.any() and col.dtype.kind in 'iu':
+                col = pd.arrays.IntegerArray(col.copy(), missing)
+            elif missing.any() and col.dtype.kind == 'b':
+                col = pd.arrays.BooleanArray(col.copy(), missing)
+            columns[f'{src}/{key}'] = col
+        return pd.DataFrame(
+            columns, index=pd.Index(self.train_ids, name='trainId'))
+
+
+class RingCollector(ScalarCollector):
+    """Like :class:`ScalarCollector`, but keeping only the last N trains.
+
+    Each value is written twice, in a buffer twice as long as *maxlen*, so
+    that the last N rows are always contiguous: appending is O(1) and column
+    access returns a view without copying.
+
+    Parameters
+    ----------
+    keys : dict or iterable of (source, key) tuples
+        As for :class:`ScalarCollector`.
+    maxlen : int
+        Number of trains to keep.
+    """
+    def __init__(self, keys, maxlen):
+        self.maxlen = maxlen
+        super().__init__(keys, chunk_size=maxlen)
+
+    def _alloc_size(self):
+        return 2 * self.maxlen
+
+    def _row_slots(self):
+        slot = self._n % self.maxlen
+        return slot, slot + self.maxlen
+
+    def __len__(self):
+        return min(self._n, self.maxlen)
+
+    def _view(self, arr):
+        n = len(self)
+        start = (self._n - n) % self.maxlen
+        return arr[start:start + n]
@@ -0,0 +1,129 @@
+# coding: utf-8
+"""
+Record where trains spend their time, as Chrome trace events.
+
+Tracing is off until :func:`enable` is called. Servers, clients and their
+processing stages then record spans in every thread, which can be saved
+with :func:`dump` and opened in Perfetto (https://ui.perfetto.dev) or
+``chrome://tracing``::
+
+    from karabo_bridge import trace
+
+    trace.enable()
+    ...  # Run servers and clients
+    trace.dump('bridge-trace.json')
+
+Copyright (c) 2017, European X-Ray Free-Electron Laser Facility GmbH
+All rights reserved.
+
+You should have received a copy of the 3-Clause BSD License along with this
+program. If not, see <https://opensource.org/licenses/BSD-3-Clause>
+"""
+
+from contextlib import contextmanager
+from itertools import count
+import json
+import os
+from threading import current_thread, get_ident
+from time import perf_counter
+
+
+__all__ = ['Tracer', 'enable', 'disable', 'dump']
+
+
+tracer = None  # The active Tracer, or None when tracing is off
+
+
+class Tracer:
+    """Spans kept in a fixed size ring buffer.
+
+    Each span claims a slot with ``next()`` on an :func:`itertools.count`,
+    which is atomic in CPython, so threads record spans without taking a
+    lock. When the buffer is full, the oldest spans are overwritten.
+
+    Times are from :func:`time.perf_counter`, in seconds.
+    """
+    def __init__(self, size=65536):
+        self.size = size
+        self._spans = [None] * size
+        self._slots = count()
+        self._threads = {}  # ident: name
+
+    def _add(self, is_async, name, start, end, train_id, args):
+        ident = get_ident()
+        if ident not in self._threads:
+            self._threads[ident] = current_thread().name
+        self._spans[next(self._slots) % self.size] = (
+            is_async, name, start, end, ident, train_id, args)
+
+    def add(self, name, start, end, train_id=None, **args):
+        """Record a span on the current thread"""
+        self._add(False, name, start, end, train_id, args)
+
+    def add_async(self, name, start, end, train_id=None, **args):
+        """Record a span which isn't work on one thread, e.g. time queued"""
+        self._add(True, name, start, end, train_id, args)
+
+    @contextmanager
+    def span(self, name, train_id=None, **args):
+        """Record the time spent in a ``with`` block"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, perf_counter(), train_id, **args)
+
+    def spans(self):
+        """The recorded spans, sorted by start time"""
+        return sorted((s for s in list(self._spans) if s is not None),
+                      key=lambda s: s[2])
+
+    def events(self):
+        """The spans as a list of Chrome trace event dicts"""
+        pid = os.getpid()
+        events = [
+            {'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': ident,
+             'args': {'name': name}}
+            for ident, name in list(self._threads.items())
+        ]
+        for i, (is_async, name, start, end, ident, tid,
+                args) in enumerate(self.spans()):
+            if tid is not None:
+                args = dict(args, train_id=tid)
+            common = {'name': name, 'cat': 'karabo_bridge', 'pid': pid,
+                      'tid': ident}
+            if is_async:
+                events.append(dict(common, ph='b', id=i, ts=start * 1e6,
+                                   args=args))
+                events.append(dict(common, ph='e', id=i, ts=end * 1e6))
+            else:
+                events.append(dict(common, ph='X', ts=start * 1e6,
+                                   dur=(end - start) * 1e6, args=args))
+        return events
+
+    def dump(self, path):
+        """Write the spans to a JSON file in the Chrome trace event format"""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events(),
+                       'displayTimeUnit': 'ms'}, f)
+
+
+def enable(size=65536):
+    """Start tracing, keeping the last *size* spans; returns the Tracer"""
+    global tracer
+    tracer = Tracer(size)
+    return tracer
+
+
+def disable():
+    """Stop tracing; returns the Tracer with the spans recorded, or None"""
+    global tracer
+    t, tracer = tracer, None
+    return t
+
+
+def dump(path):
+    """Write the spans recorded since :func:`enable` to a JSON file"""
+    if tracer is None:
+        raise RuntimeError('Tracing is not enabled')
+    tracer.dump(path)
@@ -53,8 +53,11 @@ setup(name="karabo_bridge",
       packages=find_packages(),
       entry_points={
           'console_scripts': [
+              'karabo-bridge-bench=karabo_bridge.cli.bench:main',
               'karabo-bridge-glimpse=karabo_bridge.cli.glimpse:main',
               'karabo-bridge-monitor=karabo_bridge.cli.monitor:main',
+              'karabo-bridge-multi-sim=karabo_bridge.cli.multisim:main',
+              'karabo-bridge-record=karabo_bridge.cli.record:main',
               'karabo-bridge-server-sim=karabo_bridge.cli.simulation:main',
               ],
       },